@@ -18,19 +18,18 @@
 # You should have received a copy of the GNU General Public License
 # along with Pipe-o-matic.  If not, see <http://www.gnu.org/licenses/>.
 
+# Only cheap modules are imported here, because every command-line tool pays
+# for them on every invocation. Heavier modules (yaml, subprocess, uuid,
+# datetime) are imported inside the functions that need them. (abc and
+# collections stay: argparse loads them anyway.)
 import abc
 import collections
 import contextlib
-from datetime import datetime
-import itertools
 import os
+import re
 import stat
 import string
-import subprocess
 import sys
-import uuid
-
-import yaml
 
 
 META_DIR_NAME = '.pmatic'
@@ -40,6 +39,25 @@ STAT_TESTS = [
     for name in 'BLK CHR DIR FIFO LNK REG SOCK'.split()
 ]
 EVENT_TYPES = 'started finished failed reverted'.split()
+HEAD_FIELDS = 'id what pipeline_name when'.split()
+SUMMARY_FIELDS = 'context status pipeline last_event failure'.split()
+CATALOG_FILE_NAME = 'catalog.sqlite'
+STEP_CACHE_DIR_NAME = 'step_cache'
+DEFAULTS_FILE_NAME = 'pmatic-defaults.yaml'
+PARAMETER_RECORDS_FILE_NAME = 'parameter_files.yaml'
+MAX_PARAMETER_GENERATORS = 8
+MAX_PARALLEL_STEPS = 256  # threads per parallel pipeline
+MAX_LINK_THREADS = 16  # per sandbox being built
+SANDBOXES_DIR_NAME = 'sandboxes'
+SCHEDULER_FILE_NAME = 'scheduler.yaml'
+LAUNCHER_FILE_NAME = 'launcher.yaml'
+EVENT_LOG_FILE_NAME = 'event_log.yaml'
+DURABILITY_MODES = ['none', 'batched', 'strict']
+METRICS_DIR_VARIABLE = 'PMATIC_METRICS_DIR'
+OBJECT_STORE_DIR_NAME = 'snapshot_store'
+FICLONE = 0x40049409  # Linux ioctl: _IOW(0x94, 9, int)
+IGNORE_FILE_NAME = '.pmaticignore'
+SNAPSHOT_MODES = ['all', 'outputs']
 
 
 def parse_args_and_env(args, parser):
@@ -64,7 +82,8 @@ def build_engine_from_namespace(namespace):
 
 
 class PipelineEngine(object):
-    def __init__(self, pmatic_base, context_path, verbose=False, params=None):
+    def __init__(self, pmatic_base, context_path, verbose=False, params=None,
+                 scheduler=None):
         """command is a Namespace from parsing the command line.
         Typical values:
         pipeline_name='foo-1',
@@ -72,21 +91,43 @@ class PipelineEngine(object):
         context_path='/.../pipe-o-matic/target/test/case01/execute',
         verbose=False,
         params=None
+        scheduler defaults to one configured by $PMATIC_BASE/scheduler.yaml.
         """
         super(PipelineEngine, self).__init__()
         self.pmatic_base = abspath(pmatic_base)
         self.context_path = abspath(context_path)
         self.verbose = verbose
-        self.params = params
+        self.params = parse_params(params or [])
+        # First, so that a fork server starts while the engine is small.
+        self.launcher = Launcher.from_config(self.pmatic_base)
         self.dependency_finder = DependencyFinder(pmatic_base)
-        self.event_log = EventLog(self.context_path)
+        self.catalog = Catalog.open_optional(self.pmatic_base)
+        self.object_store = ObjectStore.open_optional(self.pmatic_base)
+        self.event_log = EventLog(
+            self.context_path, self.catalog, self.object_store,
+            **load_config(self.pmatic_base, EVENT_LOG_FILE_NAME)
+        )
+        self.step_cache = StepCache.open_optional(self.pmatic_base)
+        self.scheduler = (scheduler or
+                          LocalScheduler.from_config(self.pmatic_base))
         self.pipeline_loader = PipelineLoader(
-            pmatic_base, self.dependency_finder, self.event_log
+            pmatic_base, self.dependency_finder, self.event_log,
+            self.step_cache, self.scheduler, self.launcher
         )
 
-    def run(self, pipeline_name):
+    def run(self, pipeline_name, force=False, regenerate=False):
         """Main starting point. Will attempt to start or restart the
-        pipeline."""
+        pipeline. Unless force, skips it if it is up to date. If
+        regenerate, all generated parameter files are generated again.
+        The launcher is closed when the run ends, however it ends; a fork
+        server is started again if the engine runs another pipeline."""
+        try:
+            self.run_pipeline(pipeline_name, force, regenerate)
+        finally:
+            self.launcher.close()
+
+    def run_pipeline(self, pipeline_name, force, regenerate):
+        """The body of run."""
         self.debug('running %s in %s', pipeline_name, self.context_path)
         # TODO: Add command-line support for creating context directory.
         pipeline = self.pipeline_loader.load_pipeline(pipeline_name)
@@ -98,7 +139,11 @@ class PipelineEngine(object):
         if current_status not in ['never_run', 'finished']:
             fail('Cannot run, because pipeline %r has a status of %r',
                  (current_pipeline, current_status))
+        parameter_files = pipeline.get_parameter_files()
         dependencies = pipeline.get_dependencies()
+        dependencies.update(parameter_file.get_dependency()
+                            for parameter_file in parameter_files
+                            if parameter_file.generator)
         unlisted = set(dependency for dependency in dependencies
                   if not self.dependency_finder.check_listed(dependency))
         missing = set(dependency for dependency in (dependencies - unlisted)
@@ -110,9 +155,93 @@ class PipelineEngine(object):
             fail_dependencies(
                 self.dependency_finder, unlisted, missing, bad_type
             )
-        namespace = Namespace()
         os.chdir(self.context_path)
-        pipeline.run(namespace)
+        namespace = self.build_namespace()
+        self.load_parameter_files(parameter_files, namespace, regenerate)
+        missing = pipeline.get_parameters() - set(namespace)
+        if missing:
+            fail('Missing parameters for %s: %s',
+                 (pipeline_name, ', '.join(sorted(missing))))
+        pipeline.plan(DurationModel.from_events(self.event_log.event_data))
+        metrics = get_metrics()
+        result = 'failed'
+        try:
+            with metrics.timer('pmatic_run_seconds'):
+                if pipeline.run(namespace, force):
+                    result = 'finished'
+                else:
+                    result = 'up_to_date'
+                    self.debug('%s is up to date', pipeline_name)
+        finally:
+            self.event_log.flush()
+            metrics.increment('pmatic_runs_total', result=result)
+            metrics.flush()
+
+    def build_namespace(self):
+        """Return the bottom of the parameter stack: the defaults file in
+        the context directory, overridden by the command line."""
+        defaults_path = os.path.join(self.context_path, DEFAULTS_FILE_NAME)
+        defaults = {}
+        if os.path.isfile(defaults_path):
+            defaults = load_yaml_file(defaults_path) or {}
+        return Namespace(defaults, self.params)
+
+    def load_parameter_files(self, parameter_files, namespace,
+                             regenerate=False):
+        """Push each parameter file onto namespace, in order, generating
+        the missing ones first. Generators run in waves: each wave is the
+        longest run of parameter files whose needs are already in the
+        namespace, and its generators run concurrently. A generated file
+        is kept until the parameters given to its generator change, and
+        regenerated if no record says which parameters it was made from."""
+        records_path = os.path.join(meta_path(self.context_path),
+                                    PARAMETER_RECORDS_FILE_NAME)
+        records = {}  # file path -> digest of generator input
+        if os.path.isfile(records_path):
+            records = load_yaml_file(records_path) or {}
+        pending = list(parameter_files)
+        while pending:
+            available = set(namespace)
+            wave = []
+            for parameter_file in pending:
+                if not parameter_file.needs <= available:
+                    break
+                wave.append(parameter_file)
+            if not wave:
+                fail('Parameter file %s needs missing parameters: %s',
+                     (pending[0].file,
+                      ', '.join(sorted(pending[0].needs - available))))
+            del pending[:len(wave)]
+            wave_jobs = [parameter_file.bind(namespace)
+                         for parameter_file in wave]
+            jobs = []
+            for parameter_file, job in zip(wave, wave_jobs):
+                if not parameter_file.generator:
+                    if not os.path.isfile(job.path):
+                        fail('Missing parameter file %r', job.path)
+                elif (regenerate or not os.path.isfile(job.path) or
+                      records.get(job.path) != job.digest):
+                    jobs.append(job)
+            if jobs:
+                self.debug('generating %s',
+                           ', '.join(job.path for job in jobs))
+                self.run_parameter_generators(jobs)
+                records.update((job.path, job.digest) for job in jobs)
+                write_file_atomically(records_path, format_yaml(records))
+            for job in wave_jobs:
+                namespace.mapping.push(load_yaml_file(job.path) or {})
+
+    def run_parameter_generators(self, jobs):
+        """Run at most MAX_PARAMETER_GENERATORS generators at a time."""
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(len(jobs), MAX_PARAMETER_GENERATORS))
+        try:
+            pool.map(lambda job: generate_parameter_file(
+                job, self.dependency_finder
+            ), jobs)
+        finally:
+            pool.close()
+            pool.join()
 
     def debug(self, message='', *args):
         """Format and print to stderr if verbose."""
@@ -122,11 +251,43 @@ class PipelineEngine(object):
 
 class EventLog(object):
     """Manages recording a reading of pipeline events.
-    Uses a lockfile to achieve atomicity."""
+    Uses a lockfile to achieve atomicity.
+
+    durability (from $PMATIC_BASE/event_log.yaml) trades the latency of
+    recording an event against what survives a crash:
+    none    -- each event and head update is renamed into place, but not
+               synced, so a crash may lose the latest ones.
+    strict  -- each file and its directory is fsynced before the event is
+               recorded.
+    batched -- group commit: events are queued, and a flusher thread
+               writes all of those queued within max_latency seconds,
+               then one head update, with a single sync of each
+               directory. A crash loses at most that window."""
     # TODO: Start using lockfile.
-    def __init__(self, context_path):
+    def __init__(self, context_path, catalog=None, object_store=None,
+                 durability='none', max_latency=0.05):
+        """catalog is an optional Catalog to notify of every event.
+        object_store is an optional ObjectStore to keep snapshots in."""
+        import threading
         super(EventLog, self).__init__()
+        assert durability in DURABILITY_MODES, durability
+        self.lock = threading.RLock()  # for steps running in parallel
+        self.durability = durability
+        self.max_latency = max_latency
+        self.flush_lock = threading.Lock()  # writes batches in order
+        self.pending_lock = threading.Lock()  # never held while writing
+        self.pending_events = []
+        self.pending_head = None  # text of the head record to write
+        self.flush_requested = None  # a threading.Event, once batching
         self.context_path = context_path
+        self.catalog = catalog
+        self.object_store = object_store
+        self.strategies = [
+            HardLinkStrategy(context_path),
+            ObjectStoreStrategy(context_path, object_store),
+            ReflinkStrategy(context_path),
+        ]
+        self.snapshot_strategy = None  # chosen when the first is taken
         self.events_path = os.path.join(meta_path(context_path), 'events')
         self.db_path = os.path.join(self.events_path, 'db')
         self.new_path = os.path.join(self.events_path, 'new')
@@ -140,25 +301,174 @@ class EventLog(object):
         pipeline_name = self.get_current_pipeline_name()
         assert pipeline_name
         event = None
-        for index, event in enumerate(self.event_data):
-            if event.what == 'started':
+        for event in self.event_data:
+            if is_pipeline_start(event):
                 break
         assert isinstance(event, Event)
-        assert event.what == 'started'
+        assert event.what == 'started', 'cannot revert past a checkpoint'
         assert event.pipeline_name == pipeline_name
-        new_head_id = event.parent_event_id
-        restore_snapshot(event.snapshot, self.context_path)
-        self.record_pipeline_reverted(pipeline_name, new_head_id)
+        self.revert_event(event)
+
+    def revert_steps(self, steps=1):
+        """Undo the last steps pipeline starts in one pass."""
+        self.read_log()
+        starts = [event for event in self.event_data or ()
+                  if is_run_start(event)]
+        if steps < 1 or len(starts) < steps:
+            fail('Cannot revert %d runs in %s, which has %d',
+                 (steps, self.context_path, len(starts)))
+        self.revert_events(starts[:steps])
+
+    def revert_to(self, event_id):
+        """Make event_id, an earlier event between two runs, the head again,
+        undoing every pipeline start since then in one pass."""
+        self.read_log()
+        event_ids = [event.id for event in self.event_data or ()]
+        if event_id not in event_ids:
+            fail('Event %r is not in the log of %s',
+                 (event_id, self.context_path))
+        index = event_ids.index(event_id)
+        if index == 0:
+            return
+        if not is_run_start(self.event_data[index - 1]):
+            fail('Cannot revert to %r, which is in the middle of a run',
+                 (event_id,))
+        self.revert_events([event for event in self.event_data[:index]
+                            if is_run_start(event)])
+
+    def revert_event(self, started_event):
+        """Restore the snapshot taken by started_event, and move head back
+        to its parent, which orphans it and every later event."""
+        self.revert_events([started_event])
+
+    def revert_events(self, started_events):
+        """Like revert_event for the oldest of started_events (newest
+        first), but whatever later snapshots cover that it does not is
+        restored too. The net difference from the current tree is applied
+        with one scan, whatever the number of events."""
+        target = started_events[-1]
+        with self.lock:
+            self.restore_events(started_events)
+            self.record_pipeline_reverted(target.pipeline_name,
+                                          target.parent_event_id)
+            self.read_log()
+
+    def restore_events(self, started_events):
+        """Restore the files as revert_events does, but leave head alone,
+        so that the events since stay in the log."""
+        snapshot, backups, scopes = merge_snapshots(
+            reversed(started_events), self.strategies
+        )
+        for strategy, reference in backups.itervalues():
+            if not strategy.is_available():
+                fail('Cannot revert %s, because its %s snapshots are '
+                     'unavailable', (self.context_path, strategy.name))
+        with self.lock:
+            restore_snapshot(snapshot, self.context_path, scopes, backups)
+
+    def compact(self, keep_cycles=1):
+        """Fold every event older than the last keep_cycles pipeline starts
+        into a single checkpoint event, which becomes the new root of the
+        log. Pipelines can still be reverted keep_cycles times. Return the
+        number of events removed.
+
+        The checkpoint re-uses the id of the newest folded event, so the
+        chain is rewritten by one rename into db. Events no longer reachable
+        from head, like those undone by a revert, are removed too, from the
+        catalog as well. Snapshot backups that no retained event refers to
+        are deleted afterwards."""
         self.read_log()
+        status = self.get_status()
+        if status not in ['never_run', 'finished', 'failed']:
+            fail('Cannot compact, because pipeline %r has a status of %r',
+                 (self.get_current_pipeline_name(), status))
+        starts = [index for index, event in enumerate(self.event_data or ())
+                  if is_pipeline_start(event)]
+        if keep_cycles:
+            folded = []
+            if len(starts) >= keep_cycles:
+                folded = self.event_data[starts[keep_cycles - 1] + 1:]
+        else:
+            folded = self.event_data or []
+        removed_ids = []
+        if folded and not (len(folded) == 1 and
+                           hasattr(folded[0], 'checkpoint')):
+            self.fold_events(folded)
+            removed_ids.extend(event.id for event in folded[1:])
+        removed_ids.extend(self.remove_unreachable_events())
+        if self.catalog:
+            self.catalog.forget_events(removed_ids)
+        self.prune_snapshots()
+        return len(removed_ids)
+
+    def fold_events(self, folded):
+        """Replace folded, the oldest events of the log (newest first), by
+        a checkpoint."""
+        newest, oldest = folded[0], folded[-1]
+        summary = getattr(oldest, 'checkpoint', dict(since=oldest.when))
+        summary = dict(summary, events=summary.get('events', 1))
+        for event in folded[:-1]:
+            summary['events'] += getattr(event, 'checkpoint',
+                                         dict(events=1))['events']
+        checkpoint = Event(newest.pipeline_name, newest.what, None,
+                           id=newest.id, when=newest.when,
+                           checkpoint=summary)
+        self.save_event(checkpoint)  # atomically replaces newest
+        self.flush()
+        for event in folded[1:]:
+            os.remove(os.path.join(self.db_path, event.id + '.yaml'))
+        self.read_log()
+
+    def remove_unreachable_events(self):
+        """Delete the events in db that are not on the chain from head.
+        Assumes the log has been read. Return the ids of those deleted."""
+        reachable = set(event.id + '.yaml' for event in self.event_data or ())
+        removed_ids = []
+        for name in os.listdir(self.db_path):
+            if name.endswith('.yaml') and name not in reachable:
+                os.remove(os.path.join(self.db_path, name))
+                removed_ids.append(name[:-len('.yaml')])
+        return removed_ids
 
-    def record_pipeline_started(self, pipeline, **kwds):
+    def prune_snapshots(self):
+        """Delete backups not referenced by any snapshot in the log.
+        Assumes the log has been read."""
+        for strategy in self.strategies:
+            strategy.prune(self.event_data or (), self.strategies)
+
+    def choose_snapshot_strategy(self):
+        """Clone files where the filesystem of the context supports it,
+        so that they can stay writable. Otherwise hard link them into the
+        ObjectStore, if there is one, or into the context."""
+        if self.snapshot_strategy is None:
+            for strategy in reversed(self.strategies):
+                if strategy.is_supported():
+                    self.snapshot_strategy = strategy
+                    break
+        return self.snapshot_strategy
+
+    def record_pipeline_started(self, pipeline, take_snapshot=True,
+                                snapshot_paths=None, **kwds):
         """Records start of a pipeline. Raises exception if another pipeline
-        is already running or the last entry in the EventLog was an error."""
+        is already running or the last entry in the EventLog was an error.
+        Steps that cannot be reverted separately need no snapshot. If
+        snapshot_paths is not None, the snapshot covers only those paths.
+        A scope narrower than the whole context is recorded with the
+        snapshot, so that reverting leaves everything outside it alone."""
         self.ensure_log_exists()
         # TODO: Check for previous state.
-        before_snapshot = create_snapshot(self.context_path)
-        self.post_event(pipeline, 'started',
-                        snapshot=before_snapshot, **kwds)
+        with self.lock:
+            if take_snapshot:
+                scope = SnapshotScope.load(self.context_path, snapshot_paths)
+                strategy = self.choose_snapshot_strategy()
+                kwds['snapshot'], references = create_snapshot(
+                    self.context_path, scope, strategy
+                )
+                if scope.to_data():
+                    kwds['snapshot_scope'] = scope.to_data()
+                if references:
+                    kwds[strategy.field] = references
+            self.post_event(pipeline, 'started', **kwds)
 
     def record_pipeline_finished(self, pipeline, **kwds):
         """Records completion of a pipeline. Raises exception unless the
@@ -186,24 +496,38 @@ class EventLog(object):
 
     def get_status(self):
         """Return terse execution status. Possible values:
-        never_run, started, finished, error."""
+        never_run, started, finished, error.
+        Answers from the head record when the log has not been read, so
+        that no event (and no YAML) needs to be parsed."""
         if not self.log_exists:
             return 'never_run'
+        if self.event_data is None:
+            head = self.read_head()
+            if head is None:
+                return 'never_run'
+            if head.what:
+                return head.what
         if not self.event_data:
             self.read_log()
         if not self.event_data:
             return 'never_run'
-        return self.event_data[0].what
+        return find_status_event(self.event_data).what
 
     def get_current_pipeline_name(self):
         """Return name of currently executing pipeline or None."""
         if not self.log_exists:
             return None
+        if self.event_data is None:
+            head = self.read_head()
+            if head is None:
+                return None
+            if head.pipeline_name:
+                return head.pipeline_name
         if not self.event_data:
             self.read_log()
         if not self.event_data:
             return None
-        return self.event_data[0].pipeline_name
+        return find_status_event(self.event_data).pipeline_name
 
     def ensure_log_exists(self):
         """Create empty log inside self.meta_path if it is missing."""
@@ -213,18 +537,32 @@ class EventLog(object):
 
     def read_log(self):
         """Read or re-read log from disk"""
+        self.flush()
         self.event_data = None
         if not self.log_exists:
             return
-        if not os.path.isfile(self.head_path):
-            return
-        event_data = []
-        event_id = load_yaml_file(self.head_path)  # Read log head.
-        while event_id:
-            event = self.read_event(event_id)
-            event_data.append(event)
-            event_id = event.parent_event_id
-        self.event_data = event_data
+        with get_metrics().timer('pmatic_event_log_read_seconds'):
+            head = self.read_head()
+            if head is None:
+                return
+            event_data = []
+            event_id = head.id
+            while event_id:
+                event = self.read_event(event_id)
+                event_data.append(event)
+                event_id = event.parent_event_id
+            self.event_data = event_data
+
+    def find_event(self, pipeline_name, what):
+        """Return the most recent event of pipeline_name of the given kind
+        that is still in the log, or None."""
+        with self.lock:
+            if self.event_data is None:
+                self.read_log()
+            for event in self.event_data or ():
+                if event.pipeline_name == pipeline_name and event.what == what:
+                    return event
+        return None
 
     def read_event(self, event_id):
         """Return specified event data"""
@@ -235,27 +573,117 @@ class EventLog(object):
 
     def post_event(self, pipeline, what, **kwds):
         """Store the specified event, and update head."""
-        if self.event_data:
-            parent_event_id = self.event_data[0].id
-        else:
-            parent_event_id = None
-            self.event_data = []
-        event = Event(pipeline.pipeline_name, what, parent_event_id, **kwds)
-        self.event_data.insert(0, event)
-        self.save_event(event)
-        self.save_new_head(event.id)
+        with self.lock:
+            if self.event_data:
+                parent_event_id = self.event_data[0].id
+            else:
+                parent_event_id = None
+                self.event_data = []
+            event = Event(pipeline.pipeline_name, what, parent_event_id,
+                          **kwds)
+            self.event_data.insert(0, event)
+            metrics = get_metrics()
+            metrics.increment('pmatic_events_total', what=what)
+            if what == 'failed':
+                metrics.increment('pmatic_step_failures_total',
+                                  exit_code=kwds.get('exit_code', 'none'))
+            self.save_event(event)
+            if self.catalog:
+                self.catalog.record_event(self.context_path, event)
+            self.save_new_head(event.id)
 
     def save_event(self, event):
-        event_file_name = event.id + '.yaml'
-        new_event_path = os.path.join(self.new_path, event_file_name)
-        final_event_path = os.path.join(self.db_path, event_file_name)
-        save_yaml_file(new_event_path, event.__dict__)
-        os.rename(new_event_path, final_event_path)
+        with self.pending_lock:
+            self.pending_events.append(event)
+        self.commit()
 
     def save_new_head(self, event_id):
-        new_head_path = os.path.join(self.new_path, 'head')
-        save_yaml_file(new_head_path, event_id)
-        os.rename(new_head_path, self.head_path)
+        """Point head at event_id, which must be None or the id of an event
+        in self.event_data. The head file is a single tab-separated line
+        holding HEAD_FIELDS, so that readers need not parse any YAML. Its
+        what and pipeline_name describe the top-level pipeline (the status),
+        not the step that posted the event."""
+        head_event = status_event = None
+        for index, event in enumerate(self.event_data or ()):
+            if event.id == event_id:
+                head_event = event
+                status_event = find_status_event(self.event_data[index:])
+                break
+        assert event_id is None or head_event, 'unknown event %r' % event_id
+        with self.pending_lock:
+            self.pending_head = format_head_record(head_event, status_event)
+        self.commit()
+        if self.catalog:
+            self.catalog.record_head(self.context_path, head_event,
+                                     status_event)
+
+    def commit(self):
+        """Write what is pending now, unless durability is batched."""
+        if self.durability == 'batched':
+            self.schedule_flush()
+        else:
+            self.flush()
+
+    def schedule_flush(self):
+        """Have the flusher thread, started on first use, flush within
+        max_latency seconds."""
+        import atexit
+        import threading
+        with self.pending_lock:
+            if self.flush_requested is None:
+                self.flush_requested = threading.Event()
+                start_thread(self.run_flusher)
+                atexit.register(self.flush)
+            self.flush_requested.set()
+
+    def run_flusher(self):
+        import time
+        while True:
+            self.flush_requested.wait()
+            time.sleep(self.max_latency)  # gathering the batch
+            self.flush_requested.clear()
+            self.flush()
+
+    def flush(self):
+        """Write the pending events into db, then the pending head, so
+        that head never names an event that is not on disk. Unless
+        durability is none, every file is fsynced before it is renamed
+        into place, and each directory once after. Returns only once any
+        flush already under way is on disk, too."""
+        with self.flush_lock:
+            with self.pending_lock:
+                events, self.pending_events = self.pending_events, []
+                head, self.pending_head = self.pending_head, None
+            if events or head is not None:
+                with get_metrics().timer('pmatic_event_log_flush_seconds'):
+                    self.write_batch(events, head,
+                                     sync=self.durability != 'none')
+
+    def write_batch(self, events, head, sync):
+        for event in events:
+            event_file_name = event.id + '.yaml'
+            write_and_rename(os.path.join(self.new_path, event_file_name),
+                             os.path.join(self.db_path, event_file_name),
+                             format_yaml(event.__dict__), sync)
+        if events and sync:
+            sync_directory(self.db_path)
+        if head is not None:
+            write_and_rename(os.path.join(self.new_path, 'head'),
+                             self.head_path, head, sync)
+            if sync:
+                sync_directory(self.events_path)
+
+    def read_head(self):
+        """Return a Namespace holding HEAD_FIELDS, or None if the log is
+        empty. Fields other than id are None for heads written by older
+        versions (a bare YAML string)."""
+        self.flush()
+        try:
+            with open(self.head_path) as fin:
+                line = fin.readline().rstrip('\n')
+        except IOError:
+            return None
+        return parse_head_record(line)
 
     @property
     def log_exists(self):
@@ -266,6 +694,7 @@ class EventLog(object):
 class Event(object):
     """A single event in the event log"""
     def __init__(self, pipeline_name, what, parent_event_id, **kwds):
+        from datetime import datetime
         assert what in EVENT_TYPES
         super(Event, self).__init__()
         self.file_type = 'event-1'
@@ -291,6 +720,516 @@ class Event(object):
         )
 
 
+class Catalog(object):
+    """Optional SQLite index of the events of every context, kept in
+    $PMATIC_BASE/catalog.sqlite. It exists to answer queries across many
+    contexts quickly. The event logs inside each context remain the source
+    of truth, and reindex() can rebuild the catalog from them at any time.
+    Errors while updating the catalog are reported but never stop a
+    pipeline."""
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS events (
+            id TEXT PRIMARY KEY, context_path TEXT, pipeline_name TEXT,
+            what TEXT, time TEXT, exit_code INTEGER)""",
+        """CREATE INDEX IF NOT EXISTS events_by_pipeline
+            ON events (pipeline_name, what, time)""",
+        """CREATE INDEX IF NOT EXISTS events_by_context
+            ON events (context_path, time)""",
+        """CREATE INDEX IF NOT EXISTS events_by_time ON events (time)""",
+        """CREATE TABLE IF NOT EXISTS contexts (
+            context_path TEXT PRIMARY KEY, head_id TEXT, pipeline_name TEXT,
+            status TEXT, time TEXT)""",
+        """CREATE INDEX IF NOT EXISTS contexts_by_pipeline
+            ON contexts (pipeline_name, status, time)""",
+    ]
+    EVENT_COLUMNS = 'context_path pipeline_name what time exit_code'.split()
+
+    def __init__(self, catalog_path):
+        """Open (creating if necessary) the catalog at catalog_path."""
+        import sqlite3
+        super(Catalog, self).__init__()
+        self.catalog_path = catalog_path
+        self.error_class = sqlite3.Error
+        # Autocommit mode; multi-statement updates use explicit BEGIN.
+        # Events of parallel steps arrive on several threads, one at a time.
+        self.connection = sqlite3.connect(catalog_path, timeout=60,
+                                          isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.SCHEMA:
+            self.connection.execute(statement)
+
+    @classmethod
+    def open_optional(cls, pmatic_base):
+        """Return a Catalog if pmatic_base has one, otherwise None."""
+        if not pmatic_base:
+            return None
+        path = catalog_file_path(pmatic_base)
+        if not os.path.isfile(path):
+            return None
+        return cls(path)
+
+    def record_event(self, context_path, event):
+        """Add one row for event."""
+        self.guarded_execute(
+            'INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?)',
+            catalog_event_row(abspath(context_path), event)
+        )
+
+    def record_head(self, context_path, head_event, status_event=None):
+        """Record the current status of a context, given its head event and
+        the top-level event that determines the status."""
+        self.guarded_execute(
+            'INSERT OR REPLACE INTO contexts VALUES (?, ?, ?, ?, ?)',
+            catalog_head_row(abspath(context_path), head_event, status_event)
+        )
+
+    def forget_events(self, event_ids):
+        """Delete the rows of events removed from their event logs."""
+        self.guarded_execute('DELETE FROM events WHERE id = ?',
+                             [(event_id,) for event_id in event_ids], True)
+
+    def guarded_execute(self, statement, parameters, many=False):
+        try:
+            if many:
+                self.connection.executemany(statement, parameters)
+            else:
+                self.connection.execute(statement, parameters)
+        except self.error_class, e:
+            print_err('warning: %s not updated: %s', (self.catalog_path, e))
+
+    def find_events(self, context_path=None, pipeline_name=None, what=None,
+                    since=None, until=None, limit=None):
+        """Return rows of EVENT_COLUMNS matching all the given filters,
+        newest first. since and until are ISO 8601 prefixes."""
+        where, parameters = self.build_filters(
+            context_path, pipeline_name, what, since, until, 'what'
+        )
+        statement = 'SELECT %s FROM events%s ORDER BY time DESC' % (
+            ', '.join(self.EVENT_COLUMNS), where
+        )
+        return self.fetch(statement, parameters, limit)
+
+    def find_contexts(self, context_path=None, pipeline_name=None,
+                      status=None, since=None, until=None, limit=None):
+        """Return rows of (context_path, pipeline_name, status, time) for
+        contexts whose current state matches all the given filters."""
+        where, parameters = self.build_filters(
+            context_path, pipeline_name, status, since, until, 'status'
+        )
+        statement = ('SELECT context_path, pipeline_name, status, time'
+                     ' FROM contexts%s ORDER BY time DESC' % where)
+        return self.fetch(statement, parameters, limit)
+
+    def build_filters(self, context_path, pipeline_name, what, since, until,
+                      what_column):
+        clauses = []
+        parameters = []
+        for column, operator, value in [
+            ('context_path', '=', context_path and abspath(context_path)),
+            ('pipeline_name', '=', pipeline_name),
+            (what_column, '=', what),
+            ('time', '>=', since),
+            ('time', '<', until),
+        ]:
+            if value:
+                clauses.append('%s %s ?' % (column, operator))
+                parameters.append(value)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return where, parameters
+
+    def fetch(self, statement, parameters, limit):
+        if limit:
+            statement += ' LIMIT %d' % limit
+        return self.connection.execute(statement, parameters).fetchall()
+
+    def reindex(self, root_paths, processes=None):
+        """Rebuild the rows of every context found below root_paths from
+        its event directory. Event files are parsed by a pool of processes.
+        Return the number of contexts indexed."""
+        import multiprocessing
+        context_paths = find_context_paths(root_paths)
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.imap_unordered(read_catalog_rows, context_paths,
+                                          chunksize=16)
+            count = 0
+            for context_path, event_rows, head_row in results:
+                self.replace_context(context_path, event_rows, head_row)
+                count += 1
+        finally:
+            pool.terminate()
+        return count
+
+    def replace_context(self, context_path, event_rows, head_row):
+        execute = self.connection.execute
+        execute('BEGIN')
+        try:
+            execute('DELETE FROM events WHERE context_path = ?',
+                    (context_path,))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?)',
+                event_rows
+            )
+            execute('INSERT OR REPLACE INTO contexts VALUES (?, ?, ?, ?, ?)',
+                    head_row)
+        except:
+            execute('ROLLBACK')
+            raise
+        execute('COMMIT')
+
+
+def catalog_event_row(context_path, event):
+    return (event.id, context_path, event.pipeline_name, event.what,
+            event.when.isoformat(), getattr(event, 'exit_code', None))
+
+
+def catalog_head_row(context_path, head_event, status_event=None):
+    if head_event is None:
+        return context_path, None, None, 'never_run', None
+    status_event = status_event or head_event
+    return (context_path, head_event.id, status_event.pipeline_name,
+            status_event.what, status_event.when.isoformat())
+
+
+def read_catalog_rows(context_path):
+    """Return (context_path, event_rows, head_row) for one context, reading
+    every stored event, including those no longer reachable from head.
+    Runs inside Catalog.reindex worker processes."""
+    event_log = EventLog(context_path)
+    event_rows = []
+    events = {}
+    for file_name in os.listdir(event_log.db_path):
+        if file_name.endswith('.yaml'):
+            event = event_log.read_event(file_name[:-len('.yaml')])
+            events[event.id] = event
+            event_rows.append(catalog_event_row(context_path, event))
+    head = event_log.read_head()
+    chain = []
+    event_id = head and head.id
+    while event_id in events:
+        chain.append(events[event_id])
+        event_id = chain[-1].parent_event_id
+    head_event = chain[0] if chain else None
+    head_row = catalog_head_row(context_path, head_event,
+                                find_status_event(chain))
+    return context_path, event_rows, head_row
+
+
+def find_context_paths(root_paths):
+    """Return sorted absolute paths of all context directories (those with an
+    event log) at or below root_paths."""
+    result = []
+    for root_path in root_paths:
+        for dir_path, dir_names, file_names in os.walk(abspath(root_path)):
+            if EventLog(dir_path).log_exists:
+                result.append(dir_path)
+            dir_names[:] = [name for name in dir_names
+                            if name not in (META_DIR_NAME, TRASH_DIR_NAME)]
+    return sorted(result)
+
+
+def walk_context_paths(root_paths, threads=16):
+    """Yield the absolute paths of all contexts at or below root_paths, in
+    no particular order, as threads list the directories in parallel.
+    Symlinks to directories are not followed."""
+    import Queue
+    import threading
+    directories = Queue.Queue()
+    found = Queue.Queue(maxsize=1024)
+    lock = threading.Lock()
+    pending = [0]  # directories queued or being listed
+    skipped = (META_DIR_NAME, TRASH_DIR_NAME)
+
+    def list_directories():
+        for dir_path in iter(directories.get, None):
+            subdirs = []
+            try:
+                names = os.listdir(dir_path)
+                if META_DIR_NAME in names and EventLog(dir_path).log_exists:
+                    found.put(dir_path)
+                for name in names:
+                    path = os.path.join(dir_path, name)
+                    if (name not in skipped and os.path.isdir(path) and
+                            not os.path.islink(path)):
+                        subdirs.append(path)
+            except OSError:
+                pass  # unreadable, or gone
+            finally:
+                with lock:
+                    pending[0] += len(subdirs) - 1
+                    done = not pending[0]
+                for path in subdirs:
+                    directories.put(path)
+                if done:
+                    found.put(None)
+    root_paths = [abspath(path) for path in root_paths]
+    if not root_paths:
+        return
+    pending[0] = len(root_paths)
+    for path in root_paths:
+        directories.put(path)
+    workers = [start_thread(list_directories) for i in xrange(threads)]
+    try:
+        for context_path in iter(found.get, None):
+            yield context_path
+    finally:
+        for worker in workers:
+            directories.put(None)
+
+
+def map_unordered(function, items, threads=16, backlog=1024):
+    """Yield function(item) for each of items, in the order they finish,
+    computed by threads. At most backlog items are read ahead of the
+    results consumed, so that items and results can be streams."""
+    import Queue
+    inputs = Queue.Queue(maxsize=backlog)
+    results = Queue.Queue(maxsize=backlog)
+    done = object()
+
+    def feed():
+        try:
+            for item in items:
+                inputs.put(item)
+        finally:
+            for i in xrange(threads):
+                inputs.put(done)
+
+    def work():
+        try:
+            for item in iter(inputs.get, done):
+                results.put((function(item), None))
+        except Exception, e:
+            results.put((None, e))
+        finally:
+            results.put((done, None))
+    start_thread(feed)
+    for i in xrange(threads):
+        start_thread(work)
+    running = threads
+    while running:
+        result, exception = results.get()
+        if exception:
+            raise exception
+        if result is done:
+            running -= 1
+        else:
+            yield result
+
+
+def summarize_context(context_path):
+    """Return a dict describing the context for bulk status reports: its
+    status and pipeline from the head record, the time of the last event
+    (when head was written, UTC), and for a failed pipeline, why. A log
+    that cannot be read has the status unreadable."""
+    import time
+    event_log = EventLog(context_path)
+    summary = dict(context=context_path, status='never_run', pipeline=None,
+                   last_event=None, failure=None)
+    try:
+        head = event_log.read_head() if event_log.log_exists else None
+        if head is None:
+            return summary
+        mtime = os.path.getmtime(event_log.head_path)
+        summary['last_event'] = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                              time.gmtime(mtime))
+        summary['status'] = head.what or event_log.get_status()
+        summary['pipeline'] = (head.pipeline_name or
+                               event_log.get_current_pipeline_name())
+        if summary['status'] == 'failed':
+            event = event_log.read_event(head.id)
+            while getattr(event, 'depth', 0) and event.parent_event_id:
+                event = event_log.read_event(event.parent_event_id)
+            summary['failure'] = describe_failure(event)
+    except Exception, e:
+        summary.update(status='unreadable', failure=str(e))
+    return summary
+
+
+def describe_failure(event):
+    """Return why a failed event failed, as a short phrase."""
+    if hasattr(event, 'exception'):
+        return event.exception
+    exit_code = getattr(event, 'exit_code', None)
+    reason = getattr(event, 'reason', None)
+    if reason:
+        return '%s (exit code %s)' % (reason, exit_code)
+    if exit_code is not None:
+        return 'exit code %s' % exit_code
+    return None
+
+
+def watch_status(context_paths, poll_interval=1.0, timeout=None,
+                 use_inotify=None):
+    """Generate (context_path, status) pairs: first the current status of
+    every context, then each status change as it happens. Ends after
+    timeout seconds pass without any activity (never, if timeout is None).
+
+    Uses inotify on Linux, so waiting costs nothing; elsewhere (or if
+    use_inotify is False) the head files are polled every poll_interval
+    seconds, which costs one stat() per context."""
+    event_logs = [EventLog(context_path) for context_path in context_paths]
+    watcher = None
+    if use_inotify is not False:
+        try:
+            watcher = InotifyWatcher(event_logs)
+        except (OSError, AttributeError):
+            if use_inotify:
+                raise
+    if watcher is None:
+        watcher = PollingWatcher(event_logs, poll_interval)
+    try:
+        statuses = {}
+        for event_log in event_logs:
+            status = statuses[event_log] = event_log.get_status()
+            yield event_log.context_path, status
+        while True:
+            changed = watcher.wait(timeout)
+            if not changed:
+                return
+            for event_log in changed:
+                event_log.event_data = None  # Answer from the head record.
+                status = event_log.get_status()
+                if status != statuses[event_log]:
+                    statuses[event_log] = status
+                    yield event_log.context_path, status
+    finally:
+        watcher.close()
+
+
+class InotifyWatcher(object):
+    """Waits for the head of any of several event logs to be replaced, using
+    Linux inotify through ctypes. Until a context has an events directory,
+    the nearest existing ancestor (.pmatic or the context itself) is watched
+    instead. Raises OSError or AttributeError where inotify is missing."""
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_ONLYDIR = 0x01000000
+    IN_CLOEXEC = 0x00080000
+    HEADER_FORMAT = 'iIII'  # wd, mask, cookie, len
+
+    def __init__(self, event_logs):
+        import ctypes
+        super(InotifyWatcher, self).__init__()
+        self.ctypes = ctypes
+        self.libc = load_libc()
+        self.fd = self.check(self.libc.inotify_init1(self.IN_CLOEXEC))
+        self.watches = {}  # watch descriptor -> set of event logs
+        self.watched_paths = {}  # event log -> watched directory
+        try:
+            for event_log in event_logs:
+                self.add_watch(event_log)
+        except:
+            self.close()
+            raise
+
+    def check(self, result):
+        if result < 0:
+            errno = self.ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return result
+
+    def add_watch(self, event_log):
+        """Watch the deepest existing directory on the way to head."""
+        for path in (event_log.events_path,
+                     meta_path(event_log.context_path),
+                     event_log.context_path):
+            if os.path.isdir(path):
+                break
+        if self.watched_paths.get(event_log) == path:
+            return
+        wd = self.check(self.libc.inotify_add_watch(
+            self.fd, path, self.IN_CREATE | self.IN_MOVED_TO | self.IN_ONLYDIR
+        ))
+        for event_logs in self.watches.itervalues():
+            event_logs.discard(event_log)
+        self.watches.setdefault(wd, set()).add(event_log)
+        self.watched_paths[event_log] = path
+
+    def wait(self, timeout=None):
+        """Block until a head may have changed. Return the affected event
+        logs, or an empty list on timeout."""
+        import time
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return []
+            changed = self.read_events(remaining)
+            if changed:
+                return changed
+
+    def read_events(self, timeout):
+        """Return the event logs affected by the next batch of inotify
+        events, which may be none."""
+        import select
+        import struct
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if not readable:
+            return []
+        buffer = os.read(self.fd, 65536)
+        header_size = struct.calcsize(self.HEADER_FORMAT)
+        changed = set()
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = struct.unpack_from(
+                self.HEADER_FORMAT, buffer, offset
+            )
+            offset += header_size
+            name = buffer[offset:offset + length].rstrip('\0')
+            offset += length
+            for event_log in list(self.watches.get(wd, ())):
+                if self.watched_paths[event_log] != event_log.events_path:
+                    self.add_watch(event_log)  # Something was created.
+                    changed.add(event_log)
+                elif name == 'head':
+                    changed.add(event_log)
+        return list(changed)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Portable fallback for InotifyWatcher: notices a replaced head by
+    comparing the result of stat() every poll_interval seconds."""
+    def __init__(self, event_logs, poll_interval):
+        super(PollingWatcher, self).__init__()
+        self.event_logs = event_logs
+        self.poll_interval = poll_interval
+        self.signatures = dict((event_log, self.signature(event_log))
+                               for event_log in event_logs)
+
+    def signature(self, event_log):
+        try:
+            st = os.stat(event_log.head_path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime, st.st_size
+
+    def wait(self, timeout=None):
+        """Block until a head may have changed. Return the affected event
+        logs, or an empty list on timeout."""
+        import time
+        waited = 0.0
+        while timeout is None or waited < timeout:
+            changed = []
+            for event_log in self.event_logs:
+                signature = self.signature(event_log)
+                if signature != self.signatures[event_log]:
+                    self.signatures[event_log] = signature
+                    changed.append(event_log)
+            if changed:
+                return changed
+            time.sleep(self.poll_interval)
+            waited += self.poll_interval
+        return []
+
+    def close(self):
+        pass
+
+
 class DependencyFinder(object):
     """Keeps track of where the dependencies are located on disk."""
     def __init__(self, pmatic_base):
@@ -310,14 +1249,14 @@ class DependencyFinder(object):
         """Verify that dependency is listed in deployments file."""
         name, version, dependency_type = dependency
         result = (name, version) in self.dependency_paths
-        return result
+        return self.count(result, 'listed')
 
     def check_exists(self, dependency):
         """Verify that dependency exists.
         Assumes dependency is listed in the deployments file."""
         path = self.path(dependency)
         result = os.path.exists(path)
-        return result
+        return self.count(result, 'exists')
 
     def check_type(self, dependency):
         """Verify that dependency has correct type.
@@ -330,6 +1269,13 @@ class DependencyFinder(object):
             'link': os.path.islink,
         }[dependency_type]
         result = test(path)
+        return self.count(result, 'type')
+
+    def count(self, result, check):
+        """Return result, counting it in the metrics if it is a failure."""
+        if not result:
+            get_metrics().increment('pmatic_dependency_failures_total',
+                                    check=check)
         return result
 
     def path(self, dependency):
@@ -351,14 +1297,22 @@ class DependencyFinder(object):
 class PipelineLoader(object):
     """Maintains a registry of Pipeline classes and constructs pipelines from
     files."""
-    def __init__(self, pmatic_base, dependency_finder, event_log):
+    def __init__(self, pmatic_base, dependency_finder, event_log,
+                 step_cache=None, scheduler=None, launcher=None):
         super(PipelineLoader, self).__init__()
         self.pmatic_base = pmatic_base
         self.dependency_finder = dependency_finder
         self.event_log = event_log
+        self.step_cache = step_cache
+        self.scheduler = scheduler
+        self.launcher = launcher
+        self.loading = []  # names of pipeline files being loaded
 
-    def load_pipeline(self, pipeline_name):
-        """Return pipeline object."""
+    def load_pipeline(self, pipeline_name, step_name=None, depth=0):
+        """Return pipeline object. A pipeline loaded as a step of another
+        one is named step_name in the event log."""
+        if pipeline_name in self.loading:
+            fail('Pipeline %r contains itself', pipeline_name)
         data = load_yaml_file(pipeline_path(self.pmatic_base, pipeline_name))
         try:
             meta_map = data[0]
@@ -366,26 +1320,65 @@ class PipelineLoader(object):
             meta_map = data
         file_type = meta_map['file_type']
         pipeline_class_name, version = file_type.rsplit('-', 1)
-        # TODO: Select class based on pipeline_class_name
-        klass = SingleTaskPipeline
-        pipeline = klass(self.dependency_finder, self.event_log,
-                         pipeline_name, version, data)
-        return pipeline
+        self.loading.append(pipeline_name)
+        try:
+            return self.build_pipeline(pipeline_class_name,
+                                       step_name or pipeline_name,
+                                       version, data, depth)
+        finally:
+            self.loading.pop()
+
+    def build_pipeline(self, pipeline_class_name, pipeline_name, version,
+                       data, depth=0):
+        """Return pipeline object constructed from already loaded data."""
+        if pipeline_class_name == 'builtin-command':
+            klass = BUILTIN_COMMANDS.get(data.get('command'))
+        else:
+            klass = PIPELINE_CLASSES.get(pipeline_class_name)
+        if not klass:
+            fail('Unknown type of pipeline %r: %r',
+                 (pipeline_name, data.get('command', pipeline_class_name)))
+        return klass(self.dependency_finder, self.event_log, pipeline_name,
+                     version, data, step_cache=self.step_cache,
+                     pipeline_loader=self, depth=depth,
+                     scheduler=self.scheduler, launcher=self.launcher)
 
 
 class AbstractPipeline(object):
     """Abstract base class for all pipeline classes.
     Uses Template Method Pattern."""
     __metaclass__ = abc.ABCMeta
+    parameterized_fields = []  # attributes that may contain ${param}
 
     def __init__(self, dependency_finder, event_log,
-                 pipeline_name, version, data):
+                 pipeline_name, version, data, step_cache=None,
+                 pipeline_loader=None, depth=0, scheduler=None,
+                 launcher=None):
+        """depth is 0 for the pipeline being run, 1 for its steps, etc.
+        scheduler is an optional LocalScheduler, which admits each step
+        that launches processes only when its cpus and memory fit.
+        launcher is the Launcher that starts those processes."""
         super(AbstractPipeline, self).__init__()
         self.dependency_finder = dependency_finder
         self.event_log = event_log
+        self.step_cache = step_cache
+        self.pipeline_loader = pipeline_loader
+        self.depth = depth
+        self.scheduler = scheduler
+        self.launcher = launcher or PopenLauncher()
+        self.take_snapshot = True
+        self.snapshot_mode = 'all'  # or 'outputs'
+        self.namespace = None  # bound by run
+        self.retry_policy = None  # a RetryPolicy
+        self.attempt = 1
+        self.critical_path = 0.0  # seconds from this start to the end
         self.pipeline_name = pipeline_name
         self.version = version
-        self.load(data)
+        self.step_params = {}  # pushed onto the parameter stack by parent
+        self.parameter_files = []
+        self.load(compile_templates(data))
+        self.templates = dict((name, getattr(self, name))
+                              for name in self.parameterized_fields)
 
     @abc.abstractmethod
     def load(self, data):
@@ -398,27 +1391,204 @@ class AbstractPipeline(object):
         (dependency, version, dependency_type) triplets."""
         raise NotImplementedError
 
-    def run(self, namespace):
-        """Main entry point for a pipeline object."""
-        self.implement_run(namespace)
+    def run(self, namespace, force=False):
+        """Main entry point for a pipeline object. Unless force is True,
+        skip execution if the fingerprint recorded the last time this
+        pipeline finished still matches. Return True if the pipeline was
+        executed. (Composite pipelines must force every step that follows
+        an executed one.)"""
+        self.bind_parameters(namespace)
+        self.namespace = namespace
+        self.file_hasher = FileHasher()
+        self.forced = force
+        if not force and self.is_up_to_date():
+            self.record_pipeline_finished(up_to_date=True)
+            return False
+        self.attempt = 1
+        while True:
+            try:
+                self.implement_run(namespace)
+                return True
+            except ExitCodeError, e:
+                policy = self.retry_policy
+                if not policy or not policy.should_retry(e, self.attempt):
+                    raise
+            self.revert_attempt()
+            policy.sleep(self.attempt)
+            self.attempt += 1
+
+    def revert_attempt(self):
+        """Undo the filesystem effects of a failed attempt before the next
+        one. Its events stay in the log, so that the next attempt follows
+        them and durations count every attempt. Steps without their own
+        snapshot (like those of parallel pipelines) are retried in place."""
+        started_event = self.event_log.find_event(self.pipeline_name,
+                                                  'started')
+        if started_event and hasattr(started_event, 'snapshot'):
+            self.event_log.restore_events([started_event])
 
     @abc.abstractmethod
     def implement_run(self, namespace):
         """Implementation hook."""
         raise NotImplementedError
 
+    def get_parameters(self):
+        """Return the names of all parameters needed by this pipeline and
+        its steps, which it does not define itself."""
+        return template_names(self.templates.values())
+
+    def get_parameter_files(self):
+        """Return the ParameterFile objects of this pipeline and its steps,
+        in the order that they stack."""
+        return list(self.parameter_files)
+
+    def bind_parameters(self, namespace):
+        """Substitute the values in namespace into parameterized fields."""
+        for name, value in self.templates.iteritems():
+            setattr(self, name, expand_templates(value, namespace))
+
+    def get_input_paths(self):
+        """Return the files read by this pipeline, for fingerprinting."""
+        return []
+
+    def get_output_paths(self):
+        """Return the files written by this pipeline. Pipelines with no
+        declared outputs are never considered up to date."""
+        return []
+
+    def get_fingerprint_arguments(self):
+        """Return whatever else, besides dependencies and files, determines
+        the outputs."""
+        return []
+
+    def make_fingerprint(self, file_hasher):
+        """Return a dict describing everything that determines the outputs
+        of this pipeline, or None if some declared file is missing."""
+        output_paths = self.get_output_paths()
+        if not output_paths:
+            return None
+        files = {}
+        for path in self.get_input_paths() + output_paths:
+            if not os.path.isfile(path):
+                return None
+            files[path] = file_hasher.record(path)
+        dependency_paths = [self.dependency_finder.path(dependency)
+                            for dependency in sorted(self.get_dependencies())]
+        return dict(dependencies=dependency_paths,
+                    arguments=self.get_fingerprint_arguments(), files=files)
+
+    def is_up_to_date(self):
+        """Return True if the fingerprint recorded the last time this
+        pipeline finished matches the current state of its files."""
+        event = self.event_log.find_event(self.pipeline_name, 'finished')
+        previous = getattr(event, 'fingerprint', None)
+        if not previous:
+            return False
+        self.file_hasher.update(previous['files'])
+        current = self.make_fingerprint(self.file_hasher)
+        return bool(current) and (
+            strip_file_stats(current) == strip_file_stats(previous)
+        )
+
     def record_pipeline_started(self, **kwds):
-        self.event_log.record_pipeline_started(self, **kwds)
+        kwds.update(self.duration_fields())
+        snapshot_paths = None
+        if self.take_snapshot and self.snapshot_mode == 'outputs':
+            snapshot_paths = self.get_snapshot_paths(self.namespace)
+        self.event_log.record_pipeline_started(
+            self, take_snapshot=self.take_snapshot,
+            snapshot_paths=snapshot_paths, **self.event_fields(kwds)
+        )
+
+    def get_snapshot_paths(self, namespace):
+        """Return the paths this pipeline may change, which are all that a
+        snapshot in outputs mode covers. namespace binds those of steps."""
+        return self.get_output_paths()
+
+    def set_snapshot_mode(self, mode):
+        """mode is 'all' to snapshot the whole context before running, or
+        'outputs' to snapshot only what get_snapshot_paths returns."""
+        mode = mode or 'all'
+        assert mode in SNAPSHOT_MODES, (
+            '%s: snapshot must be one of %s, not %r' %
+            (self.pipeline_name, SNAPSHOT_MODES, mode)
+        )
+        self.snapshot_mode = mode
+
+    def disable_snapshots(self):
+        """Called for steps that cannot be reverted one by one."""
+        self.take_snapshot = False
+
+    def reserve(self, cpus, memory):
+        """Return a context manager that holds cpus and memory from the
+        scheduler, if any, while the body runs. Steps on longer critical
+        paths are admitted first."""
+        if self.scheduler:
+            return self.scheduler.reserve(cpus, memory, self.critical_path)
+        return no_reservation()
+
+    def get_resources(self):
+        """Return the (cpus, memory) that this pipeline may hold from the
+        scheduler at once."""
+        return 0, 0
+
+    def duration_fields(self):
+        """Return what identifies this pipeline to the DurationModel,
+        besides its name. Recorded in started events."""
+        fields = dict(version=self.version)
+        executable = getattr(self, 'executable', None)
+        if executable:
+            fields['executable'] = executable
+        return fields
+
+    def estimate_remaining(self, model, progress=None, now=None):
+        """Return the seconds that model predicts until this pipeline
+        finishes. progress maps the names of the pipelines of the current
+        execution to their latest events, and now is when it is asked;
+        without them, nothing has started."""
+        event = (progress or {}).get(self.pipeline_name)
+        if event and event.what == 'finished':
+            return 0.0
+        estimate = model.estimate(self.pipeline_name,
+                                  self.duration_fields())
+        if event and event.what == 'started':
+            elapsed = (now - event.when).total_seconds()
+            return max(0.0, estimate - elapsed)
+        return estimate
+
+    def plan(self, model, remaining_after=0.0):
+        """Set critical_path, the seconds that model predicts from the
+        start of this pipeline to the end of the execution, given the
+        remaining_after it."""
+        self.critical_path = self.estimate_remaining(model) + remaining_after
 
     def record_pipeline_failed(self, **kwds):
-        self.event_log.record_pipeline_failed(self, **kwds)
+        self.event_log.record_pipeline_failed(self, **self.event_fields(kwds))
 
     def record_pipeline_finished(self, **kwds):
-        self.event_log.record_pipeline_finished(self, **kwds)
+        """Also records the fingerprint used by is_up_to_date."""
+        fingerprint = self.make_fingerprint(self.file_hasher)
+        if fingerprint:
+            kwds['fingerprint'] = fingerprint
+        self.event_log.record_pipeline_finished(self,
+                                                **self.event_fields(kwds))
+
+    def event_fields(self, kwds):
+        """Mark the events of steps, which do not determine the status, and
+        of retries."""
+        if self.depth:
+            kwds['depth'] = self.depth
+        if self.attempt > 1:
+            kwds['attempt'] = self.attempt
+        return kwds
 
 
 class SingleTaskPipeline(AbstractPipeline):
     """Pipelines that wrap just one executable."""
+    parameterized_fields = [
+        'arguments', 'stdin', 'stdout', 'stderr', 'inputs', 'outputs',
+    ]
+
     def load(self, data):
         """Requirement of AbstractPipeline"""
         assert self.version == '1', (
@@ -429,10 +1599,23 @@ class SingleTaskPipeline(AbstractPipeline):
         self.stdin = None
         self.stdout = None
         self.stderr = None
+        self.inputs = []  # files read, besides stdin
+        self.outputs = []  # files written, besides stdout and stderr
+        self.cache = False  # True to memoize results in the StepCache
+        self.cpus = 1  # for admission by the LocalScheduler
+        self.memory = None  # bytes or a size like 4G; enforced by setrlimit
+        self.timeout = None  # seconds before the Watchdog kills the step
+        self.stall_timeout = None  # seconds without output or CPU progress
         # TODO: Ensure that stdout and stderr are always directed somewhere.
+        self.parameter_files = load_parameter_files(
+            data.pop('parameter-files', None)
+        )
+        self.retry_policy = RetryPolicy.from_data(data.pop('retry', None))
+        self.set_snapshot_mode(data.pop('snapshot', None))
         self.__dict__.update(data)
         if not self.stdin:
             self.stdin = '/dev/null'
+        self.memory = parse_size(self.memory)
         assert self.executable
         assert self.version
 
@@ -440,28 +1623,78 @@ class SingleTaskPipeline(AbstractPipeline):
         """Requirement of AbstractPipeline"""
         return set([(self.executable, self.version, 'executable')])
 
-    def implement_run(self, namespace):
-        """Requirement of AbstractPipeline"""
+    def get_input_paths(self):
+        """Return all files the executable reads, including stdin."""
+        return [path for path in [self.stdin] + self.inputs
+                if path != os.devnull]
+
+    def get_output_paths(self):
+        """Return all files the executable writes, including redirects."""
+        return [path for path in [self.stdout, self.stderr] + self.outputs
+                if path]
+
+    def get_fingerprint_arguments(self):
+        return list(self.arguments)
+
+    def get_command_line(self):
+        """Return the arguments for launching the executable."""
         executable_path = self.dependency_finder.path(
             self.get_dependencies().pop()
         )
-        args = [executable_path]
-        args.extend(self.arguments)
+        return [executable_path] + list(self.arguments)
+
+    def get_resources(self):
+        return self.cpus, self.memory or 0
+
+    def implement_run(self, namespace):
+        """Requirement of AbstractPipeline"""
+        args = self.get_command_line()
+        executable_path = args[0]
         self.record_pipeline_started()
+        cache_key = None
         try:
+            if self.cache and self.step_cache:
+                input_digests = [(path, self.file_hasher.record(path)[0])
+                                 for path in [self.stdin] + self.inputs]
+                cache_key = self.step_cache.make_key(
+                    executable_path, self.version, self.arguments,
+                    input_digests, self.get_output_paths()
+                )
+                if self.step_cache.fetch(cache_key, self.get_output_paths()):
+                    self.record_pipeline_finished(cache_hit=True)
+                    return
             cfin = conditional_file(self.stdin)
             cfout = conditional_file(self.stdout, 'w')
             cferr = conditional_file(self.stderr, 'w')
+            reservation = self.reserve(self.cpus, self.memory)
+            watched = bool(self.timeout or self.stall_timeout)
             with cfin as stdin, cfout as stdout, cferr as stderr:
-                proc = subprocess.Popen(
-                    args, stdin=stdin, stdout=stdout, stderr=stderr
-                )
-                exit_code = proc.wait()
+                with reservation:
+                    process = self.launcher.launch(
+                        args, stdin, stdout, stderr,
+                        ChildLimits(self.memory, new_process_group=watched),
+                        close_fds=True
+                    )
+                    if watched:
+                        watchdog = Watchdog(
+                            process, self.timeout, self.stall_timeout,
+                            [self.stdout, self.stderr]
+                        )
+                        exit_code, rusage, reason = watchdog.wait()
+                    else:
+                        exit_code, reason = process.wait(), None
         except Exception, e:
             self.record_pipeline_failed(exception=str(e))
             raise
         else:
-            if exit_code == 0:
+            if reason:
+                self.record_pipeline_failed(exit_code=exit_code,
+                                            reason=reason, rusage=rusage)
+                raise WatchdogError(exit_code, '%s of %r' %
+                                    (reason, executable_path), reason)
+            elif exit_code == 0:
+                if cache_key:
+                    self.step_cache.store(cache_key, self.get_output_paths())
                 self.record_pipeline_finished()
             else:
                 self.record_pipeline_failed(exit_code=exit_code)
@@ -469,139 +1702,2698 @@ class SingleTaskPipeline(AbstractPipeline):
                                     'exit code from %r' % executable_path)
 
 
-class ExitCodeError(EnvironmentError):
-    """Signals that an external program returned a nonzero exit code."""
-    pass
-
-
-def restore_snapshot(snapshot_dict, context_path):
-    """Restore the working directory to the state described in snapshot_dict
-    using the contents of ./.pmatic/inode_snapshots to recover moved or
-    deleted files."""
-    assert isinstance(snapshot_dict, dict)
-    current_scan = scan_directory(context_path)
-    # Delete anything new.
-    trash_can = TrashCan(context_path)
-    items_to_check = list(sorted(current_scan.items()))
-    for key, record in items_to_check:
-        matching_record = snapshot_dict.get(key)  # None if not found
-        if strip_permissions(record) != strip_permissions(matching_record):
-            path = os.path.join(context_path, key)
-            if os.path.lexists(path):
-                trash_can.trash(key)
-    # Restore anything old.
-    for key, record in sorted(snapshot_dict.items()):
-        format, mode, size, inode, symlink = record
-        path = os.path.join(context_path, key)
-        if not os.path.exists(path):
-            if format == 'DIR':
-                os.mkdir(path)
-            elif format == 'LNK':
-                os.symlink(symlink, path)
+class SequentialPipeline(AbstractPipeline):
+    """An ordered collection of pipelines of any concrete type. Each step
+    records its own events, named after this pipeline and its position.
+    Steps that are up to date are skipped, until one of them executes."""
+    def load(self, data):
+        """Requirement of AbstractPipeline"""
+        assert self.version == '1', (
+            'SequentialPipeline currently only version 1'
+        )
+        self.executable_versions = {}
+        self.pipeline_versions = {}
+        self.steps = []
+        for item in data[1:]:
+            if 'executable-versions' in item:
+                self.executable_versions.update(
+                    version_map(item, 'executable-versions')
+                )
+            elif 'pipeline-versions' in item:
+                self.pipeline_versions.update(
+                    version_map(item, 'pipeline-versions')
+                )
+            elif 'parameter-files' in item:
+                self.parameter_files.extend(
+                    load_parameter_files(item['parameter-files'])
+                )
+            elif item.keys() == ['snapshot']:
+                self.set_snapshot_mode(item['snapshot'])
             else:
-                target = os.path.join(meta_path(context_path),
-                                      'inode_snapshots',
-                                      str(inode))
-                os.link(target, path)
-        lchmod(path, mode)
-
+                self.steps.append(self.build_step(len(self.steps) + 1, item))
 
-def strip_permissions(record):
-    if record == None:
-        result = None
-    else:
-        format, mode, size, inode, symlink = record
-        result = format, size, inode, symlink
-    return result
+    def build_step(self, index, item):
+        """Return the pipeline for one step of the sequence. The params of
+        the item are pushed onto the parameter stack for that step."""
+        item = dict(item)
+        step_params = item.pop('params', None) or {}
+        retry = item.pop('retry', None)
+        snapshot_mode = item.pop('snapshot', None)
+        sandbox = item.pop('sandbox', None)
+        step = self.build_step_pipeline(index, item)
+        if sandbox is not None:
+            if 'pipeline' not in item:
+                fail('%s: only pipeline steps can have a sandbox, not %r',
+                     (self.pipeline_name, item))
+            name = item['pipeline']
+            step = self.pipeline_loader.build_pipeline(
+                'sandbox', step.pipeline_name, '1',
+                dict(sandbox or {}, step=step, pipeline='%s-%s' % (
+                    name, self.pipeline_versions[name]
+                )), step.depth
+            )
+        step.step_params = step_params
+        if retry:
+            step.retry_policy = RetryPolicy.from_data(retry)
+        if snapshot_mode:
+            step.set_snapshot_mode(snapshot_mode)
+        return step
 
+    def build_step_pipeline(self, index, item):
+        loader = self.pipeline_loader
+        depth = self.depth + 1
+        if 'command' in item:
+            step_name = self.step_name(index, item['command'])
+            return loader.build_pipeline('builtin-command', step_name, '1',
+                                         item, depth)
+        elif 'executable' in item:
+            executable = item['executable']
+            if executable not in self.executable_versions:
+                fail('%s lists no version of executable %r',
+                     (self.pipeline_name, executable))
+            data = dict(item, version=self.executable_versions[executable])
+            return loader.build_pipeline('single-task',
+                                         self.step_name(index, executable),
+                                         '1', data, depth)
+        elif 'pipe' in item or 'parallel' in item:
+            class_name = 'pipe' if 'pipe' in item else 'parallel'
+            data = [dict(file_type=class_name + '-1'),
+                    {'executable-versions': self.executable_versions},
+                    {'pipeline-versions': self.pipeline_versions}]
+            return loader.build_pipeline(
+                class_name, self.step_name(index, class_name), '1',
+                data + item[class_name], depth
+            )
+        elif 'pipeline' in item:
+            name = item['pipeline']
+            if name not in self.pipeline_versions:
+                fail('%s lists no version of pipeline %r',
+                     (self.pipeline_name, name))
+            return loader.load_pipeline(
+                '%s-%s' % (name, self.pipeline_versions[name]),
+                self.step_name(index, name), depth
+            )
+        fail('Cannot understand step %d of %s: %r',
+             (index, self.pipeline_name, item))
 
-def create_snapshot(context_path):
-    """Prepare to restore the state of the working directory later: Make hard
-    link "backups" of all but symlinks and directories. Make all regular files
-    read-only. Return the dict returned by scan_directory."""
-    result = scan_directory(context_path)
-    inode_dir = os.path.join(meta_path(context_path), 'inode_snapshots')
-    ensure_directory_exists(inode_dir, os.makedirs)
-    for key, record in result.iteritems():
-        path = os.path.join(context_path, key)
-        assert os.path.exists(path)
-        format, mode, size, inode, symlink = record
-        if format not in ('DIR', 'LNK'):
-            inode_file = os.path.join(inode_dir, str(inode))
-            if os.path.exists(inode_file):
-                if not os.path.samefile(path, inode_file):
-                    os.remove(inode_file)
-            if not os.path.exists(inode_file):
-                os.link(path, inode_file)
-        if format == 'REG':
-            new_mode = mode & 07555  # TODO: may not be portable
-            lchmod(path, new_mode)
-    return result
+    def step_name(self, index, label):
+        return '%s/%d-%s' % (self.pipeline_name, index, label)
 
+    def get_dependencies(self):
+        """Requirement of AbstractPipeline"""
+        dependencies = set()
+        for step in self.steps:
+            dependencies.update(step.get_dependencies())
+        return dependencies
 
-def scan_directory(start_path, *exclude_paths):
-    """Return dict path:(format, mode, size, inode, symlink).
-    exclude_paths (default '.pmatic') will not be scanned."""
-    if not exclude_paths:
-        exclude_paths = (META_DIR_NAME, TRASH_DIR_NAME)
-    result = {}
-    for dir_path, dir_names, file_names in os.walk(start_path):
-        remove_dir_names = []
-        for dir_name in dir_names:
-            key, format, mode, size, inode, symlink = stat_item(
-                dir_name, dir_path, start_path
-            )
-            if key in exclude_paths:
-                remove_dir_names.append(dir_name)
-                continue
-            result[key] = format, mode, size, inode, None
-        for dir_name in remove_dir_names:
-            dir_names.remove(dir_name)
-        for file_name in file_names:
-            key, format, mode, size, inode, symlink = stat_item(
-                file_name, dir_path, start_path
-            )
-            result[key] = format, mode, size, inode, symlink
-    return result
+    def disable_snapshots(self):
+        super(SequentialPipeline, self).disable_snapshots()
+        for step in self.steps:
+            step.disable_snapshots()
 
+    def get_parameter_files(self):
+        parameter_files = list(self.parameter_files)
+        for step in self.steps:
+            parameter_files.extend(step.get_parameter_files())
+        return parameter_files
 
-def stat_item(file_name, dir_path, base_path):
-    path = os.path.join(dir_path, file_name)
-    st = os.lstat(path)
-    format_code = stat.S_IFMT(st.st_mode)
-    format = decode_format(format_code)
-    mode = stat.S_IMODE(st.st_mode)
-    size = st.st_size if format in ('REG', 'LNK') else 0L
-    inode = st.st_ino if format not in ('DIR', 'LNK') else 0L
-    symlink = os.readlink(path) if format == 'LNK' else None
-    key = os.path.relpath(path, base_path)
-    return key, format, mode, size, inode, symlink
+    def get_parameters(self):
+        """Checks the whole tree, so that missing parameters are found
+        before any step runs."""
+        names = super(SequentialPipeline, self).get_parameters()
+        for step in self.steps:
+            names.update(step.get_parameters() - set(step.step_params))
+            names.update(template_names(step.step_params.values()))
+        return names
 
+    def push_step_params(self, step, namespace):
+        namespace.mapping.push(expand_templates(step.step_params, namespace))
 
-def decode_format(format_code):
-    format = None
-    for test_fcn, name in STAT_TESTS:
-        if test_fcn(format_code):
-            assert format is None, 'A file can only have one type.'
-            format = name
-    assert format, 'A filesystem object must have some type'
-    return format
+    def get_resources(self):
+        """The steps run one after the other."""
+        return combine_resources(self.steps, max)
 
+    def estimate_remaining(self, model, progress=None, now=None):
+        """The steps run one after the other."""
+        event = (progress or {}).get(self.pipeline_name)
+        if event and event.what == 'finished':
+            return 0.0
+        return sum(step.estimate_remaining(model, progress, now)
+                   for step in self.steps)
 
-def lchmod(path, mode):
-    """If path is not a symlink, do a regular chmod. If path is a symlink
-    and os.lchmod is available, do os.lchmod. If path is a symlink and
-    os.lchmod is not available, do nothing."""
-    if os.path.islink(path):
-        if hasattr(os, 'lchmod'):
-            os.lchmod(path, mode)
-    else:
-        os.chmod(path, mode)
+    def plan(self, model, remaining_after=0.0):
+        super(SequentialPipeline, self).plan(model, remaining_after)
+        for step in reversed(self.steps):
+            step.plan(model, remaining_after)
+            remaining_after += step.estimate_remaining(model)
 
+    def get_snapshot_paths(self, namespace):
+        """Binds the parameters of each step early, to find its paths."""
+        paths = []
+        for step in self.steps:
+            self.push_step_params(step, namespace)
+            try:
+                step.bind_parameters(namespace)
+                paths.extend(step.get_snapshot_paths(namespace))
+            finally:
+                namespace.mapping.pop()
+        return paths
 
-class TrashCan(object):
-    """A place to move files, prior to deleting them."""
-    def __init__(self, context_path):
+    def implement_run(self, namespace):
+        """Requirement of AbstractPipeline"""
+        self.record_pipeline_started()
+        force = self.forced
+        try:
+            for step in self.steps:
+                self.push_step_params(step, namespace)
+                try:
+                    force = step.run(namespace, force) or force
+                finally:
+                    namespace.mapping.pop()
+        except Exception, e:
+            self.record_pipeline_failed(exception=str(e))
+            raise
+        self.record_pipeline_finished()
+
+
+class PipePipeline(SequentialPipeline):
+    """Steps (stages) that run concurrently, each one's stdout connected to
+    the next one's stdin through an OS pipe, so that intermediate data
+    never touches the disk. A stage with a tee key also copies its output
+    into that file. Only the first stage may redirect stdin and only the
+    last may redirect stdout. Stages are executables, or built-in commands
+    that can stream (like md5), which run in threads of the engine."""
+    parameterized_fields = ['tees']
+
+    def load(self, data):
+        """Requirement of AbstractPipeline"""
+        self.tees = []
+        super(PipePipeline, self).load(data)
+        assert self.steps, 'pipe %s has no stages' % self.pipeline_name
+        for index, stage in enumerate(self.steps):
+            assert (isinstance(stage, SingleTaskPipeline) or
+                    hasattr(stage, 'stream')), (
+                'stage %s cannot stream' % stage.pipeline_name
+            )
+            if index > 0:
+                assert stage.stdin in (None, os.devnull), (
+                    'only the first stage may redirect stdin: %s' %
+                    stage.pipeline_name
+                )
+            if index < len(self.steps) - 1:
+                assert stage.stdout is None, (
+                    'only the last stage may redirect stdout: %s' %
+                    stage.pipeline_name
+                )
+
+    def build_step(self, index, item):
+        """Set tees aside, and default the stream parameters of built-in
+        commands, which the pipes supply."""
+        item = dict(item)
+        self.tees.append(item.pop('tee', None))
+        if 'command' in item:
+            item.setdefault('stdin', None)
+            item.setdefault('stdout', None)
+        return super(PipePipeline, self).build_step(index, item)
+
+    def get_input_paths(self):
+        return [path for stage in self.steps
+                for path in stage.get_input_paths() if path]
+
+    def get_output_paths(self):
+        return [path for stage in self.steps
+                for path in stage.get_output_paths() if path] + [
+            path for path in self.tees if path
+        ]
+
+    def get_fingerprint_arguments(self):
+        return [stage.get_fingerprint_arguments() for stage in self.steps]
+
+    def get_snapshot_paths(self, namespace):
+        return super(PipePipeline, self).get_snapshot_paths(namespace) + [
+            path for path in self.tees if path
+        ]
+
+    def get_resources(self):
+        """The stages run at the same time."""
+        return combine_resources(self.steps, sum)
+
+    def estimate_remaining(self, model, progress=None, now=None):
+        """The stages overlap, so the pipe as a whole is what to time."""
+        return AbstractPipeline.estimate_remaining(self, model, progress, now)
+
+    def plan(self, model, remaining_after=0.0):
+        """The pipe reserves resources for all of its stages at once."""
+        AbstractPipeline.plan(self, model, remaining_after)
+
+    def implement_run(self, namespace):
+        """Requirement of AbstractPipeline. Records the exit status of each
+        stage as its own event."""
+        self.record_pipeline_started()
+        for stage in self.steps:
+            self.push_step_params(stage, namespace)
+            try:
+                stage.bind_parameters(namespace)
+            finally:
+                namespace.mapping.pop()
+            self.event_log.record_pipeline_started(
+                stage, take_snapshot=False, **stage.event_fields({})
+            )
+        try:
+            results = self.run_stages()
+        except Exception, e:
+            self.record_pipeline_failed(exception=str(e))
+            raise
+        first_failure = None
+        for stage, (exit_code, exception) in zip(self.steps, results):
+            if exception:
+                kwds = dict(exception=exception)
+            elif exit_code:
+                kwds = dict(exit_code=exit_code)
+            else:
+                self.event_log.record_pipeline_finished(
+                    stage, **stage.event_fields({})
+                )
+                continue
+            self.event_log.record_pipeline_failed(stage,
+                                                  **stage.event_fields(kwds))
+            first_failure = first_failure or (stage, kwds)
+        if first_failure:
+            stage, kwds = first_failure
+            self.record_pipeline_failed(**kwds)
+            raise ExitCodeError(kwds.get('exit_code', 1),
+                                'failed stage %r' % stage.pipeline_name)
+        self.record_pipeline_finished()
+
+    def run_stages(self):
+        """Start every stage at once and wait for all of them. Return a
+        list of (exit_code, exception) pairs."""
+        processes = [stage for stage in self.steps
+                     if isinstance(stage, SingleTaskPipeline)]
+        with self.reserve(sum(stage.cpus for stage in processes),
+                          sum(stage.memory or 0 for stage in processes)):
+            return self.run_stages_reserved()
+
+    def run_stages_reserved(self):
+        last = len(self.steps) - 1
+        results = [(0, None)] * len(self.steps)
+        processes = []
+        threads = []
+        in_fd = os.open(self.steps[0].stdin or os.devnull, os.O_RDONLY)
+        next_in_fd = None
+        try:
+            for index, stage in enumerate(self.steps):
+                if index < last:
+                    next_in_fd, out_fd = close_on_exec_pipe()
+                    if self.tees[index]:
+                        tee_in_fd = next_in_fd
+                        next_in_fd, tee_out_fd = close_on_exec_pipe()
+                        threads.append(start_thread(
+                            self.guard, results, index, tee_stream,
+                            tee_in_fd, tee_out_fd, self.tees[index]
+                        ))
+                elif stage.stdout:
+                    out_fd = os.open(stage.stdout,
+                                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                     0666)
+                else:
+                    out_fd = os.dup(sys.stdout.fileno())
+                if isinstance(stage, SingleTaskPipeline):
+                    try:
+                        with conditional_file(stage.stderr, 'w') as stderr:
+                            processes.append((index, stage.launcher.launch(
+                                stage.get_command_line(), in_fd, out_fd,
+                                stderr, ChildLimits(stage.memory,
+                                                    restore_sigpipe=True),
+                                close_fds=True
+                            )))
+                    finally:
+                        os.close(in_fd)
+                        os.close(out_fd)
+                        in_fd = None
+                else:
+                    threads.append(start_thread(
+                        self.guard, results, index, stream_fds, stage,
+                        in_fd, out_fd
+                    ))
+                in_fd, next_in_fd = next_in_fd, None
+        except:
+            for fd in (in_fd, next_in_fd):  # Upstream sees a broken pipe.
+                if fd is not None:
+                    os.close(fd)
+            raise
+        finally:
+            for index, process in processes:
+                results[index] = (process.wait(), results[index][1])
+            for thread in threads:
+                thread.join()
+        return results
+
+    def guard(self, results, index, function, *args):
+        """Call function(*args) in a thread, recording any exception as
+        the failure of stage index."""
+        try:
+            function(*args)
+        except Exception, e:
+            results[index] = (results[index][0], str(e))
+
+
+class ParallelPipeline(SequentialPipeline):
+    """Steps that run at the same time, each one as soon as the scheduler
+    admits it. A loop item, like {parameter: sample, values: [a, b]},
+    repeats the step that follows it once for each value, which is passed
+    in the named parameter. The steps share one snapshot, taken when the
+    parallel pipeline starts."""
+    def load(self, data):
+        """Requirement of AbstractPipeline"""
+        items = []
+        loop = None
+        for item in data[1:]:
+            if 'loop' in item:
+                loop = item['loop']
+            elif loop:
+                for value in loop['values']:
+                    params = dict(item.get('params') or {})
+                    params[loop['parameter']] = value
+                    items.append(dict(item, params=params))
+                loop = None
+            else:
+                items.append(item)
+        super(ParallelPipeline, self).load(data[:1] + items)
+        for step in self.steps:
+            step.disable_snapshots()
+
+    def get_resources(self):
+        """The steps may all run at the same time."""
+        return combine_resources(self.steps, sum)
+
+    def estimate_remaining(self, model, progress=None, now=None):
+        """The steps run at the same time."""
+        event = (progress or {}).get(self.pipeline_name)
+        if event and event.what == 'finished':
+            return 0.0
+        return max([step.estimate_remaining(model, progress, now)
+                    for step in self.steps] or [0.0])
+
+    def plan(self, model, remaining_after=0.0):
+        AbstractPipeline.plan(self, model, remaining_after)
+        for step in self.steps:
+            step.plan(model, remaining_after)
+
+    def implement_run(self, namespace):
+        """Requirement of AbstractPipeline. After a step fails, no more
+        steps are started, and the first failure is raised once the
+        running ones finish."""
+        from multiprocessing.pool import ThreadPool
+        self.record_pipeline_started()
+        failures = []
+
+        def run_step(step):
+            if failures:
+                return
+            step_namespace = Namespace(
+                dict(namespace), expand_templates(step.step_params, namespace)
+            )
+            try:
+                step.run(step_namespace, self.forced)
+            except Exception, e:
+                failures.append(e)
+        pool = ThreadPool(min(len(self.steps), MAX_PARALLEL_STEPS) or 1)
+        steps = sorted(self.steps, key=lambda step: -step.critical_path)
+        try:
+            pool.map(run_step, steps, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        if failures:
+            self.record_pipeline_failed(exception=str(failures[0]))
+            raise failures[0]
+        self.record_pipeline_finished()
+
+
+class SandboxPipeline(AbstractPipeline):
+    """Runs a pipeline step, like {pipeline: greet, sandbox: {inputs: [a],
+    outputs: [b]}}, in a directory of its own under .pmatic/sandboxes
+    rather than in the context, so that many can run at once. The sandbox
+    is a farm of hard links (or symlinks, with link: symlink) to the
+    inputs, built in parallel; hard links become symlinks across
+    filesystems. A separate engine process runs the pipeline there, with
+    its own event log, and the parameters of the step as its defaults.
+    When it finishes, the outputs are renamed into the context, once all
+    of them exist. A failed sandbox is kept for inspection.
+
+    Inputs are shared, not copied, so the pipeline must not change them
+    in place."""
+    parameterized_fields = ['inputs', 'outputs']
+
+    def load(self, data):
+        """Requirement of AbstractPipeline"""
+        assert self.version == '1', (
+            'SandboxPipeline currently only version 1'
+        )
+        data = dict(data)
+        self.inner = data.pop('step')  # for dependencies and parameters
+        self.pipeline_file = data.pop('pipeline')
+        self.link = data.pop('link', 'hard')
+        assert self.link in ('hard', 'symlink'), (
+            '%s: sandbox link must be hard or symlink, not %r' %
+            (self.pipeline_name, self.link)
+        )
+        self.inputs = data.pop('inputs', None) or []
+        self.outputs = data.pop('outputs', None) or []
+        self.set_snapshot_mode(data.pop('snapshot', None))
+        assert not data, 'unknown sandbox fields %s' % sorted(data)
+
+    def get_dependencies(self):
+        """Requirement of AbstractPipeline"""
+        return self.inner.get_dependencies()
+
+    def get_parameters(self):
+        names = super(SandboxPipeline, self).get_parameters()
+        return names | self.inner.get_parameters()
+
+    def get_parameter_files(self):
+        return self.inner.get_parameter_files()
+
+    def get_input_paths(self):
+        return list(self.inputs)
+
+    def get_output_paths(self):
+        return list(self.outputs)
+
+    def get_fingerprint_arguments(self):
+        return ['sandbox', self.pipeline_file]
+
+    def get_resources(self):
+        return self.inner.get_resources()
+
+    def implement_run(self, namespace):
+        """Requirement of AbstractPipeline"""
+        import shutil
+        self.record_pipeline_started()
+        context_path = self.event_log.context_path
+        sandbox_path = os.path.join(meta_path(context_path),
+                                    SANDBOXES_DIR_NAME, gen_uuid_str())
+        fields = dict(sandbox=os.path.relpath(sandbox_path, context_path))
+        try:
+            self.materialize(context_path, sandbox_path)
+            save_yaml_file(os.path.join(sandbox_path, DEFAULTS_FILE_NAME),
+                           dict(namespace))
+            cpus, memory = self.get_resources()
+            if self.scheduler:  # A parallel inner pipeline may ask more.
+                cpus = min(cpus, self.scheduler.cpus)
+                memory = min(memory, self.scheduler.memory)
+            with self.reserve(cpus, memory):
+                process = self.launcher.launch(sandbox_command(
+                    self.pipeline_loader.pmatic_base, sandbox_path,
+                    self.pipeline_file, cpus, memory, self.forced
+                ))
+                exit_code = process.wait()
+            if exit_code:
+                raise ExitCodeError(exit_code, 'exit code from sandbox %r' %
+                                    fields['sandbox'])
+            self.merge_outputs(context_path, sandbox_path)
+        except ExitCodeError, e:
+            self.record_pipeline_failed(exit_code=e.errno, **fields)
+            raise
+        except Exception, e:
+            self.record_pipeline_failed(exception=str(e), **fields)
+            raise
+        shutil.rmtree(sandbox_path)
+        self.record_pipeline_finished()
+
+    def materialize(self, context_path, sandbox_path):
+        """Create the sandbox, with a link to every file of the inputs."""
+        import errno
+        from multiprocessing.pool import ThreadPool
+        keys = []
+        for path in self.inputs:
+            key = context_key(context_path, path)
+            source = os.path.join(context_path, key)
+            if os.path.isdir(source) and not os.path.islink(source):
+                for dir_path, dir_names, file_names in os.walk(source):
+                    dir_key = os.path.relpath(dir_path, context_path)
+                    ensure_directory_exists(
+                        os.path.join(sandbox_path, dir_key), os.makedirs
+                    )
+                    keys.extend(os.path.join(dir_key, name)
+                                for name in file_names)
+                    keys.extend(os.path.join(dir_key, name)
+                                for name in dir_names  # not followed
+                                if os.path.islink(os.path.join(dir_path,
+                                                               name)))
+            elif os.path.lexists(source):
+                ensure_directory_exists(
+                    os.path.dirname(os.path.join(sandbox_path, key)),
+                    os.makedirs
+                )
+                keys.append(key)
+            else:
+                raise EnvironmentError(errno.ENOENT,
+                                       'missing sandbox input %r' % path)
+        ensure_directory_exists(sandbox_path, os.makedirs)
+        pool = ThreadPool(min(len(keys), MAX_LINK_THREADS) or 1)
+        try:
+            pool.map(lambda key: link_into_sandbox(
+                context_path, sandbox_path, key, self.link
+            ), keys)
+        finally:
+            pool.close()
+            pool.join()
+
+    def merge_outputs(self, context_path, sandbox_path):
+        """Rename each output into the context, replacing what is there.
+        Nothing is moved unless every output exists, and if a rename fails,
+        those done already are undone, so the context gets all of the
+        outputs or none. What they replace is set aside in the sandbox,
+        which is deleted once it has been merged."""
+        import errno
+        keys = [context_key(context_path, path) for path in self.outputs]
+        missing = [key for key in keys
+                   if not os.path.lexists(os.path.join(sandbox_path, key))]
+        if missing:
+            raise EnvironmentError(errno.ENOENT, 'sandbox wrote no %s' %
+                                   ', '.join(missing))
+        replaced_path = os.path.join(meta_path(sandbox_path), 'replaced')
+        renames = []  # (source, dest, backup or None), in order
+        try:
+            for key in keys:
+                source_path = os.path.join(sandbox_path, key)
+                dest_path = os.path.join(context_path, key)
+                ensure_directory_exists(os.path.dirname(dest_path) or '.',
+                                        os.makedirs)
+                backup_path = None
+                if os.path.lexists(dest_path):  # even a directory
+                    backup_path = os.path.join(replaced_path, key)
+                    ensure_directory_exists(os.path.dirname(backup_path),
+                                            os.makedirs)
+                    os.rename(dest_path, backup_path)
+                renames.append((source_path, dest_path, backup_path))
+                os.rename(source_path, dest_path)
+        except:
+            for source_path, dest_path, backup_path in reversed(renames):
+                if not os.path.lexists(source_path):
+                    os.rename(dest_path, source_path)
+                if backup_path:
+                    os.rename(backup_path, dest_path)
+            raise
+
+
+def context_key(context_path, path):
+    """Return path relative to context_path. Raises EnvironmentError if it
+    is outside."""
+    import errno
+    key = os.path.relpath(os.path.join(context_path, path), context_path)
+    if key == os.pardir or key.startswith(os.pardir + os.sep):
+        raise EnvironmentError(errno.EINVAL, '%r is outside the context %s'
+                               % (path, context_path))
+    return key
+
+
+def link_into_sandbox(context_path, sandbox_path, key, link='hard'):
+    """Make key in sandbox_path a link to key in context_path. Symlinks
+    are copied as they are."""
+    import errno
+    source_path = os.path.join(context_path, key)
+    dest_path = os.path.join(sandbox_path, key)
+    if os.path.islink(source_path):
+        os.symlink(os.readlink(source_path), dest_path)
+        return
+    if link == 'hard':
+        try:
+            os.link(source_path, dest_path)
+            return
+        except OSError, e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    os.symlink(source_path, dest_path)
+
+
+def combine_resources(pipelines, combine):
+    """Return the (cpus, memory) of pipelines, each combined by combine,
+    which is sum for pipelines that run at once, or max."""
+    resources = [pipeline.get_resources() for pipeline in pipelines]
+    if not resources:
+        return 0, 0
+    return tuple(combine(column) for column in zip(*resources))
+
+
+def sandbox_command(pmatic_base, sandbox_path, pipeline_name, cpus, memory,
+                    force=False):
+    """Return the command line of an engine process that runs pipeline_name
+    in sandbox_path, with the same Python and pmatic as this one, and a
+    scheduler limited to the cpus and memory reserved for it."""
+    code = ('import sys; sys.path.insert(0, %r); import pmatic; '
+            'pmatic.run_sandbox(*sys.argv[1:])' %
+            os.path.dirname(os.path.abspath(__file__)))
+    return [sys.executable, '-c', code, pmatic_base, sandbox_path,
+            pipeline_name, str(cpus), str(memory)] + (
+                ['force'] if force else [])
+
+
+def run_sandbox(pmatic_base, sandbox_path, pipeline_name, cpus=None,
+                memory=None, force=None):
+    """Entry point of the engine process of a SandboxPipeline. Its steps
+    share the cpus and memory that the parent reserved for it, rather
+    than the whole node. Errors that the pipeline did not record itself,
+    like a bad template, are recorded as a failure in the sandbox's event
+    log. Any error exits with 1, since an errno may not fit in an exit
+    code."""
+    config = load_config(pmatic_base, SCHEDULER_FILE_NAME)
+    if cpus is not None:
+        config.update(cpus=int(cpus), memory=int(memory))
+    engine = PipelineEngine(pmatic_base, sandbox_path,
+                            scheduler=LocalScheduler(**config))
+    event_log = engine.event_log
+    event_log.catalog = None  # The sandbox is temporary.
+    try:
+        engine.run(pipeline_name, bool(force))
+    except Exception, e:
+        print_err('%s', e)
+        event_log.read_log()
+        if event_log.get_status() != 'failed':
+            event_log.record_pipeline_failed(
+                Namespace(pipeline_name=pipeline_name), exception=str(e)
+            )
+            event_log.flush()
+        exit(1)
+
+
+class LocalScheduler(object):
+    """Admission control for the cpus and memory of this node. Requests
+    are granted highest priority (longest critical path) first, then
+    oldest first, except that a request that fits may backfill around
+    those ahead of it that do not, as long as none of those has been
+    overtaken max_skips times already. Capacity comes from
+    $PMATIC_BASE/scheduler.yaml (cpus, memory, max_skips), defaulting to
+    the whole node."""
+    def __init__(self, cpus=None, memory=None, max_skips=8):
+        import multiprocessing
+        import threading
+        super(LocalScheduler, self).__init__()
+        self.cpus = cpus or multiprocessing.cpu_count()
+        self.memory = parse_size(memory) or (os.sysconf('SC_PAGE_SIZE') *
+                                             os.sysconf('SC_PHYS_PAGES'))
+        self.max_skips = max_skips
+        self.free_cpus = self.cpus
+        self.free_memory = self.memory
+        self.condition = threading.Condition()
+        self.waiting = []  # requests, in the order they are granted
+
+    @classmethod
+    def from_config(cls, pmatic_base):
+        return cls(**load_config(pmatic_base, SCHEDULER_FILE_NAME))
+
+    @contextlib.contextmanager
+    def reserve(self, cpus, memory, priority=0):
+        """Context manager that blocks until cpus and memory (bytes) are
+        granted, then releases them at the end."""
+        request = self.acquire(cpus, memory, priority)
+        try:
+            yield
+        finally:
+            self.release(request)
+
+    def acquire(self, cpus, memory, priority=0):
+        import errno
+        request = Namespace(cpus=cpus or 0, memory=memory or 0, skips=0,
+                            priority=priority)
+        if request.cpus > self.cpus or request.memory > self.memory:
+            raise EnvironmentError(
+                errno.E2BIG, 'need %d cpus and %d bytes, but this node has '
+                '%d and %d' % (request.cpus, request.memory, self.cpus,
+                               self.memory)
+            )
+        with self.condition:
+            index = len(self.waiting)
+            while index and self.waiting[index - 1].priority < priority:
+                index -= 1
+            self.waiting.insert(index, request)
+            while not self.can_grant(request):
+                self.condition.wait()
+            index = self.waiting.index(request)
+            for older in self.waiting[:index]:
+                older.skips += 1
+            del self.waiting[index]
+            self.free_cpus -= request.cpus
+            self.free_memory -= request.memory
+            self.condition.notify_all()  # Others may backfill behind us.
+        return request
+
+    def release(self, request):
+        with self.condition:
+            self.free_cpus += request.cpus
+            self.free_memory += request.memory
+            self.condition.notify_all()
+
+    def fits(self, request):
+        return (request.cpus <= self.free_cpus and
+                request.memory <= self.free_memory)
+
+    def can_grant(self, request):
+        if not self.fits(request):
+            return False
+        for older in self.waiting:
+            if older is request:
+                return True
+            if self.fits(older) or older.skips >= self.max_skips:
+                return False
+
+
+class DurationModel(object):
+    """Predicts how long pipelines take from the started and finished
+    events of their earlier executions, per pipeline name, executable and
+    version. Each prediction is a moving average that weights the latest
+    duration by WEIGHT. A retried execution lasts from the start of its
+    first attempt. Executions that were skipped as up to date or cached
+    say nothing about durations. Pipelines never seen to finish are
+    predicted to take the median of the other predictions."""
+    WEIGHT = 0.5
+
+    def __init__(self):
+        super(DurationModel, self).__init__()
+        self.estimates = {}  # (pipeline_name, executable, version) -> secs
+        self.default = 0.0
+
+    @classmethod
+    def from_events(cls, events):
+        """events are newest first, like EventLog.event_data."""
+        model = cls()
+        starts = {}
+        for event in reversed(events or ()):
+            if event.what == 'started':
+                if not is_retry(event) or event.pipeline_name not in starts:
+                    starts[event.pipeline_name] = event
+            elif event.what == 'finished' and not (
+                    hasattr(event, 'up_to_date') or
+                    hasattr(event, 'cache_hit')):
+                started = starts.pop(event.pipeline_name, None)
+                if started:
+                    model.add(event.pipeline_name, vars(started),
+                              (event.when - started.when).total_seconds())
+        return model
+
+    def key(self, pipeline_name, fields):
+        return (pipeline_name, fields.get('executable'),
+                fields.get('version'))
+
+    def add(self, pipeline_name, fields, seconds):
+        key = self.key(pipeline_name, fields)
+        previous = self.estimates.get(key, seconds)
+        self.estimates[key] = (self.WEIGHT * seconds +
+                               (1 - self.WEIGHT) * previous)
+        values = sorted(self.estimates.itervalues())
+        self.default = values[len(values) // 2]
+
+    def estimate(self, pipeline_name, fields):
+        return self.estimates.get(self.key(pipeline_name, fields),
+                                  self.default)
+
+
+def predict_remaining(event_log, pipeline=None, now=None):
+    """Return the seconds until the execution running in the context of
+    event_log is predicted to finish, from the durations of earlier ones:
+    0 if none is running, or None if there is nothing to go by. pipeline,
+    the one running, lets the steps still to come be predicted one by
+    one."""
+    from datetime import datetime
+    event_log.read_log()
+    if event_log.get_status() != 'started':
+        return 0.0
+    events = event_log.event_data
+    starts = [index for index, event in enumerate(events)
+              if is_run_start(event)]
+    if not starts:
+        return None
+    index = starts[0]
+    model = DurationModel.from_events(events[index + 1:])
+    if not model.estimates:
+        return None
+    progress = {}
+    first_starts = {}
+    for event in reversed(events[:index + 1]):
+        if event.what == 'started':
+            if is_retry(event):
+                event = first_starts.get(event.pipeline_name, event)
+            first_starts[event.pipeline_name] = event
+        progress[event.pipeline_name] = event
+    now = now or datetime.utcnow()
+    if pipeline:
+        return pipeline.estimate_remaining(model, progress, now)
+    started = events[index]
+    key = model.key(started.pipeline_name, vars(started))
+    if key not in model.estimates:
+        return None
+    elapsed = (now - started.when).total_seconds()
+    return max(0.0, model.estimates[key] - elapsed)
+
+
+class ChildLimits(object):
+    """Callable for preexec_fn, which limits the address space of the child
+    to memory bytes (if any). A Watchdog needs the child to lead a new
+    process group, so that all of its descendants can be killed."""
+    def __init__(self, memory=None, restore_sigpipe=False,
+                 new_process_group=False):
+        super(ChildLimits, self).__init__()
+        self.memory = memory
+        self.restore_sigpipe = restore_sigpipe
+        self.new_process_group = new_process_group
+
+    def __call__(self):
+        if self.new_process_group:
+            os.setpgid(0, 0)
+        if self.memory:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory, self.memory))
+        if self.restore_sigpipe:
+            restore_sigpipe()
+
+
+class Watchdog(object):
+    """Waits for a ChildProcess that leads its own process group. Kills the
+    group
+    if the child runs for more than timeout seconds, or if for
+    stall_timeout seconds none of output_paths grows and the processes of
+    the group use no CPU time. Killing sends SIGTERM, then SIGKILL after
+    grace seconds."""
+    def __init__(self, process, timeout=None, stall_timeout=None,
+                 output_paths=(), grace=10.0):
+        super(Watchdog, self).__init__()
+        self.process = process
+        self.pid = process.pid
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.output_paths = [path for path in output_paths if path]
+        self.grace = grace
+        limits = [limit for limit in (timeout, stall_timeout) if limit]
+        self.poll_interval = min([1.0] + [limit / 10.0 for limit in limits])
+
+    def wait(self):
+        """Return (exit_code, rusage, reason). exit_code is negative for a
+        signal, like Popen.returncode. reason is 'timeout' or 'stall' if
+        the watchdog killed the group, else None."""
+        import time
+        start = last_progress = time.time()
+        progress = self.measure_progress()
+        while True:
+            if self.process.poll() is not None:
+                return self.process.returncode, self.process.rusage, None
+            now = time.time()
+            reason = None
+            if self.timeout and now - start >= self.timeout:
+                reason = 'timeout'
+            elif self.stall_timeout:
+                current = self.measure_progress()
+                if current != progress:
+                    progress, last_progress = current, now
+                elif now - last_progress >= self.stall_timeout:
+                    reason = 'stall'
+            if reason:
+                exit_code, rusage = self.kill()
+                return exit_code, rusage, reason
+            time.sleep(self.poll_interval)
+
+    def kill(self):
+        """Terminate the process group. Return (exit_code, rusage)."""
+        import signal
+        import time
+        self.signal_group(signal.SIGTERM)
+        deadline = time.time() + self.grace
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(min(self.poll_interval, 0.1))
+        self.signal_group(signal.SIGKILL)  # including any stragglers
+        return self.process.wait(), self.process.rusage
+
+    def signal_group(self, signal_number):
+        import errno
+        try:
+            os.killpg(self.pid, signal_number)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def measure_progress(self):
+        """Return something that changes whenever the step progresses."""
+        sizes = []
+        for path in self.output_paths:
+            try:
+                sizes.append(os.stat(path).st_size)
+            except OSError:
+                sizes.append(None)
+        return sizes, group_cpu_ticks(self.pid)
+
+
+def group_cpu_ticks(pgid):
+    """Return the CPU time (user + system, in clock ticks) used so far by
+    the live processes of a process group. Returns 0 without /proc."""
+    ticks = 0
+    try:
+        pids = [name for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return ticks
+    for pid in pids:
+        try:
+            with open('/proc/%s/stat' % pid) as fin:
+                fields = fin.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue  # The process is gone.
+        if int(fields[2]) == pgid:
+            ticks += int(fields[11]) + int(fields[12])
+    return ticks
+
+
+def decode_exit_status(status):
+    """Return the exit code from os.wait status, negative for signals."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def format_rusage(rusage):
+    """Return the interesting parts of os.wait4 resource usage as a dict,
+    suitable for an event."""
+    return dict(utime=rusage.ru_utime, stime=rusage.ru_stime,
+                maxrss=rusage.ru_maxrss)
+
+
+class Launcher(object):
+    """Starts the child processes of steps. launch() takes the command line,
+    the stdin, stdout and stderr of the child (file objects, file
+    descriptors, or None to inherit them) and a ChildLimits, and returns a
+    ChildProcess. The launcher is named by $PMATIC_BASE/launcher.yaml
+    (launcher: popen, spawn or fork-server), defaulting to popen. A
+    launcher that cannot honor some limits, or is unavailable, hands the
+    launch to Popen.
+    Uses Template Method Pattern."""
+    __metaclass__ = abc.ABCMeta
+    name = None
+
+    @classmethod
+    def from_config(cls, pmatic_base):
+        config = load_config(pmatic_base, LAUNCHER_FILE_NAME)
+        name = config.get('launcher', PopenLauncher.name)
+        klass = LAUNCHER_CLASSES.get(name)
+        if not klass:
+            fail('Unknown launcher %r in %s', (name, LAUNCHER_FILE_NAME))
+        if not klass.is_available():
+            klass = PopenLauncher
+        return klass()
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def supports(self, limits, close_fds):
+        """Return whether implement_launch can honor limits and close_fds."""
+        return True
+
+    def launch(self, args, stdin=None, stdout=None, stderr=None,
+               limits=None, close_fds=False):
+        """Start args[0]. Raises OSError, like Popen, if it cannot be
+        executed. close_fds keeps the child from inheriting descriptors
+        besides its stdin, stdout and stderr."""
+        limits = limits or ChildLimits()
+        launcher = self
+        if not self.supports(limits, close_fds):
+            launcher = PopenLauncher()
+        return launcher.implement_launch(list(args), stdin, stdout, stderr,
+                                         limits, close_fds)
+
+    @abc.abstractmethod
+    def implement_launch(self, args, stdin, stdout, stderr, limits,
+                         close_fds):
+        raise NotImplementedError
+
+    def close(self):
+        """Release anything the launcher keeps between launches."""
+        pass
+
+
+class ChildProcess(object):
+    """A process started by a Launcher. Like Popen, returncode is negative
+    for a signal. rusage is the dict from format_rusage, once the process
+    is reaped."""
+    def __init__(self, pid, popen=None):
+        super(ChildProcess, self).__init__()
+        self.pid = pid
+        self.popen = popen  # told the returncode, so it never reaps
+        self.returncode = None
+        self.rusage = None
+
+    def poll(self):
+        """Return returncode, or None while the process runs."""
+        if self.returncode is None:
+            self.reap(os.WNOHANG)
+        return self.returncode
+
+    def wait(self):
+        """Block until the process exits. Return returncode."""
+        if self.returncode is None:
+            self.reap(0)
+        return self.returncode
+
+    def reap(self, options):
+        import errno
+        while True:
+            try:
+                pid, status, rusage = os.wait4(self.pid, options)
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+            else:
+                break
+        if pid:
+            self.exited(status, format_rusage(rusage))
+
+    def exited(self, status, rusage):
+        self.returncode = decode_exit_status(status)
+        self.rusage = rusage
+        if self.popen:
+            self.popen.returncode = self.returncode
+
+
+class PopenLauncher(Launcher):
+    """Starts children with subprocess.Popen: fork, then preexec_fn, then
+    exec. Honors every limit, but fork copies the page tables of the
+    engine, which gets slow as the engine grows."""
+    name = 'popen'
+
+    def implement_launch(self, args, stdin, stdout, stderr, limits,
+                         close_fds):
+        import subprocess
+        popen = subprocess.Popen(args, stdin=stdin, stdout=stdout,
+                                 stderr=stderr, close_fds=close_fds,
+                                 preexec_fn=limits)
+        return ChildProcess(popen.pid, popen)
+
+
+class SpawnLauncher(Launcher):
+    """Starts children with posix_spawn, which the C library implements
+    with vfork or clone(CLONE_VM), so the cost does not grow with the
+    memory of the engine. It can start a new process group and restore
+    SIGPIPE, but not limit memory. close_fds needs /proc."""
+    name = 'spawn'
+    POSIX_SPAWN_SETPGROUP = 0x02
+    POSIX_SPAWN_SETSIGDEF = 0x04
+    # ctypes cannot know the sizes of posix_spawn_file_actions_t,
+    # posix_spawnattr_t and sigset_t, which are 80, 336 and 128 bytes
+    # with glibc on 64-bit Linux, so allocate several times as much.
+    FILE_ACTIONS_SIZE = 1024
+    ATTR_SIZE = 4096
+    SIGSET_SIZE = 1024
+
+    @classmethod
+    def is_available(cls):
+        try:
+            load_spawn_functions()
+        except (OSError, AttributeError):
+            return False
+        return True
+
+    def supports(self, limits, close_fds):
+        return not limits.memory and (not close_fds or
+                                      os.path.isdir('/proc/self/fd'))
+
+    def implement_launch(self, args, stdin, stdout, stderr, limits,
+                         close_fds):
+        import ctypes
+        libc = load_spawn_functions()
+        actions = ctypes.create_string_buffer(self.FILE_ACTIONS_SIZE)
+        attr = ctypes.create_string_buffer(self.ATTR_SIZE)
+        check_errno(libc.posix_spawn_file_actions_init(actions))
+        try:
+            check_errno(libc.posix_spawnattr_init(attr))
+            try:
+                for target, source in enumerate((stdin, stdout, stderr)):
+                    fd = file_descriptor(source)
+                    if fd is not None:
+                        check_errno(libc.posix_spawn_file_actions_adddup2(
+                            actions, fd, target
+                        ))
+                if close_fds:
+                    for fd in list_open_fds():
+                        if fd > 2:
+                            check_errno(
+                                libc.posix_spawn_file_actions_addclose(
+                                    actions, fd
+                                )
+                            )
+                flags = 0
+                if limits.new_process_group:
+                    flags |= self.POSIX_SPAWN_SETPGROUP
+                    check_errno(libc.posix_spawnattr_setpgroup(attr, 0))
+                if limits.restore_sigpipe:
+                    import signal
+                    flags |= self.POSIX_SPAWN_SETSIGDEF
+                    sigset = ctypes.create_string_buffer(self.SIGSET_SIZE)
+                    libc.sigemptyset(sigset)
+                    libc.sigaddset(sigset, signal.SIGPIPE)
+                    check_errno(libc.posix_spawnattr_setsigdefault(
+                        attr, sigset
+                    ))
+                check_errno(libc.posix_spawnattr_setflags(attr, flags))
+                env = ['%s=%s' % item for item in os.environ.iteritems()]
+                argv = (ctypes.c_char_p * (len(args) + 1))(*args + [None])
+                envp = (ctypes.c_char_p * (len(env) + 1))(*env + [None])
+                pid = ctypes.c_int()
+                check_errno(libc.posix_spawn(ctypes.byref(pid), args[0],
+                                             actions, attr, argv, envp))
+            finally:
+                libc.posix_spawnattr_destroy(attr)
+        finally:
+            libc.posix_spawn_file_actions_destroy(actions)
+        return ChildProcess(pid.value)
+
+
+class ForkServerLauncher(Launcher):
+    """Starts children from a server process forked when the launcher is
+    created, while the engine is still small, so that each fork copies
+    only the server. Requests and replies are JSON lines on a Unix socket.
+    The server opens the stdin, stdout and stderr of the child through
+    /proc/<engine pid>/fd, since Python 2 cannot pass descriptors over a
+    socket, and reports the exit status and resource usage of each child
+    it reaps. Honors every limit. Linux only."""
+    name = 'fork-server'
+    FD_FLAGS = [os.O_RDONLY, os.O_WRONLY, os.O_WRONLY]  # stdin, out, err
+
+    @classmethod
+    def is_available(cls):
+        return os.path.isdir('/proc/self/fd')
+
+    def __init__(self):
+        import threading
+        super(ForkServerLauncher, self).__init__()
+        self.lock = threading.Lock()  # one launch at a time
+        self.condition = threading.Condition()
+        self.start_server()
+
+    def start_server(self):
+        """Fork the server, as at creation and again on the first launch
+        after close()."""
+        import socket
+        engine_socket, server_socket = socket.socketpair()
+        self.server_pid = os.fork()
+        if not self.server_pid:
+            try:
+                engine_socket.close()
+                serve_launches(server_socket)
+            finally:
+                os._exit(0)
+        server_socket.close()
+        self.socket = engine_socket
+        self.replies = []  # to launch requests, in order
+        self.exits = {}  # pid -> (status, rusage)
+        self.closed = False
+        start_thread(self.read_messages, engine_socket.makefile('rb'))
+
+    def read_messages(self, fin):
+        import json
+        try:
+            for line in iter(fin.readline, ''):
+                message = json.loads(line)
+                with self.condition:
+                    if 'exited' in message:
+                        self.exits[message['exited']] = (message['status'],
+                                                         message['rusage'])
+                    else:
+                        self.replies.append(message)
+                    self.condition.notify_all()
+        finally:
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+
+    def implement_launch(self, args, stdin, stdout, stderr, limits,
+                         close_fds):
+        import json
+        fd_paths = []
+        for source in (stdin, stdout, stderr):
+            fd = file_descriptor(source)
+            fd_paths.append(None if fd is None else
+                            '/proc/%d/fd/%d' % (os.getpid(), fd))
+        request = dict(args=args, cwd=os.getcwd(), env=dict(os.environ),
+                       fd_paths=fd_paths, memory=limits.memory,
+                       restore_sigpipe=limits.restore_sigpipe,
+                       new_process_group=limits.new_process_group)
+        with self.lock:
+            if not self.server_pid:
+                self.start_server()
+            self.socket.sendall(json.dumps(request) + '\n')
+            reply = self.wait_for(lambda: self.replies and
+                                  self.replies.pop(0))
+        if 'error' in reply:
+            raise OSError(reply['error'], os.strerror(reply['error']))
+        return ServedChildProcess(reply['pid'], self)
+
+    def wait_for(self, get, block=True):
+        """Return get() once it is true, under the condition. Raises
+        OSError if the server has gone."""
+        import errno
+        with self.condition:
+            while True:
+                result = get()
+                if result or not block:
+                    return result
+                if self.closed:
+                    raise OSError(errno.ECHILD, 'fork server exited')
+                self.condition.wait(1.0)  # a timeout allows ^C
+
+    def close(self):
+        import socket
+        if self.server_pid:
+            self.socket.shutdown(socket.SHUT_RDWR)
+            self.socket.close()
+            os.waitpid(self.server_pid, 0)
+            self.server_pid = None
+
+
+class ServedChildProcess(ChildProcess):
+    """A ChildProcess of a ForkServerLauncher, reaped by its server."""
+    def __init__(self, pid, launcher):
+        super(ServedChildProcess, self).__init__(pid)
+        self.launcher = launcher
+
+    def reap(self, options):
+        result = self.launcher.wait_for(
+            lambda: self.launcher.exits.pop(self.pid, None),
+            block=not options & os.WNOHANG
+        )
+        if result:
+            self.exited(*result)
+
+
+def serve_launches(server_socket):
+    """Main loop of the fork server: start the child asked for by each
+    request line, reply with its pid (or errno), and report each child
+    reaped. Returns when the engine closes its end of server_socket."""
+    import errno
+    import fcntl
+    import json
+    import select
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # ^C is for the engine
+    wake_fd, wake_write_fd = os.pipe()  # written on SIGCHLD
+    for fd in (wake_fd, wake_write_fd, server_socket.fileno()):
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    fcntl.fcntl(wake_write_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+    signal.set_wakeup_fd(wake_write_fd)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.siginterrupt(signal.SIGCHLD, False)
+    buffered = ''
+    while True:
+        try:
+            readable = select.select([server_socket, wake_fd], [], [])[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        if wake_fd in readable:
+            os.read(wake_fd, 4096)
+        if server_socket in readable:
+            data = server_socket.recv(65536)
+            if not data:
+                return
+            buffered += data
+            while '\n' in buffered:
+                line, buffered = buffered.split('\n', 1)
+                reply = fork_served_child(json.loads(line))
+                server_socket.sendall(json.dumps(reply) + '\n')
+        while True:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    break  # ECHILD: none left
+            else:
+                if not pid:
+                    break
+                server_socket.sendall(json.dumps(dict(
+                    exited=pid, status=status, rusage=format_rusage(rusage)
+                )) + '\n')
+
+
+def fork_served_child(request):
+    """Fork and exec the child for a request of ForkServerLauncher.
+    Return the reply: its pid, or the errno that kept it from executing,
+    which the child reports through a close-on-exec pipe."""
+    import fcntl
+    import signal
+    error_fd, error_write_fd = os.pipe()
+    fcntl.fcntl(error_write_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    args = [arg.encode('utf-8') for arg in request['args']]
+    env = dict((name.encode('utf-8'), value.encode('utf-8'))
+               for name, value in request['env'].iteritems())
+    pid = os.fork()
+    if not pid:
+        try:
+            os.chdir(request['cwd'])
+            for target, (path, flags) in enumerate(
+                    zip(request['fd_paths'], ForkServerLauncher.FD_FLAGS)):
+                if path:
+                    fd = os.open(path, flags)
+                    os.dup2(fd, target)
+                    os.close(fd)
+            for fd in list_open_fds():
+                if fd > 2 and fd != error_write_fd:
+                    try:
+                        os.close(fd)
+                    except OSError:
+                        pass  # the descriptor that listed them
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            ChildLimits(request['memory'], request['restore_sigpipe'],
+                        request['new_process_group'])()
+            os.execve(args[0], args, env)
+        except EnvironmentError, e:
+            os.write(error_write_fd, str(e.errno or 0))
+        finally:
+            os._exit(127)
+    os.close(error_write_fd)
+    with os.fdopen(error_fd, 'rb') as fin:
+        error = fin.read()
+    if error:
+        os.waitpid(pid, 0)
+        return dict(error=int(error))
+    return dict(pid=pid)
+
+
+LAUNCHER_CLASSES = dict((klass.name, klass) for klass in [
+    PopenLauncher, SpawnLauncher, ForkServerLauncher
+])
+
+
+def file_descriptor(source):
+    """Return the descriptor of a file object, or source itself if it is
+    already a descriptor or None."""
+    if source is None or isinstance(source, (int, long)):
+        return source
+    return source.fileno()
+
+
+def list_open_fds():
+    """Return the open file descriptors of this process, from /proc."""
+    return [int(name) for name in os.listdir('/proc/self/fd')]
+
+
+def close_on_exec_pipe():
+    """Return os.pipe(), with both ends marked close-on-exec so that only
+    the child each end is handed to inherits it."""
+    import fcntl
+    fds = os.pipe()
+    for fd in fds:
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    return fds
+
+
+def check_errno(result):
+    """Raise OSError for a nonzero result that is an errno, as posix_spawn
+    and its helpers return."""
+    if result:
+        raise OSError(result, os.strerror(result))
+
+
+class BuiltinCommandPipeline(AbstractPipeline):
+    """Pipelines that wrap a standard command like mkdir, cp, or mv. They
+    run inside the engine rather than in a child process, and always
+    require exactly the named parameters listed by the subclass."""
+    command = None
+    parameters = []
+
+    @property
+    def parameterized_fields(self):
+        return self.parameters
+
+    def load(self, data):
+        """Requirement of AbstractPipeline"""
+        assert self.version == '1', (
+            'BuiltinCommandPipeline currently only version 1'
+        )
+        data = dict(data)
+        data.pop('file_type', None)
+        data.pop('command', None)
+        self.set_snapshot_mode(data.pop('snapshot', None))
+        assert set(data) == set(self.parameters), (
+            'command %s needs parameters %s, not %s' %
+            (self.command, sorted(self.parameters), sorted(data))
+        )
+        self.__dict__.update(data)
+
+    def get_dependencies(self):
+        """Requirement of AbstractPipeline"""
+        return set()
+
+    def get_fingerprint_arguments(self):
+        return [self.command] + [getattr(self, name)
+                                 for name in self.parameters]
+
+    def implement_run(self, namespace):
+        """Requirement of AbstractPipeline"""
+        self.record_pipeline_started()
+        try:
+            self.execute()
+        except Exception, e:
+            self.record_pipeline_failed(exception=str(e))
+            raise
+        self.record_pipeline_finished()
+
+    @abc.abstractmethod
+    def execute(self):
+        """Do the work of the command."""
+        raise NotImplementedError
+
+
+class MkdirPipeline(BuiltinCommandPipeline):
+    """mkdir -p dir"""
+    command = 'mkdir'
+    parameters = ['dir']
+
+    def is_up_to_date(self):
+        return os.path.isdir(self.dir)
+
+    def get_snapshot_paths(self, namespace):
+        return [self.dir]
+
+    def execute(self):
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+
+
+class Md5Pipeline(BuiltinCommandPipeline):
+    """md5sum <stdin >stdout"""
+    command = 'md5'
+    parameters = ['stdin', 'stdout']
+
+    def get_input_paths(self):
+        return [self.stdin]
+
+    def get_output_paths(self):
+        return [self.stdout]
+
+    def execute(self):
+        with open(self.stdin, 'rb') as fin:
+            with open(self.stdout, 'w') as fout:
+                self.stream(fin, fout)
+
+    def stream(self, fin, fout):
+        """Checksum fin into fout. Lets md5 be a stage of a pipe."""
+        fout.write('%s  -\n' % hash_stream(fin, hash_name='md5'))
+
+
+class CpPipeline(BuiltinCommandPipeline):
+    """cp source dest"""
+    command = 'cp'
+    parameters = ['source', 'dest']
+
+    def get_input_paths(self):
+        return [self.source]
+
+    def get_output_paths(self):
+        return [self.dest]
+
+    def execute(self):
+        import shutil
+        with open(self.source, 'rb') as fin:
+            with open(self.dest, 'wb') as fout:
+                copy_file_data(fin.fileno(), fout.fileno())
+        shutil.copymode(self.source, self.dest)
+
+
+class MvPipeline(BuiltinCommandPipeline):
+    """mv source dest"""
+    command = 'mv'
+    parameters = ['source', 'dest']
+
+    def get_output_paths(self):
+        return [self.dest]
+
+    def get_snapshot_paths(self, namespace):
+        return [self.source, self.dest]
+
+    def is_up_to_date(self):
+        return (not os.path.lexists(self.source) and
+                super(MvPipeline, self).is_up_to_date())
+
+    def execute(self):
+        import errno
+        try:
+            os.rename(self.source, self.dest)
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise
+            import shutil
+            shutil.move(self.source, self.dest)
+
+
+PIPELINE_CLASSES = {
+    'single-task': SingleTaskPipeline,
+    'explicit-sequence': SequentialPipeline,
+    'pipe': PipePipeline,
+    'parallel': ParallelPipeline,
+    'sandbox': SandboxPipeline,
+}
+BUILTIN_COMMANDS = dict((klass.command, klass) for klass in [
+    MkdirPipeline, Md5Pipeline, CpPipeline, MvPipeline,
+])
+
+
+class ParameterFile(object):
+    """A YAML file of parameters, pushed onto the namespace before any step
+    runs, and the optional executable that generates it. The generator
+    reads the parameters accumulated so far as YAML on stdin and writes
+    the contents of the file to stdout. needs lists parameters that must
+    be defined before the generator can run (besides those mentioned in
+    the file name or arguments)."""
+    def __init__(self, file, generator=None, version=None, arguments=(),
+                 needs=()):
+        super(ParameterFile, self).__init__()
+        assert version or not generator, (
+            'parameter generator %s needs a version' % generator
+        )
+        self.file = file
+        self.generator = generator
+        self.version = version and str(version)
+        self.arguments = list(arguments)
+        self.needs = set(needs) | template_names([file, self.arguments])
+
+    def get_dependency(self):
+        return (self.generator, self.version, 'executable')
+
+    def bind(self, namespace):
+        """Return a Namespace describing the generation of this file from
+        the parameters in namespace."""
+        import hashlib
+        inputs = dict(namespace)
+        arguments = expand_templates(self.arguments, namespace)
+        digest = hashlib.sha1(repr(
+            (sorted(inputs.items()), self.generator, self.version, arguments)
+        )).hexdigest()
+        return Namespace(parameter_file=self,
+                         path=expand_templates(self.file, namespace),
+                         arguments=arguments, inputs=inputs, digest=digest)
+
+
+def load_parameter_files(entries):
+    """Return ParameterFile objects from the parameter-files of a pipeline
+    file."""
+    return [ParameterFile(**entry) for entry in entries or ()]
+
+
+def generate_parameter_file(job, dependency_finder):
+    """Run the generator for job (from ParameterFile.bind) and atomically
+    replace the parameter file with its output."""
+    import errno
+    import subprocess
+    import yaml
+    args = [dependency_finder.path(job.parameter_file.get_dependency())]
+    args.extend(job.arguments)
+    proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, close_fds=True)
+    output = proc.communicate(format_yaml(job.inputs))[0]
+    if proc.returncode:
+        raise ExitCodeError(proc.returncode, 'exit code from %r generating %r'
+                            % (args[0], job.path))
+    if not isinstance(yaml.safe_load(output), (dict, type(None))):
+        raise EnvironmentError(errno.EINVAL, '%r generated no map in %r'
+                               % (args[0], job.path))
+    write_file_atomically(job.path, output)
+
+
+class RetryPolicy(object):
+    """When and how often to run a failed step again. Pipeline files give
+    it as a retry map, for example:
+
+        retry:
+          attempts: 3           # in all, including the first
+          backoff: 10           # seconds to wait before the second
+          factor: 2             # backoff grows by this for each attempt
+          max_backoff: 600
+          jitter: 0.25          # randomize the wait by up to this fraction
+          exit_codes: [75]      # default: any exit code
+          signals: [KILL, 15]   # names or numbers; default: none
+          watchdog: [timeout]   # Watchdog reasons; default: none
+    """
+    def __init__(self, attempts=3, backoff=10.0, factor=2.0,
+                 max_backoff=600.0, jitter=0.25, exit_codes=None,
+                 signals=(), watchdog=()):
+        super(RetryPolicy, self).__init__()
+        self.attempts = attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.exit_codes = exit_codes and set(exit_codes)
+        self.signals = set(signal_number(name) for name in signals)
+        self.watchdog = set(watchdog)
+
+    @classmethod
+    def from_data(cls, data):
+        """Return a RetryPolicy from a retry map, or None."""
+        if not data:
+            return None
+        return cls(**data)
+
+    def should_retry(self, error, attempt):
+        """Return True if the ExitCodeError error from attempt (counting
+        from 1) deserves another attempt."""
+        if attempt >= self.attempts:
+            return False
+        if isinstance(error, WatchdogError):
+            return error.reason in self.watchdog
+        if error.errno < 0:
+            return -error.errno in self.signals
+        return not self.exit_codes or error.errno in self.exit_codes
+
+    def get_delay(self, attempt):
+        """Return the seconds to wait after attempt failed."""
+        import random
+        delay = min(self.max_backoff,
+                    self.backoff * self.factor ** (attempt - 1))
+        return delay * (1 + self.jitter * random.uniform(-1, 1))
+
+    def sleep(self, attempt):
+        import time
+        time.sleep(max(0, self.get_delay(attempt)))
+
+
+def signal_number(name):
+    """Return the number of a signal given as a number, KILL or SIGKILL."""
+    import signal
+    if isinstance(name, basestring) and not name.isdigit():
+        name = name.upper()
+        return getattr(signal, name if name.startswith('SIG') else
+                       'SIG' + name)
+    return int(name)
+
+
+class ExitCodeError(EnvironmentError):
+    """Signals that an external program returned a nonzero exit code."""
+    pass
+
+
+class WatchdogError(ExitCodeError):
+    """Signals that a Watchdog killed an external program. reason is
+    'timeout' or 'stall'."""
+    def __init__(self, exit_code, message, reason):
+        super(WatchdogError, self).__init__(exit_code, message)
+        self.reason = reason
+
+
+class StepCache(object):
+    """Memoizes the output files of single-task pipelines across contexts,
+    in $PMATIC_BASE/step_cache. The cache is used only if that directory
+    exists and only by pipelines that declare "cache: true".
+
+    Output files are copied once per content into objects/, named by SHA-1,
+    and made read-only. Each cached step is a YAML entry in entries/, named
+    by a hash of everything that determines the outputs. Hits are
+    materialized as hard links, so the cache must be on the same filesystem
+    as the contexts. Entries are evicted least recently used first once the
+    objects exceed max_bytes (settable in step_cache/config.yaml)."""
+    DEFAULT_MAX_BYTES = 100 * 2 ** 30
+
+    def __init__(self, cache_path, max_bytes=None):
+        super(StepCache, self).__init__()
+        self.cache_path = cache_path
+        self.objects_path = os.path.join(cache_path, 'objects')
+        self.entries_path = os.path.join(cache_path, 'entries')
+        self.new_path = os.path.join(cache_path, 'new')
+        for path in (self.objects_path, self.entries_path, self.new_path):
+            ensure_directory_exists(path, os.makedirs)
+        if max_bytes is None:
+            config_path = os.path.join(cache_path, 'config.yaml')
+            if os.path.isfile(config_path):
+                max_bytes = load_yaml_file(config_path).get('max_bytes')
+        self.max_bytes = max_bytes or self.DEFAULT_MAX_BYTES
+
+    @classmethod
+    def open_optional(cls, pmatic_base):
+        """Return a StepCache if pmatic_base has one, otherwise None."""
+        path = os.path.join(pmatic_base, STEP_CACHE_DIR_NAME)
+        if not os.path.isdir(path):
+            return None
+        return cls(path)
+
+    def make_key(self, executable_path, version, arguments, input_digests,
+                 output_paths):
+        """Return a hex digest identifying one execution of a step.
+        input_digests is a list of (path, digest) pairs."""
+        import hashlib
+        key_data = [executable_path, version, list(arguments),
+                    list(input_digests), list(output_paths)]
+        return hashlib.sha1(repr(key_data)).hexdigest()
+
+    def fetch(self, key, output_paths):
+        """Hard link the cached outputs for key into the current directory.
+        Return False (having changed nothing) on a cache miss. An entry
+        counts only if it has an object for every one of output_paths;
+        an incomplete one, as from an interrupted store, is deleted."""
+        entry_path = os.path.join(self.entries_path, key + '.yaml')
+        try:
+            entry = load_yaml_file(entry_path)
+        except IOError:
+            return False
+        except Exception:
+            entry = None  # truncated
+        outputs = isinstance(entry, dict) and entry.get('outputs') or {}
+        object_paths = dict((path, self.object_path(digest))
+                            for path, digest in outputs.iteritems())
+        if (not output_paths or set(object_paths) != set(output_paths) or
+                not all(map(os.path.isfile, object_paths.itervalues()))):
+            remove_if_exists(entry_path)
+            return False
+        for path, object_path in sorted(object_paths.iteritems()):
+            dir_path = os.path.dirname(path)
+            if dir_path:
+                ensure_directory_exists(dir_path, os.makedirs)
+            temp_path = '%s.%s.tmp' % (path, key)
+            os.link(object_path, temp_path)
+            os.rename(temp_path, path)
+        os.utime(entry_path, None)  # Mark as recently used.
+        return True
+
+    def store(self, key, output_paths):
+        """Add the output files of a successful execution under key."""
+        outputs = {}
+        for path in output_paths:
+            digest = outputs[path] = hash_file(path)
+            object_path = self.object_path(digest)
+            if not os.path.exists(object_path):
+                ensure_directory_exists(os.path.dirname(object_path))
+                # Copy rather than link, so that making the object
+                # read-only leaves the context's file alone.
+                temp_path = os.path.join(self.new_path, digest)
+                with open(path, 'rb') as fin:
+                    with open(temp_path, 'wb') as fout:
+                        copy_file_data(fin.fileno(), fout.fileno())
+                os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode) &
+                         07444)
+                os.rename(temp_path, object_path)
+        temp_path = os.path.join(self.new_path, key + '.yaml')
+        save_yaml_file(temp_path, dict(file_type='step-cache-entry-1',
+                                       outputs=outputs))
+        os.rename(temp_path, os.path.join(self.entries_path, key + '.yaml'))
+        self.evict()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_path, digest[:2], digest[2:])
+
+    def evict(self):
+        """Remove least recently used entries until the objects referenced by
+        the remaining entries fit in max_bytes. Then delete the objects that
+        are no longer referenced."""
+        entries = []
+        for name in os.listdir(self.entries_path):
+            entry_path = os.path.join(self.entries_path, name)
+            try:
+                mtime = os.stat(entry_path).st_mtime
+                digests = set(load_yaml_file(entry_path)['outputs'].values())
+            except (IOError, OSError):
+                continue  # Evicted concurrently
+            entries.append((mtime, entry_path, digests))
+        entries.sort(reverse=True)
+        sizes = {}
+        for mtime, entry_path, digests in entries:
+            for digest in digests - set(sizes):
+                object_path = self.object_path(digest)
+                if os.path.isfile(object_path):
+                    sizes[digest] = os.stat(object_path).st_size
+        total = sum(sizes.itervalues())
+        while entries and total > self.max_bytes:
+            mtime, entry_path, digests = entries.pop()
+            remove_if_exists(entry_path)
+            live = set()
+            for entry in entries:
+                live.update(entry[2])
+            for digest in digests - live:
+                total -= sizes.pop(digest, 0)
+                remove_if_exists(self.object_path(digest))
+
+
+class ObjectStore(object):
+    """Snapshot backups shared by every context, in
+    $PMATIC_BASE/snapshot_store, which must be on the same filesystem as
+    the contexts (it may be a symlink to a directory there). The store is
+    used only if that directory exists.
+
+    Regular files are hard linked into objects/, named by SHA-1, so a file
+    is linked once no matter how many snapshots or contexts hold it. An
+    SQLite index maps (device, inode, size, mtime) to the digest, so that
+    files that have not changed since they were stored are never read
+    again. Each context lists the digests that its event log refers to in
+    a file in refs/, and collect_garbage() deletes the objects that no
+    context refers to. Files that cannot be linked into the store fall back
+    to the inode_snapshots of their context."""
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS prekeys (
+            device INTEGER, inode INTEGER, size INTEGER, mtime REAL,
+            digest TEXT, PRIMARY KEY (device, inode))""",
+    ]
+
+    def __init__(self, store_path):
+        import sqlite3
+        super(ObjectStore, self).__init__()
+        self.store_path = store_path
+        self.objects_path = os.path.join(store_path, 'objects')
+        self.refs_path = os.path.join(store_path, 'refs')
+        for path in (self.objects_path, self.refs_path):
+            ensure_directory_exists(path, os.makedirs)
+        self.connection = sqlite3.connect(
+            os.path.join(store_path, 'index.sqlite'), timeout=60,
+            check_same_thread=False
+        )
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            self.connection.execute(statement)
+
+    @classmethod
+    def open_optional(cls, pmatic_base):
+        """Return an ObjectStore if pmatic_base has one, otherwise None."""
+        if not pmatic_base:
+            return None
+        path = os.path.join(pmatic_base, OBJECT_STORE_DIR_NAME)
+        if not os.path.isdir(path):
+            return None
+        return cls(path)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_path, digest[:2], digest[2:])
+
+    def store(self, path):
+        """Hard link the regular file at path into the store, unless its
+        contents are there already. Return its digest, or None if it
+        cannot be linked (as from another filesystem)."""
+        import errno
+        st = os.stat(path)
+        prekey = (st.st_dev, st.st_ino)
+        row = self.connection.execute(
+            'SELECT size, mtime, digest FROM prekeys'
+            ' WHERE device = ? AND inode = ?', prekey
+        ).fetchone()
+        if row and tuple(row[:2]) == (st.st_size, st.st_mtime):
+            digest = str(row[2])
+            if os.path.exists(self.object_path(digest)):
+                return digest
+        digest = hash_file(path)
+        object_path = self.object_path(digest)
+        if not os.path.exists(object_path):
+            ensure_directory_exists(os.path.dirname(object_path))
+            try:
+                os.link(path, object_path)
+            except OSError, e:
+                if e.errno == errno.EXDEV:
+                    return None
+                if e.errno != errno.EEXIST:
+                    raise
+        self.connection.execute(
+            'INSERT OR REPLACE INTO prekeys VALUES (?, ?, ?, ?, ?)',
+            prekey + (st.st_size, st.st_mtime, digest)
+        )
+        return digest
+
+    def commit(self):
+        self.connection.commit()
+
+    def ref_path(self, context_path):
+        import hashlib
+        return os.path.join(self.refs_path,
+                            hashlib.sha1(abspath(context_path)).hexdigest())
+
+    def read_refs(self, ref_path):
+        """Return the context path and the set of digests in a ref file."""
+        with open(ref_path) as f:
+            lines = f.read().splitlines()
+        return lines[0], set(lines[1:])
+
+    def write_refs(self, context_path, digests):
+        """Make digests the objects that context_path refers to."""
+        write_file_atomically(
+            self.ref_path(context_path),
+            '\n'.join([abspath(context_path)] + sorted(digests)) + '\n'
+        )
+
+    def add_refs(self, context_path, digests):
+        ref_path = self.ref_path(context_path)
+        if os.path.isfile(ref_path):
+            digests = self.read_refs(ref_path)[1].union(digests)
+        self.write_refs(context_path, digests)
+
+    def collect_garbage(self, grace=3600):
+        """Delete the objects that no context refers to, except those linked
+        within the last grace seconds, which a snapshot still being taken
+        may be about to claim. Refs of contexts that no longer have an
+        event log are dropped first. Return the number of bytes freed."""
+        import time
+        live = set()
+        for name in os.listdir(self.refs_path):
+            ref_path = os.path.join(self.refs_path, name)
+            context_path, digests = self.read_refs(ref_path)
+            if os.path.isdir(os.path.join(meta_path(context_path),
+                                          'events')):
+                live.update(digests)
+            else:
+                remove_if_exists(ref_path)
+        freed = 0
+        deadline = time.time() - grace
+        for dir_name in os.listdir(self.objects_path):
+            dir_path = os.path.join(self.objects_path, dir_name)
+            for name in os.listdir(dir_path):
+                digest = dir_name + name
+                object_path = os.path.join(dir_path, name)
+                st = os.lstat(object_path)
+                if digest in live or st.st_ctime > deadline:
+                    continue
+                os.remove(object_path)
+                self.connection.execute(
+                    'DELETE FROM prekeys WHERE digest = ?', (digest,)
+                )
+                freed += st.st_size if st.st_nlink == 1 else 0
+        self.commit()
+        return freed
+
+
+class FileHasher(object):
+    """Caches file digests by (inode, size, mtime), so that files that have
+    not changed are never read twice."""
+    def __init__(self):
+        super(FileHasher, self).__init__()
+        self.records = {}  # path -> [digest, inode, size, mtime]
+
+    def update(self, records):
+        """Accept records previously returned by record()."""
+        self.records.update(records)
+
+    def record(self, path):
+        """Return [digest, inode, size, mtime] for path."""
+        st = os.stat(path)
+        stats = [st.st_ino, st.st_size, st.st_mtime]
+        record = self.records.get(path)
+        if not record or list(record[1:]) != stats:
+            record = self.records[path] = [hash_file(path)] + stats
+        return record
+
+
+def strip_file_stats(fingerprint):
+    """Return a copy of fingerprint with only the digest of each file."""
+    files = dict((path, record[0])
+                 for path, record in fingerprint['files'].iteritems())
+    return dict(fingerprint, files=files)
+
+
+def hash_file(path, block_size=2 ** 20, hash_name='sha1'):
+    """Return the hex digest of the contents of path (default SHA-1)."""
+    with open(path, 'rb') as fin:
+        return hash_stream(fin, block_size, hash_name)
+
+
+def hash_stream(fin, block_size=2 ** 20, hash_name='sha1'):
+    """Return the hex digest of everything left to read from fin."""
+    import hashlib
+    digest = hashlib.new(hash_name)
+    for block in iter(lambda: fin.read(block_size), ''):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def tee_stream(in_fd, out_fd, file_path, block_size=2 ** 20):
+    """Copy everything from in_fd to both out_fd and file_path, then close
+    both file descriptors. If the reader of out_fd goes away, keep
+    writing to file_path, so that the file is always complete."""
+    import errno
+    try:
+        with open(file_path, 'wb') as fout:
+            for block in iter(lambda: os.read(in_fd, block_size), ''):
+                fout.write(block)
+                while block and out_fd is not None:
+                    try:
+                        block = block[os.write(out_fd, block):]
+                    except OSError, e:
+                        if e.errno != errno.EPIPE:
+                            raise
+                        os.close(out_fd)
+                        out_fd = None
+    finally:
+        os.close(in_fd)
+        if out_fd is not None:
+            os.close(out_fd)
+
+
+def stream_fds(stage, in_fd, out_fd):
+    """Run stage.stream() on file descriptors, then close them."""
+    with os.fdopen(in_fd, 'rb') as fin:
+        with os.fdopen(out_fd, 'wb') as fout:
+            stage.stream(fin, fout)
+
+
+def start_thread(target, *args):
+    """Return a started daemon thread running target(*args)."""
+    import threading
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def restore_sigpipe():
+    """Give a child process the default SIGPIPE handling, which Python
+    ignores, so that a writer stops when the reader of its pipe exits."""
+    import signal
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+def copy_file_data(in_fd, out_fd, block_size=2 ** 24):
+    """Copy the rest of the file open as in_fd to out_fd, inside the kernel
+    where possible: by copy_file_range, else sendfile, else read & write.
+    Each method continues from the file offsets left by the last."""
+    import ctypes
+    import errno
+    calls = [
+        ('copy_file_range',
+         (in_fd, None, out_fd, None, ctypes.c_size_t(block_size), 0)),
+        ('sendfile', (out_fd, in_fd, None, ctypes.c_size_t(block_size))),
+    ]
+    for function_name, args in calls:
+        try:
+            function = getattr(load_libc(), function_name)
+        except (OSError, AttributeError):
+            continue
+        function.restype = ctypes.c_ssize_t
+        while True:
+            count = function(*args)
+            if count == 0:
+                return
+            if count < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                             errno.EOPNOTSUPP):
+                    break  # Try the next method.
+                raise OSError(error, os.strerror(error))
+    for block in iter(lambda: os.read(in_fd, block_size), ''):
+        while block:
+            block = block[os.write(out_fd, block):]
+
+
+_libc = None
+_spawn_functions_declared = False
+
+
+def load_libc():
+    """Return the C library through ctypes, with errno support. Raises
+    OSError where it cannot be loaded."""
+    global _libc
+    if _libc is None:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+
+def load_spawn_functions():
+    """Return the C library with the prototypes of posix_spawn and the
+    functions that prepare its arguments declared. Raises OSError or
+    AttributeError where they are missing."""
+    global _spawn_functions_declared
+    import ctypes
+    libc = load_libc()
+    if not _spawn_functions_declared:
+        c_int, c_void_p = ctypes.c_int, ctypes.c_void_p
+        string_array = ctypes.POINTER(ctypes.c_char_p)
+        prototypes = [
+            ('posix_spawn', [ctypes.POINTER(c_int), ctypes.c_char_p,
+                             c_void_p, c_void_p, string_array,
+                             string_array]),
+            ('posix_spawn_file_actions_init', [c_void_p]),
+            ('posix_spawn_file_actions_destroy', [c_void_p]),
+            ('posix_spawn_file_actions_adddup2', [c_void_p, c_int, c_int]),
+            ('posix_spawn_file_actions_addclose', [c_void_p, c_int]),
+            ('posix_spawnattr_init', [c_void_p]),
+            ('posix_spawnattr_destroy', [c_void_p]),
+            ('posix_spawnattr_setflags', [c_void_p, ctypes.c_short]),
+            ('posix_spawnattr_setpgroup', [c_void_p, c_int]),
+            ('posix_spawnattr_setsigdefault', [c_void_p, c_void_p]),
+            ('sigemptyset', [c_void_p]),
+            ('sigaddset', [c_void_p, c_int]),
+        ]
+        for function_name, argtypes in prototypes:
+            function = getattr(libc, function_name)
+            function.argtypes = argtypes
+            function.restype = c_int
+        _spawn_functions_declared = True
+    return libc
+
+
+def restore_snapshot(snapshot_dict, context_path, scopes=(), backups=None):
+    """Restore the working directory to the state described in snapshot_dict
+    using the contents of ./.pmatic/inode_snapshots to recover moved or
+    deleted files, except for those that backups maps to a (strategy,
+    reference) pair. Only paths within scopes, the SnapshotScopes that the
+    snapshot was taken with, are touched."""
+    with get_metrics().timer('pmatic_restore_seconds'):
+        restore_files(snapshot_dict, context_path, scopes, backups)
+
+
+def restore_files(snapshot_dict, context_path, scopes, backups):
+    assert isinstance(snapshot_dict, dict)
+    backups = backups or {}
+    hard_links = (HardLinkStrategy(context_path), None)
+    current_scan = {}
+    with get_metrics().timer('pmatic_scan_seconds', operation='restore'):
+        for scope in scopes or [None]:
+            current_scan.update(scan_directory(context_path, scope=scope))
+    # Delete anything new.
+    trash_can = TrashCan(context_path)
+    items_to_check = list(sorted(current_scan.items()))
+    for key, record in items_to_check:
+        matching_record = snapshot_dict.get(key)  # None if not found
+        strategy, reference = backups.get(key, hard_links)
+        if not strategy.is_unchanged(key, matching_record, reference,
+                                     record):
+            path = os.path.join(context_path, key)
+            if os.path.lexists(path):
+                trash_can.trash(key)
+    # Restore anything old.
+    for key, record in sorted(snapshot_dict.items()):
+        format, mode, size, inode, symlink = record
+        path = os.path.join(context_path, key)
+        if not os.path.exists(path):
+            if format == 'DIR':
+                os.mkdir(path)
+            elif format == 'LNK':
+                os.symlink(symlink, path)
+            else:
+                strategy, reference = backups.get(key, hard_links)
+                strategy.restore(key, record, reference)
+        lchmod(path, mode)
+
+
+def merge_snapshots(started_events, strategies):
+    """Combine the snapshots of started_events, oldest first, into one that
+    describes the state before the oldest of them. Each path comes from the
+    oldest snapshot whose scope covers it, since no earlier run changed it.
+    Return the snapshot, the (strategy, reference) backups of its paths
+    that are not simply hard linked, and the distinct scopes of the
+    events."""
+    snapshot = {}
+    backups = {}
+    scopes = []
+    for event in started_events:
+        scope = SnapshotScope.from_data(getattr(event, 'snapshot_scope', None))
+        if scope.to_data() in [seen.to_data() for seen in scopes]:
+            continue  # covered entirely by an older snapshot
+        event_backups = snapshot_backups(event, strategies)
+        for key, record in event.snapshot.iteritems():
+            if not any(seen.covers(key, record[0] == 'DIR')
+                       for seen in scopes):
+                snapshot[key] = record
+                if key in event_backups:
+                    backups[key] = event_backups[key]
+        scopes.append(scope)
+    return snapshot, backups, scopes
+
+
+def snapshot_backups(event, strategies):
+    """Return a dict of path:(strategy, reference) for the files of the
+    snapshot of event that strategies with a field backed up."""
+    backups = {}
+    for strategy in strategies:
+        if strategy.field:
+            for key, reference in getattr(event, strategy.field,
+                                          {}).iteritems():
+                backups[key] = strategy, reference
+    return backups
+
+
+def is_pipeline_start(event):
+    """Return True for the started event of a pipeline being run, as
+    opposed to one of its steps or a later attempt of a retried run."""
+    return (event.what == 'started' and not getattr(event, 'depth', 0) and
+            not is_retry(event))
+
+
+def is_retry(event):
+    return getattr(event, 'attempt', 1) > 1
+
+
+def is_run_start(event):
+    """Like is_pipeline_start, but excluding checkpoints, which cannot be
+    reverted."""
+    return is_pipeline_start(event) and hasattr(event, 'snapshot')
+
+
+def strip_permissions(record):
+    if record == None:
+        result = None
+    else:
+        format, mode, size, inode, symlink = record
+        result = format, size, inode, symlink
+    return result
+
+
+def create_snapshot(context_path, scope=None, strategy=None):
+    """Prepare to restore the state of the working directory later: Back up
+    all but symlinks and directories with strategy, a SnapshotStrategy,
+    falling back to hard links in ./.pmatic/inode_snapshots (the default).
+    Make the regular files read-only unless the strategy allows changing
+    them in place. Return the dict returned by scan_directory, and a dict
+    of the references to record in the started event field of strategy."""
+    metrics = get_metrics()
+    with metrics.timer('pmatic_snapshot_seconds'):
+        result, references = snapshot_files(context_path, scope, strategy)
+    metrics.observe('pmatic_snapshot_bytes',
+                    sum(record[2] for record in result.itervalues()
+                        if record[0] == 'REG'))
+    return result, references
+
+
+def snapshot_files(context_path, scope, strategy):
+    with get_metrics().timer('pmatic_scan_seconds', operation='snapshot'):
+        result = scan_directory(context_path, scope=scope)
+    hard_links = HardLinkStrategy(context_path)
+    strategy = strategy or hard_links
+    references = {}
+    for key, record in result.iteritems():
+        path = os.path.join(context_path, key)
+        assert os.path.exists(path)
+        format, mode, size, inode, symlink = record
+        if format in ('DIR', 'LNK'):
+            continue
+        reference = None
+        if format == 'REG' and strategy.field:
+            reference = strategy.back_up(key, record)
+        if reference is None:
+            hard_links.back_up(key, record)
+        else:
+            references[key] = reference
+        if format == 'REG' and (reference is None or strategy.read_only):
+            new_mode = mode & 07555  # TODO: may not be portable
+            lchmod(path, new_mode)
+    strategy.finish(references)
+    return result, references
+
+
+class SnapshotStrategy(object):
+    """How snapshots back up the files of a context, and how reverting gets
+    them back. Strategies other than HardLinkStrategy keep a reference to
+    the backup of each file in the started event, in the field that they
+    name; any file that they cannot back up is hard linked instead."""
+    __metaclass__ = abc.ABCMeta
+    name = None
+    field = None  # of started events: path -> reference
+    read_only = True  # True if backed up files must not change in place
+
+    def __init__(self, context_path):
+        super(SnapshotStrategy, self).__init__()
+        self.context_path = context_path
+
+    def is_supported(self):
+        """Return True if this strategy can take snapshots here."""
+        return True
+
+    def is_available(self):
+        """Return True if snapshots taken by this strategy can be restored
+        here."""
+        return True
+
+    @abc.abstractmethod
+    def back_up(self, key, record):
+        """Back up the file at key, described by its scan record. Return
+        the reference to record, or None if there is none."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def restore(self, key, record, reference):
+        """Bring back the file at key, which does not exist."""
+        raise NotImplementedError
+
+    def is_unchanged(self, key, record, reference, current_record):
+        """Return True if current_record shows the file at key to be the
+        one that was backed up, with the snapshot record record (or None)."""
+        return strip_permissions(record) == strip_permissions(current_record)
+
+    def finish(self, references):
+        """Called once a snapshot has been taken."""
+
+    def prune(self, events, strategies):
+        """Delete backups that no snapshot in events refers to. strategies
+        are every strategy that events may use."""
+
+
+class HardLinkStrategy(SnapshotStrategy):
+    """Hard links in ./.pmatic/inode_snapshots, named by inode number. They
+    share their contents with the working files, which is why those are
+    made read-only."""
+    name = 'hard-link'
+
+    def __init__(self, context_path):
+        super(HardLinkStrategy, self).__init__(context_path)
+        self.inode_dir = os.path.join(meta_path(context_path),
+                                      'inode_snapshots')
+
+    def back_up(self, key, record):
+        format, mode, size, inode, symlink = record
+        path = os.path.join(self.context_path, key)
+        ensure_directory_exists(self.inode_dir, os.makedirs)
+        inode_file = os.path.join(self.inode_dir, str(inode))
+        if os.path.exists(inode_file):
+            if not os.path.samefile(path, inode_file):
+                os.remove(inode_file)
+        if not os.path.exists(inode_file):
+            os.link(path, inode_file)
+        return None
+
+    def restore(self, key, record, reference):
+        format, mode, size, inode, symlink = record
+        os.link(os.path.join(self.inode_dir, str(inode)),
+                os.path.join(self.context_path, key))
+
+    def prune(self, events, strategies):
+        if not os.path.isdir(self.inode_dir):
+            return
+        keep = set()
+        for event in events:
+            backups = snapshot_backups(event, strategies)
+            for key, record in getattr(event, 'snapshot', {}).iteritems():
+                format, mode, size, inode, symlink = record
+                if format not in ('DIR', 'LNK') and key not in backups:
+                    keep.add(str(inode))
+        for name in os.listdir(self.inode_dir):
+            if name not in keep:
+                os.remove(os.path.join(self.inode_dir, name))
+
+
+class ObjectStoreStrategy(SnapshotStrategy):
+    """Hard links in the ObjectStore shared by every context, referenced by
+    digest. Files are restored from the store as copies."""
+    name = 'object-store'
+    field = 'snapshot_objects'
+
+    def __init__(self, context_path, object_store):
+        super(ObjectStoreStrategy, self).__init__(context_path)
+        self.object_store = object_store
+
+    def is_supported(self):
+        return bool(self.object_store)
+
+    is_available = is_supported
+
+    def back_up(self, key, record):
+        return self.object_store.store(os.path.join(self.context_path, key))
+
+    def restore(self, key, record, reference):
+        """Clone or copy the object, rather than linking it, since the
+        restored file gets back its writable mode and must not share its
+        contents with the store, or with other contexts."""
+        object_path = self.object_store.object_path(reference)
+        path = os.path.join(self.context_path, key)
+        try:
+            clone_file(object_path, path)
+        except EnvironmentError:
+            with open(object_path, 'rb') as fin:
+                with open(path, 'wb') as fout:
+                    copy_file_data(fin.fileno(), fout.fileno())
+        st = os.stat(object_path)
+        os.utime(path, (st.st_atime, st.st_mtime))
+
+    def finish(self, references):
+        self.object_store.commit()
+        if references:
+            self.object_store.add_refs(self.context_path,
+                                       references.values())
+
+    def prune(self, events, strategies):
+        if self.object_store:
+            digests = set()
+            for event in events:
+                digests.update(getattr(event, self.field, {}).values())
+            self.object_store.write_refs(self.context_path, digests)
+
+
+class ReflinkStrategy(SnapshotStrategy):
+    """Copy-on-write clones in ./.pmatic/reflink_snapshots, made with the
+    FICLONE ioctl of filesystems like btrfs and XFS. Cloning copies only
+    metadata, and the working files stay writable. Each clone is named by
+    the inode, size and mtime of the file it was cloned from, so files
+    that have not changed are not cloned again, and files changed in place
+    are told apart."""
+    name = 'reflink'
+    field = 'snapshot_clones'
+    read_only = False
+
+    def __init__(self, context_path):
+        super(ReflinkStrategy, self).__init__(context_path)
+        self.clone_dir = os.path.join(meta_path(context_path),
+                                      'reflink_snapshots')
+        self.supported = None
+
+    def is_supported(self):
+        """Try cloning a small file."""
+        if self.supported is None:
+            probe_path = os.path.join(meta_path(self.context_path),
+                                      'reflink_probe')
+            remove_if_exists(probe_path)
+            remove_if_exists(probe_path + '.clone')
+            with open(probe_path, 'w') as f:
+                f.write('probe\n')
+            try:
+                clone_file(probe_path, probe_path + '.clone')
+                self.supported = True
+            except EnvironmentError:
+                self.supported = False
+            remove_if_exists(probe_path)
+            remove_if_exists(probe_path + '.clone')
+        return self.supported
+
+    def make_reference(self, path):
+        st = os.stat(path)
+        return '%d-%d-%r' % (st.st_ino, st.st_size, st.st_mtime)
+
+    def back_up(self, key, record):
+        path = os.path.join(self.context_path, key)
+        reference = self.make_reference(path)
+        clone_path = os.path.join(self.clone_dir, reference)
+        if not os.path.exists(clone_path):
+            ensure_directory_exists(self.clone_dir)
+            temp_path = clone_path + '.tmp'
+            remove_if_exists(temp_path)
+            try:
+                clone_file(path, temp_path)
+            except EnvironmentError:
+                return None
+            os.rename(temp_path, clone_path)
+        return reference
+
+    def restore(self, key, record, reference):
+        path = os.path.join(self.context_path, key)
+        clone_file(os.path.join(self.clone_dir, reference), path)
+        mtime = float(reference.rsplit('-', 1)[1])
+        os.utime(path, (mtime, mtime))
+
+    def is_unchanged(self, key, record, reference, current_record):
+        if not record or not current_record or current_record[0] != 'REG':
+            return False
+        path = os.path.join(self.context_path, key)
+        return self.make_reference(path) == reference
+
+    def prune(self, events, strategies):
+        if not os.path.isdir(self.clone_dir):
+            return
+        keep = set()
+        for event in events:
+            keep.update(getattr(event, self.field, {}).values())
+        for name in os.listdir(self.clone_dir):
+            if name not in keep:
+                os.remove(os.path.join(self.clone_dir, name))
+
+
+def clone_file(source_path, dest_path):
+    """Create dest_path as a copy-on-write clone of source_path. Raises
+    IOError or OSError where the filesystem cannot clone."""
+    import fcntl
+    with open(source_path, 'rb') as fin:
+        fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        try:
+            fcntl.ioctl(fd, FICLONE, fin.fileno())
+        except EnvironmentError:
+            os.close(fd)
+            os.remove(dest_path)
+            raise
+        os.close(fd)
+
+
+def scan_directory(start_path, *exclude_paths, **kwds):
+    """Return dict path:(format, mode, size, inode, symlink).
+    exclude_paths (default '.pmatic') will not be scanned. Neither will
+    paths outside of scope, a SnapshotScope that defaults to the patterns
+    of the .pmaticignore file in start_path."""
+    if not exclude_paths:
+        exclude_paths = (META_DIR_NAME, TRASH_DIR_NAME)
+    scope = kwds.pop('scope', None) or SnapshotScope.load(start_path)
+    assert not kwds, 'unexpected arguments %r' % sorted(kwds)
+    result = {}
+    if scope.paths is None:
+        top_paths = [start_path]
+    else:
+        top_paths = []
+        for key in scope.paths:
+            path = os.path.join(start_path, key)
+            if not os.path.lexists(path) or scope.ignores(
+                    key, os.path.isdir(path)):
+                continue
+            key, format, mode, size, inode, symlink = stat_item(
+                key, start_path, start_path
+            )
+            if format == 'DIR':
+                result[key] = format, mode, size, inode, None
+                top_paths.append(path)
+            else:
+                result[key] = format, mode, size, inode, symlink
+    for top_path in top_paths:
+        for dir_path, dir_names, file_names in os.walk(top_path):
+            remove_dir_names = []
+            for dir_name in dir_names:
+                key, format, mode, size, inode, symlink = stat_item(
+                    dir_name, dir_path, start_path
+                )
+                if key in exclude_paths or scope.ignores(key, True):
+                    remove_dir_names.append(dir_name)
+                    continue
+                result[key] = format, mode, size, inode, None
+            for dir_name in remove_dir_names:
+                dir_names.remove(dir_name)
+            for file_name in file_names:
+                key, format, mode, size, inode, symlink = stat_item(
+                    file_name, dir_path, start_path
+                )
+                if scope.ignores(key, False):
+                    continue
+                result[key] = format, mode, size, inode, symlink
+    return result
+
+
+class SnapshotScope(object):
+    """The part of a context that snapshots cover. ignore_patterns are
+    lines of a .pmaticignore file, gitignore-style globs: a pattern with a
+    slash matches paths from the top of the context, one without matches
+    names at any depth, a trailing slash matches only directories, and a
+    leading ! re-includes what an earlier pattern ignored. The contents of
+    ignored directories are not scanned at all. If paths is not None, only
+    those paths (and the contents of those that are directories) are
+    covered, which is how pipelines with "snapshot: outputs" limit their
+    snapshots to what they declare that they write."""
+    def __init__(self, ignore_patterns=(), paths=None):
+        import fnmatch
+        import re
+        super(SnapshotScope, self).__init__()
+        self.ignore_patterns = []
+        self.rules = []
+        for line in ignore_patterns:
+            pattern = line.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            self.ignore_patterns.append(pattern)
+            negate = pattern.startswith('!')
+            pattern = pattern.lstrip('!')
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            anchored = '/' in pattern
+            regex = re.compile(fnmatch.translate(pattern.lstrip('/')))
+            self.rules.append((regex, negate, dir_only, anchored))
+        self.paths = None if paths is None else sorted(set(paths))
+
+    @classmethod
+    def load(cls, context_path, paths=None):
+        """Read context_path/.pmaticignore, if any. paths may be absolute
+        or relative to context_path; those outside of it are dropped."""
+        ignore_path = os.path.join(context_path, IGNORE_FILE_NAME)
+        ignore_patterns = []
+        if os.path.isfile(ignore_path):
+            with open(ignore_path) as f:
+                ignore_patterns = f.read().splitlines()
+        if paths is not None:
+            keys = (os.path.relpath(os.path.join(context_path, path),
+                                    context_path) for path in paths if path)
+            paths = [key for key in keys
+                     if key != os.curdir and
+                     not key.startswith(os.pardir + os.sep)]
+        return cls(ignore_patterns, paths)
+
+    @classmethod
+    def from_data(cls, data):
+        """Rebuild the scope recorded by a started event. Events from before
+        scopes were recorded covered everything."""
+        data = data or {}
+        return cls(data.get('ignore', ()), data.get('paths'))
+
+    def to_data(self):
+        """Return a dict for the started event, or None if this scope covers
+        everything."""
+        data = {}
+        if self.ignore_patterns:
+            data['ignore'] = list(self.ignore_patterns)
+        if self.paths is not None:
+            data['paths'] = list(self.paths)
+        return data or None
+
+    def covers(self, key, is_dir):
+        """Return True if snapshots with this scope record the path key."""
+        if self.paths is not None and not any(
+                key == path or key.startswith(path + os.sep)
+                for path in self.paths):
+            return False
+        parts = key.split(os.sep)
+        return not any(self.ignores(os.sep.join(parts[:index]),
+                                    is_dir or index < len(parts))
+                       for index in range(1, len(parts) + 1))
+
+    def ignores(self, key, is_dir):
+        """Return True if the path key, relative to the context, matches
+        the ignore patterns. The last matching pattern decides."""
+        ignored = False
+        name = os.path.basename(key)
+        for regex, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(key if anchored else name):
+                ignored = not negate
+        return ignored
+
+
+def stat_item(file_name, dir_path, base_path):
+    path = os.path.join(dir_path, file_name)
+    st = os.lstat(path)
+    format_code = stat.S_IFMT(st.st_mode)
+    format = decode_format(format_code)
+    mode = stat.S_IMODE(st.st_mode)
+    size = st.st_size if format in ('REG', 'LNK') else 0L
+    inode = st.st_ino if format not in ('DIR', 'LNK') else 0L
+    symlink = os.readlink(path) if format == 'LNK' else None
+    key = os.path.relpath(path, base_path)
+    return key, format, mode, size, inode, symlink
+
+
+def decode_format(format_code):
+    format = None
+    for test_fcn, name in STAT_TESTS:
+        if test_fcn(format_code):
+            assert format is None, 'A file can only have one type.'
+            format = name
+    assert format, 'A filesystem object must have some type'
+    return format
+
+
+def lchmod(path, mode):
+    """If path is not a symlink, do a regular chmod. If path is a symlink
+    and os.lchmod is available, do os.lchmod. If path is a symlink and
+    os.lchmod is not available, do nothing."""
+    if os.path.islink(path):
+        if hasattr(os, 'lchmod'):
+            os.lchmod(path, mode)
+    else:
+        os.chmod(path, mode)
+
+
+class TrashCan(object):
+    """A place to move files, prior to deleting them."""
+    def __init__(self, context_path):
+        from datetime import datetime
         self.context_path = context_path
         self.trash_path = os.path.join(context_path, TRASH_DIR_NAME,
                                        datetime.utcnow().isoformat())
@@ -622,6 +4414,214 @@ class TrashCan(object):
             os.rename(abs_path, dest_path)
 
 
+class Metrics(object):
+    """Counters and histograms of engine internals. Each process adds up
+    its own, then merges them, under flock, into the JSON state that all
+    pmatic processes share in metrics_dir, and renders the totals as a
+    Prometheus textfile-collector file (pmatic.prom). Merging happens at
+    most every interval seconds while metrics are updated, and at exit.
+    Without a metrics_dir ($PMATIC_METRICS_DIR), nothing is written."""
+    STATE_FILE_NAME = 'pmatic-metrics.json'
+    LOCK_FILE_NAME = 'pmatic-metrics.lock'
+    TEXT_FILE_NAME = 'pmatic.prom'
+
+    def __init__(self, metrics_dir=None, interval=15.0):
+        import threading
+        import time
+        super(Metrics, self).__init__()
+        self.metrics_dir = metrics_dir
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> bucket counts + [sum]
+        self.last_flush = time.time()
+        self.exit_hook = False
+
+    def increment(self, name, amount=1, **labels):
+        """Add amount to a counter. Labels are sorted (name, value) pairs
+        in keys, with values as strings."""
+        assert METRIC_DEFINITIONS[name][1] is None, name
+        key = (name, metric_labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+        self.updated()
+
+    def observe(self, name, value, **labels):
+        """Count value in the histogram name."""
+        import bisect
+        buckets = METRIC_DEFINITIONS[name][1]
+        key = (name, metric_labels(labels))
+        with self.lock:
+            counts = self.histograms.setdefault(key,
+                                                [0] * (len(buckets) + 2))
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+        self.updated()
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Context manager that observes the seconds its body takes."""
+        import time
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def updated(self):
+        import time
+        if not self.metrics_dir:
+            return
+        if not self.exit_hook:
+            import atexit
+            atexit.register(self.flush)
+            self.exit_hook = True
+        if time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Merge what this process has counted since the last flush into
+        the shared state, and rewrite the textfile."""
+        import fcntl
+        import json
+        import time
+        if not self.metrics_dir:
+            return
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            histograms, self.histograms = self.histograms, {}
+            self.last_flush = time.time()
+        ensure_directory_exists(self.metrics_dir, os.makedirs)
+        state_path = os.path.join(self.metrics_dir, self.STATE_FILE_NAME)
+        lock_path = os.path.join(self.metrics_dir, self.LOCK_FILE_NAME)
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # released by closing
+            state = self.read_state(state_path)
+            for key, value in counters.iteritems():
+                state['counters'][key] = (state['counters'].get(key, 0) +
+                                          value)
+            for key, counts in histograms.iteritems():
+                total = state['histograms'].get(key, [0] * len(counts))
+                state['histograms'][key] = [a + b for a, b
+                                            in zip(total, counts)]
+            write_file_atomically(state_path, json.dumps(dict(
+                (kind, [[name, labels, value] for (name, labels), value
+                        in sorted(series.iteritems())])
+                for kind, series in state.iteritems()
+            )))
+            write_file_atomically(
+                os.path.join(self.metrics_dir, self.TEXT_FILE_NAME),
+                format_metrics(state['counters'], state['histograms'])
+            )
+
+    @staticmethod
+    def read_state(state_path):
+        """Return dict(counters={...}, histograms={...}) from state_path."""
+        import json
+        state = dict(counters={}, histograms={})
+        if os.path.isfile(state_path):
+            with open(state_path) as fin:
+                data = json.load(fin)
+            for kind, series in data.iteritems():
+                for name, labels, value in series:
+                    key = (str(name), tuple((str(label), str(text))
+                                            for label, text in labels))
+                    state[kind][key] = value
+        return state
+
+
+DURATION_BUCKETS = [0.001, 0.01, 0.1, 1, 10, 60, 600, 3600]
+SIZE_BUCKETS = [1024 * 4 ** n for n in xrange(11)]  # 1K to 1T
+METRIC_DEFINITIONS = {  # name -> (help, buckets or None for a counter)
+    'pmatic_runs_total': ('Pipelines run by the engine, by result.', None),
+    'pmatic_run_seconds': ('Duration of engine runs.', DURATION_BUCKETS),
+    'pmatic_events_total': ('Events recorded, by kind.', None),
+    'pmatic_step_failures_total': ('Failed events, by exit code.', None),
+    'pmatic_event_log_read_seconds': ('Time to read an event log.',
+                                      DURATION_BUCKETS),
+    'pmatic_event_log_flush_seconds': ('Time to write events and head.',
+                                       DURATION_BUCKETS),
+    'pmatic_scan_seconds': ('Time to scan a context, by operation.',
+                            DURATION_BUCKETS),
+    'pmatic_snapshot_seconds': ('Time to take a snapshot.',
+                                DURATION_BUCKETS),
+    'pmatic_snapshot_bytes': ('Size of the regular files in a snapshot.',
+                              SIZE_BUCKETS),
+    'pmatic_restore_seconds': ('Time to restore a snapshot.',
+                               DURATION_BUCKETS),
+    'pmatic_dependency_failures_total': ('Failed dependency checks, by '
+                                         'check.', None),
+}
+
+
+def metric_labels(labels):
+    return tuple(sorted((name, str(value))
+                        for name, value in labels.iteritems()))
+
+
+def format_metrics(counters, histograms):
+    """Return counters and histograms, dicts keyed by (name, labels), in
+    the Prometheus text exposition format."""
+    lines = []
+    for name in sorted(METRIC_DEFINITIONS):
+        help_text, buckets = METRIC_DEFINITIONS[name]
+        series = sorted((labels, value) for (metric, labels), value
+                        in (histograms if buckets else counters).iteritems()
+                        if metric == name)
+        if not series:
+            continue
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, buckets and 'histogram' or
+                                       'counter'))
+        for labels, value in series:
+            if not buckets:
+                lines.append('%s%s %s' % (name, format_metric_labels(labels),
+                                          format_metric_value(value)))
+                continue
+            count = 0
+            for bound, bucket_count in zip(buckets + ['+Inf'], value):
+                count += bucket_count
+                lines.append('%s_bucket%s %d' % (
+                    name, format_metric_labels(
+                        labels + (('le', format_metric_value(bound)),)
+                    ), count
+                ))
+            lines.append('%s_sum%s %s' % (name, format_metric_labels(labels),
+                                          format_metric_value(value[-1])))
+            lines.append('%s_count%s %d' % (name,
+                                            format_metric_labels(labels),
+                                            count))
+    return ''.join(line + '\n' for line in lines)
+
+
+def format_metric_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, value.replace('\\', r'\\').replace('"', r'\"')
+                     .replace('\n', r'\n'))
+        for name, value in labels
+    )
+
+
+def format_metric_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+_metrics = None
+
+
+def get_metrics():
+    """Return the Metrics of this process, writing to
+    $PMATIC_METRICS_DIR if that is set."""
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics(os.environ.get(METRICS_DIR_VARIABLE))
+    return _metrics
+
+
 def fail_dependencies(dependency_finder, unlisted, missing, bad_type):
     if unlisted:
         print_err('The following dependencies are not listed in %s:',
@@ -663,9 +4663,136 @@ def gen_uuid_str():
     Nice hook for testing. For testing, you can replace this function
     by the bound next() method of some iterator. Example:
     pmatic.gen_uuid_str = iter([uuid1, uuid2, uuid3]).next"""
+    import uuid
     return str(uuid.uuid1())
 
 
+def remove_if_exists(path):
+    """Remove the file at path, unless it is already gone."""
+    try:
+        os.remove(path)
+    except OSError:
+        if os.path.lexists(path):
+            raise
+
+
+@contextlib.contextmanager
+def no_reservation():
+    """Stands in for LocalScheduler.reserve() when there is no scheduler."""
+    yield
+
+
+def parse_size(size):
+    """Return a number of bytes from an int, or from a string like 512M or
+    1.5G, or None if not size."""
+    if not size:
+        return None
+    if isinstance(size, basestring):
+        units = 'KMGTP'
+        size = size.strip().upper().rstrip('B')
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * 1024 ** (units.index(size[-1]) + 1))
+    return int(size)
+
+
+def parse_params(pairs):
+    """Return a dict from command line arguments like KEY=VALUE."""
+    params = {}
+    for pair in pairs:
+        key, equals, value = pair.partition('=')
+        if not equals or not key:
+            fail('Expected KEY=VALUE, not %r', pair)
+        params[key] = value
+    return params
+
+
+def compile_templates(value):
+    """Return a copy of value (nested lists and dicts) with every string
+    that mentions a parameter, as ${name}, replaced by a Template."""
+    if isinstance(value, basestring) and Template.pattern.search(value):
+        return Template(value)
+    elif isinstance(value, list):
+        return [compile_templates(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((key, compile_templates(item))
+                    for key, item in value.iteritems())
+    return value
+
+
+def expand_templates(value, mapping):
+    """Inverse of compile_templates, substituting values from mapping."""
+    if isinstance(value, Template):
+        return value.substitute(mapping)
+    elif isinstance(value, list):
+        return [expand_templates(item, mapping) for item in value]
+    elif isinstance(value, dict):
+        return dict((key, expand_templates(item, mapping))
+                    for key, item in value.iteritems())
+    return value
+
+
+def template_names(value):
+    """Return the set of parameter names mentioned by templates in value."""
+    if isinstance(value, Template):
+        return set(value.names)
+    names = set()
+    if isinstance(value, dict):
+        value = value.values()
+    if isinstance(value, list):
+        for item in value:
+            names.update(template_names(item))
+    return names
+
+
+class Template(object):
+    """A string mentioning parameters as ${name}, parsed once into literal
+    text and names. Every other $ is literal, as in '{print $1}' or $HOME,
+    and $${name} stands for a literal ${name}."""
+    pattern = re.compile(r'\$(?P<escaped>\$?)\{(?P<name>[_a-z][_a-z0-9]*)\}',
+                         re.IGNORECASE)
+
+    def __init__(self, text):
+        super(Template, self).__init__()
+        self.text = text
+        parts = []  # literal, name, literal, ..., literal
+        literal = []
+        position = 0
+        for match in self.pattern.finditer(text):
+            literal.append(text[position:match.start()])
+            position = match.end()
+            if match.group('escaped'):
+                literal.append(match.group()[1:])
+            else:
+                parts.append(''.join(literal))
+                parts.append(match.group('name'))
+                literal = []
+        literal.append(text[position:])
+        parts.append(''.join(literal))
+        self.parts = parts
+        self.names = frozenset(parts[1::2])
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.text)
+
+    def substitute(self, mapping):
+        parts = list(self.parts)
+        for index in xrange(1, len(parts), 2):
+            parts[index] = str(mapping[parts[index]])
+        return ''.join(parts)
+
+
+def version_map(item, key):
+    """Return the versions listed under key in an item of a sequence file.
+    Also accepts the versions as siblings of key, which is how YAML reads
+    them when they are indented no deeper than key."""
+    versions = item[key]
+    if versions is None:
+        versions = dict(item)
+        del versions[key]
+    return dict((name, str(version))
+                for name, version in versions.iteritems())
+
+
 def ensure_directory_exists(dir_path, create_fcn=os.mkdir):
     """Create the specified directory if it is missing.
     create_fcn defaults to os.mkdir."""
@@ -673,16 +4800,93 @@ def ensure_directory_exists(dir_path, create_fcn=os.mkdir):
         create_fcn(dir_path)
 
 
+def load_config(pmatic_base, file_name):
+    """Return the dict in the optional YAML file_name in pmatic_base."""
+    if pmatic_base:
+        config_path = os.path.join(pmatic_base, file_name)
+        if os.path.isfile(config_path):
+            return load_yaml_file(config_path) or {}
+    return {}
+
+
 def load_yaml_file(yaml_file_path):
     """Return YAML data in yaml_file_path."""
+    import yaml
     with open(yaml_file_path) as fin:
         return yaml.load(fin)
 
 
 def save_yaml_file(yaml_file_path, data):
     with open(yaml_file_path, 'w') as fout:
-        # Use safe_dump to supress non-standard tags:
-        yaml.safe_dump(data, fout, default_flow_style=False)
+        fout.write(format_yaml(data))
+
+
+def format_yaml(data):
+    import yaml
+    # Use safe_dump to supress non-standard tags:
+    return yaml.safe_dump(data, default_flow_style=False)
+
+
+def write_and_rename(temp_path, file_path, text, sync=False):
+    """Write text to temp_path, then rename it to file_path. If sync, the
+    data reaches the disk before the rename, which the caller makes
+    durable with sync_directory."""
+    with open(temp_path, 'w') as fout:
+        fout.write(text)
+        if sync:
+            fout.flush()
+            os.fsync(fout.fileno())
+    os.rename(temp_path, file_path)
+
+
+def sync_directory(dir_path):
+    """fsync a directory, making the renames into it durable."""
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_file_atomically(file_path, text):
+    """Replace file_path with text, so that readers see all or nothing."""
+    temp_path = '%s.%d.tmp' % (file_path, os.getpid())
+    with open(temp_path, 'w') as fout:
+        fout.write(text)
+    os.rename(temp_path, file_path)
+
+
+def format_head_record(event, status_event=None):
+    """Return the contents of a head file pointing at event (or None), with
+    the status taken from status_event (default event)."""
+    if event is None:
+        return '\n'
+    status_event = status_event or event
+    fields = [event.id, status_event.what, status_event.pipeline_name,
+              status_event.when.isoformat()]
+    return '\t'.join(fields) + '\n'
+
+
+def find_status_event(events):
+    """Return the first top-level (not step) event in events, newest first.
+    Its what is the status of the context."""
+    for event in events:
+        if not getattr(event, 'depth', 0):
+            return event
+    return None
+
+
+def parse_head_record(line):
+    """Inverse of format_head_record. Also accepts the first line of a head
+    file written as YAML by earlier versions."""
+    if '\t' in line:
+        return Namespace(**dict(zip(HEAD_FIELDS, line.split('\t'))))
+    event_id = line.strip().strip('\'"')
+    if event_id in ('', 'null', '~', '...'):
+        return None
+    fields = dict.fromkeys(HEAD_FIELDS)
+    fields['id'] = event_id
+    return Namespace(**fields)
 
 
 @contextlib.contextmanager
@@ -707,6 +4911,10 @@ def deployment_file_path(pmatic_base):
     return os.path.join(pmatic_base, 'deployments.yaml')
 
 
+def catalog_file_path(pmatic_base):
+    return os.path.join(pmatic_base, CATALOG_FILE_NAME)
+
+
 def pipeline_path(pmatic_base, pipeline_name):
     """Return the path to the specified pipeline."""
     return os.path.join(pmatic_base, 'pipelines', pipeline_name + '.yaml')
@@ -747,7 +4955,7 @@ class Namespace(collections.Mapping):
         self.mapping[key] = value
 
     def __delitem__(self, key):
-        del self.mapping
+        del self.mapping[key]
 
     def __contains__(self, key):
         return key in self.mapping
@@ -760,36 +4968,62 @@ class Namespace(collections.Mapping):
 
 
 class ChainMap(collections.Mapping):
-    """Simple wrapper around a list of dicts. Last wins. Modifications apply
-    to the possibly empty kwds mapping."""
+    """Stack of dicts. Last wins. Modifications apply to the possibly empty
+    kwds mapping, or to the mapping pushed last. Reads go through a
+    flattened copy, which is rebuilt only after the version changes. Every
+    change made through the ChainMap bumps the version, so the mappings
+    must not be changed behind its back."""
     def __init__(self, *mappings, **kwds):
         super(ChainMap, self).__init__()
         self.mappings = list(mappings)
         self.mappings.append(kwds)
+        self.version = 0
+        self.flat = None
+        self.flat_version = None
 
     def __repr__(self):
         return "%s(%r)" % (type(self).__name__, self.mappings)
 
+    def get_flat(self):
+        """Return a dict merging all of the mappings."""
+        if self.flat_version != self.version:
+            flat = {}
+            for mapping in self.mappings:
+                flat.update(mapping)
+            self.flat = flat
+            self.flat_version = self.version
+        return self.flat
+
+    def push(self, mapping=None):
+        """Put a new mapping on top of the stack, to receive changes."""
+        self.mappings.append({} if mapping is None else mapping)
+        self.version += 1
+
+    def pop(self):
+        """Remove and return the mapping on top of the stack."""
+        assert len(self.mappings) > 1, 'cannot pop the last mapping'
+        self.version += 1
+        return self.mappings.pop()
+
     def __getitem__(self, key):
-        for mapping in self.mappings[::-1]:
-            if key in mapping:
-                return mapping[key]
-        raise KeyError(key)
+        return self.get_flat()[key]
 
     def __setitem__(self, key, value):
         self.mappings[-1][key] = value
+        if self.flat_version == self.version:
+            self.flat[key] = value  # Still up to date.
+            self.flat_version += 1
+        self.version += 1
 
     def __delitem__(self, key):
         del self.mappings[-1][key]
+        self.version += 1
 
     def __contains__(self, key):
-        for mapping in self.mappings:
-            if key in mapping:
-                return True
-        return False
+        return key in self.get_flat()
 
     def __iter__(self):
-        return iter(set(itertools.chain(*self.mappings)))
+        return iter(self.get_flat())
 
     def __len__(self):
-        return len(set(itertools.chain(*self.mappings)))
+        return len(self.get_flat())
@@ -18,11 +18,17 @@
 # You should have received a copy of the GNU General Public License
 # along with Pipe-o-matic.  If not, see <http://www.gnu.org/licenses/>.
 
+import datetime
+import hashlib
+import itertools
 import os
 import pprint
 import shutil
 import stat
+import subprocess
 import sys
+import threading
+import time
 import unittest
 
 import pmatic
@@ -179,6 +185,502 @@ class TestSingleTaskPipeline(unittest.TestCase):
         self.assertEqual(scan1, scan3)
         pprint.pprint(scan3)
 
+    def test_revert_to(self):
+        write_file('foo-input', 'hello\nworld')
+        write_probe('''#!/usr/bin/env bash
+                    echo hello world from probe! | tee bar
+                    mv eggs eggs2
+                    rm foo/spam''')
+        namespace = pmatic.Namespace()
+        self.pipeline_loader.load_pipeline('bar-1').run(namespace)
+        target_id = self.event_log.event_data[0].id
+        scan1 = pmatic.scan_directory(self.test_dir)
+        self.pipeline_loader.load_pipeline('foo-1').run(namespace)
+        self.pipeline_loader.build_pipeline(
+            'single-task', 'run-probe-1', '1',
+            dict(executable='run-probe', version='1.0', snapshot='outputs',
+                 outputs=['bar', 'eggs', 'eggs2', 'foo/spam'])
+        ).run(namespace)
+        os.chdir('..')
+        original_scan_directory = pmatic.scan_directory
+        scans = []
+        pmatic.scan_directory = lambda *args, **kwds: (
+            scans.append(args) or original_scan_directory(*args, **kwds)
+        )
+        try:
+            pmaticrevert.main(('--to', target_id, self.test_dir))
+        finally:
+            pmatic.scan_directory = original_scan_directory
+        self.assertEqual(len(scans), 2)  # one per distinct scope
+        self.assertEqual(pmatic.scan_directory(self.test_dir), scan1)
+        event_log = pmatic.EventLog(self.test_dir)
+        event_log.read_log()
+        self.assertEqual(event_log.event_data[0].id, target_id)
+        self.assertEqual(len(os.listdir(os.path.join(self.test_dir,
+                                                     '.trash_cans'))), 1)
+        event_log.revert_steps(1)
+        self.assertFalse(event_log.event_data)
+
+    def test_snapshot_scope(self):
+        write_file('.pmaticignore', '# scratch space\nscratch/\n*.tmp\n'
+                   '!keep.tmp\n')
+        os.mkdir('scratch')
+        write_file('scratch/big', 'data')
+        write_file('a.tmp', 'tmp')
+        write_file('keep.tmp', 'tmp')
+        scan = pmatic.scan_directory(self.test_dir)
+        self.assertEqual(sorted(scan),
+                         ['.pmaticignore', 'eggs', 'foo', 'foo/spam',
+                          'keep.tmp'])
+        write_file('foo-input', 'hello\nworld')
+        pipeline = self.pipeline_loader.build_pipeline(
+            'single-task', 'foo-1', '1',
+            dict(executable='foo', version='1.0', stdin='foo-input',
+                 stdout='foo.log', snapshot='outputs')
+        )
+        self.assertTrue(pipeline.run(pmatic.Namespace()))
+        started = self.event_log.find_event('foo-1', 'started')
+        self.assertEqual(started.snapshot, {})
+        self.assertEqual(started.snapshot_scope['paths'], ['foo.log'])
+        self.assertEqual(os.stat('foo-input').st_mode & 0777, 0644)
+        write_file('scratch/new', 'untouched by revert')
+        write_file('bar', 'untouched by revert')
+        self.event_log.revert_one()
+        self.assertFalse(os.path.exists('foo.log'))
+        self.assertTrue(os.path.exists('scratch/new'))
+        self.assertTrue(os.path.exists('bar'))
+
+    def test_up_to_date(self):
+        write_file('foo-input', 'hello\nworld')
+        namespace = pmatic.Namespace()
+        pipeline = self.pipeline_loader.load_pipeline('foo-1')
+        self.assertTrue(pipeline.run(namespace))
+        original_hash_file = pmatic.hash_file
+        hashed = []
+        pmatic.hash_file = lambda path: hashed.append(path) or 'changed'
+        try:
+            self.assertFalse(pipeline.run(namespace))
+        finally:
+            pmatic.hash_file = original_hash_file
+        self.assertEqual(hashed, [])  # nothing re-read
+        event = self.event_log.event_data[0]
+        self.assertEqual(event.what, 'finished')
+        self.assertTrue(event.up_to_date)
+        self.assertTrue(pipeline.run(namespace, force=True))
+        os.remove('foo-input')
+        write_file('foo-input', 'hello\nworld!')
+        self.assertTrue(pipeline.run(namespace))
+        self.assertFalse(pipeline.run(namespace))
+        self.assertEqual(
+            [(e.what, hasattr(e, 'up_to_date'))
+             for e in self.event_log.event_data],
+            [('finished', True), ('finished', False), ('started', False),
+             ('finished', False), ('started', False), ('finished', True),
+             ('finished', False), ('started', False)]
+        )
+        bar = self.pipeline_loader.load_pipeline('run-probe-1')
+        self.assertEqual(bar.make_fingerprint(pmatic.FileHasher()), None)
+
+    def test_sequence(self):
+        write_file('foo-input', 'hello\nworld')
+        namespace = pmatic.Namespace()
+        pipeline = self.pipeline_loader.load_pipeline('sequence-1')
+        self.assertEqual(pipeline.get_dependencies(),
+                         set([('foo', '1.0', 'executable'),
+                              ('bar', '1.1', 'executable')]))
+        self.assertTrue(pipeline.run(namespace))
+        self.assertEqual(self.event_log.get_status(), 'finished')
+        self.assertEqual(self.event_log.read_head().pipeline_name,
+                         'sequence-1')
+        with open('sub_dir/intermediate_file') as fin:
+            digest = hashlib.md5(fin.read()).hexdigest()
+        with open('checksum.md5') as fin:
+            self.assertEqual(fin.read(), digest + '  -\n')
+        with open('sub_dir/copy.md5') as fin:
+            self.assertEqual(fin.read(), digest + '  -\n')
+        self.assertFalse(os.path.exists('sub_dir/checksum.md5'))
+        # Steps before the first one that must execute are skipped.
+        self.assertTrue(pipeline.run(namespace))
+        self.assertEqual(
+            [(e.pipeline_name, hasattr(e, 'up_to_date'))
+             for e in self.event_log.event_data
+             if e.what == 'finished'][:7],
+            [('sequence-1', False), ('sequence-1/6-bar', False),
+             ('sequence-1/5-mv', False), ('sequence-1/4-cp', False),
+             ('sequence-1/3-md5', True), ('sequence-1/2-foo', True),
+             ('sequence-1/1-mkdir', True)]
+        )
+        self.event_log.revert_one()
+        self.assertEqual(self.event_log.get_status(), 'finished')
+        self.assertEqual(self.event_log.event_data[0].pipeline_name,
+                         'sequence-1')
+
+    def test_pipe(self):
+        write_file('foo-input', 'hello\nworld')
+        namespace = pmatic.Namespace()
+        pipeline = self.pipeline_loader.load_pipeline('pipe-1')
+        self.assertTrue(pipeline.run(namespace))
+        with open('intermediate_file') as fin:
+            self.assertEqual(fin.read(),
+                             'inside foo\n123 abc\n     1\thello\n'
+                             '     2\tworld\n')
+            fin.seek(0)
+            digest = hashlib.md5(fin.read()).hexdigest()
+        with open('checksum.md5') as fin:
+            self.assertEqual(fin.read(), digest + '  -\n')
+        self.assertEqual(
+            [(e.pipeline_name, e.what, hasattr(e, 'snapshot'))
+             for e in self.event_log.event_data],
+            [('pipe-1', 'finished', False),
+             ('pipe-1/2-md5', 'finished', False),
+             ('pipe-1/1-foo', 'finished', False),
+             ('pipe-1/2-md5', 'started', False),
+             ('pipe-1/1-foo', 'started', False),
+             ('pipe-1', 'started', True)]
+        )
+        self.assertFalse(pipeline.run(namespace))
+
+    def test_parameters(self):
+        write_file('foo-input', 'hello')
+        write_file('bar-input', 'world')
+        pipeline = self.pipeline_loader.load_pipeline('greet-sequence-1')
+        self.assertEqual(pipeline.get_parameters(), set(['greeting', 'other']))
+        namespace = pmatic.Namespace(dict(greeting='hi', other='bar'))
+        self.assertTrue(pipeline.run(namespace))
+        with open('bar.log') as fin:
+            self.assertEqual(fin.read(),
+                             'inside foo\nhi $HOME\n     1\tworld\n')
+        self.assertTrue(os.path.isfile('foo.log'))
+        self.assertEqual(namespace, dict(greeting='hi', other='bar'))
+
+    def test_watchdog(self):
+        write_probe('''#!/usr/bin/env bash
+                    echo sleeping
+                    sleep 30''')
+        namespace = pmatic.Namespace()
+        for limits, reason in [(dict(timeout=0.5), 'timeout'),
+                               (dict(stall_timeout=0.5), 'stall')]:
+            pipeline = self.pipeline_loader.build_pipeline(
+                'single-task', 'run-probe-' + reason, '1',
+                dict(executable='run-probe', version='1.0', **limits)
+            )
+            start = time.time()
+            with self.assertRaises(pmatic.WatchdogError) as context:
+                pipeline.run(namespace)
+            self.assertLess(time.time() - start, 5)
+            self.assertEqual(context.exception.reason, reason)
+            event = self.event_log.event_data[0]
+            self.assertEqual((event.what, event.reason, event.exit_code),
+                             ('failed', reason, -15))
+            self.assertEqual(sorted(event.rusage),
+                             ['maxrss', 'stime', 'utime'])
+            self.event_log.revert_one()
+
+    def test_launchers(self):
+        write_file('probe-input', 'hello')
+        for klass in [pmatic.PopenLauncher, pmatic.SpawnLauncher,
+                      pmatic.ForkServerLauncher]:
+            launcher = klass()
+            try:
+                write_probe('''#!/usr/bin/env bash
+                            echo args "$@"
+                            cat
+                            exit 3''')
+                with open('probe-input') as fin:
+                    with open('probe.out', 'w') as fout:
+                        process = launcher.launch(['./probe', 'a b'], fin,
+                                                  fout.fileno())
+                self.assertEqual(process.wait(), 3)
+                self.assertEqual(sorted(process.rusage),
+                                 ['maxrss', 'stime', 'utime'])
+                with open('probe.out') as fin:
+                    self.assertEqual(fin.read(), 'args a b\nhello\n')
+                with self.assertRaises(OSError):
+                    launcher.launch(['./missing'])
+                write_probe('''#!/usr/bin/env bash
+                            sleep 30''')
+                pipeline = pmatic.PipelineLoader(
+                    self.pmatic_base, self.dependency_finder, self.event_log,
+                    launcher=launcher
+                ).build_pipeline('single-task', 'run-probe-' + klass.name,
+                                 '1', dict(executable='run-probe',
+                                           version='1.0', timeout=0.5))
+                with self.assertRaises(pmatic.WatchdogError) as context:
+                    pipeline.run(pmatic.Namespace())
+                self.assertEqual(context.exception.errno, -15)
+                self.event_log.revert_one()
+                launcher.close()  # and launches again after
+                self.assertEqual(launcher.launch(['/bin/true']).wait(), 0)
+            finally:
+                launcher.close()
+        self.assertFalse(pmatic.SpawnLauncher().supports(
+            pmatic.ChildLimits(memory=2 ** 30), False
+        ))
+        self.assertIsInstance(pmatic.Launcher.from_config(self.pmatic_base),
+                              pmatic.PopenLauncher)  # spawn is opt-in
+
+    def test_retry(self):
+        write_probe('''#!/usr/bin/env bash
+                    n=$(cat .pmatic/count 2>/dev/null || echo 0)
+                    echo $((n + 1)) >.pmatic/count
+                    touch attempt$n
+                    test $n -ge 1''')
+        pipeline = self.pipeline_loader.build_pipeline(
+            'single-task', 'run-probe-1', '1',
+            dict(executable='run-probe', version='1.0',
+                 retry=dict(attempts=2, backoff=0))
+        )
+        self.assertTrue(pipeline.run(pmatic.Namespace()))
+        self.assertFalse(os.path.exists('attempt0'))  # reverted
+        self.assertTrue(os.path.exists('attempt1'))
+        self.assertEqual(
+            [(e.what, getattr(e, 'attempt', 1))
+             for e in self.event_log.event_data],
+            [('finished', 2), ('started', 2), ('failed', 1), ('started', 1)]
+        )
+        first, last = (self.event_log.event_data[3],
+                       self.event_log.event_data[0])
+        model = pmatic.DurationModel.from_events(self.event_log.event_data)
+        self.assertEqual(model.estimate('run-probe-1', vars(first)),
+                         (last.when - first.when).total_seconds())
+        self.event_log.revert_steps(1)  # both attempts
+        self.assertEqual(self.event_log.get_status(), 'never_run')
+        self.assertFalse(os.path.exists('attempt1'))
+        policy = pmatic.RetryPolicy(attempts=3, exit_codes=[75],
+                                    signals=['KILL', 'SIGTERM'],
+                                    watchdog=['stall'])
+        self.assertTrue(policy.should_retry(pmatic.ExitCodeError(75, ''), 2))
+        self.assertFalse(policy.should_retry(pmatic.ExitCodeError(75, ''), 3))
+        self.assertFalse(policy.should_retry(pmatic.ExitCodeError(1, ''), 1))
+        self.assertTrue(policy.should_retry(pmatic.ExitCodeError(-9, ''), 1))
+        self.assertFalse(policy.should_retry(pmatic.ExitCodeError(-2, ''), 1))
+        self.assertFalse(policy.should_retry(
+            pmatic.WatchdogError(-15, '', 'timeout'), 1
+        ))
+
+    def test_parallel(self):
+        write_file('foo-input', 'hello')
+        write_file('bar-input', 'world')
+        scheduler = pmatic.LocalScheduler(cpus=2, memory='1G')
+        pipeline_loader = pmatic.PipelineLoader(
+            self.pmatic_base, self.dependency_finder, self.event_log,
+            scheduler=scheduler
+        )
+        pipeline = pipeline_loader.load_pipeline('greet-parallel-1')
+        self.assertEqual(pipeline.get_parameters(), set(['greeting']))
+        self.assertTrue(pipeline.run(pmatic.Namespace(greeting='hi')))
+        for name in ['big', 'foo', 'bar']:
+            self.assertTrue(os.path.isfile(name + '.log'))
+        self.assertEqual(
+            sorted((e.pipeline_name, e.what, hasattr(e, 'snapshot'))
+                   for e in self.event_log.event_data),
+            [('greet-parallel-1', 'finished', False),
+             ('greet-parallel-1', 'started', True),
+             ('greet-parallel-1/1-foo', 'finished', False),
+             ('greet-parallel-1/1-foo', 'started', False),
+             ('greet-parallel-1/2-greet', 'finished', False),
+             ('greet-parallel-1/2-greet', 'started', False),
+             ('greet-parallel-1/3-greet', 'finished', False),
+             ('greet-parallel-1/3-greet', 'started', False)]
+        )
+        self.assertEqual(scheduler.free_cpus, 2)
+
+    def test_sandbox(self):
+        write_file('foo-input', 'hello')
+        write_file('bar-input', 'world')
+        scheduler = pmatic.LocalScheduler(cpus=1, memory='1G')
+        pipeline = pmatic.PipelineLoader(
+            self.pmatic_base, self.dependency_finder, self.event_log,
+            scheduler=scheduler
+        ).load_pipeline('greet-sandbox-1')
+        self.assertEqual(pipeline.get_parameters(), set(['greeting']))
+        self.assertEqual([step.get_resources() for step in pipeline.steps],
+                         [(1, 0), (1, 0)])  # so they take turns
+        parallel = self.pipeline_loader.load_pipeline('greet-parallel-1')
+        self.assertEqual(parallel.get_resources(), (2 + 1 + 1, 2 ** 29))
+        self.assertTrue(pipeline.run(pmatic.Namespace(greeting='hi')))
+        with open('bar.log') as fin:
+            self.assertEqual(fin.read(),
+                             'inside foo\nhi $HOME\n     1\tworld\n')
+        self.assertTrue(os.path.isfile('foo.log'))
+        self.assertEqual(os.listdir('.pmatic/sandboxes'), [])
+        self.assertEqual(scheduler.free_cpus, 1)
+        self.assertEqual(
+            sorted((e.pipeline_name, e.what)
+                   for e in self.event_log.event_data),
+            [('greet-sandbox-1', 'finished'), ('greet-sandbox-1', 'started'),
+             ('greet-sandbox-1/1-greet', 'finished'),
+             ('greet-sandbox-1/1-greet', 'started'),
+             ('greet-sandbox-1/2-greet', 'finished'),
+             ('greet-sandbox-1/2-greet', 'started')]
+        )
+        os.remove('bar-input')
+        with self.assertRaises(EnvironmentError):
+            pipeline.run(pmatic.Namespace(greeting='hi'), force=True)
+        sandbox_path = os.path.join(self.test_dir, 'sandbox')
+        os.mkdir(sandbox_path)  # without foo-input
+        with self.assertRaises(SystemExit) as context:
+            pmatic.run_sandbox(self.pmatic_base, sandbox_path, 'foo-1')
+        self.assertEqual(context.exception.code, 1)  # not ENOENT
+        event_log = pmatic.EventLog(sandbox_path)
+        event_log.read_log()
+        self.assertEqual(event_log.get_status(), 'failed')
+        self.assertTrue(event_log.event_data[0].exception)
+        sandbox_path = os.path.join(self.test_dir, 'sandbox-bug')
+        os.mkdir(sandbox_path)
+
+        def run_pipeline(*args):
+            raise KeyError('bug')
+        original_run_pipeline = pmatic.PipelineEngine.run_pipeline
+        pmatic.PipelineEngine.run_pipeline = run_pipeline
+        try:
+            with self.assertRaises(SystemExit) as context:
+                pmatic.run_sandbox(self.pmatic_base, sandbox_path, 'foo-1')
+        finally:
+            pmatic.PipelineEngine.run_pipeline = original_run_pipeline
+        self.assertEqual(context.exception.code, 1)
+        event_log = pmatic.EventLog(sandbox_path)
+        event_log.read_log()
+        self.assertEqual([(e.what, e.exception) for e in event_log.event_data],
+                         [('failed', "'bug'")])
+        os.chdir(self.test_dir)  # which the sandbox engine left
+        step = pipeline.steps[0]
+        step.outputs = ['x', 'y/z']
+        merge_path = os.path.join(self.test_dir, 'merge')
+        os.makedirs(os.path.join(merge_path, 'y'))
+        for path in ['x', 'y/z']:
+            write_file(os.path.join(merge_path, path), 'new')
+        write_file('x', 'old')
+        write_file('y', 'in the way of y/z')
+        self.assertRaises(OSError, step.merge_outputs, self.test_dir,
+                          merge_path)
+        with open('x') as fin:  # put back
+            self.assertEqual(fin.read(), 'old\n')
+        self.assertTrue(os.path.isfile(os.path.join(merge_path, 'x')))
+        os.remove('y')
+        step.merge_outputs(self.test_dir, merge_path)
+        for path in ['x', 'y/z']:
+            with open(path) as fin:
+                self.assertEqual(fin.read(), 'new\n')
+
+    def test_critical_path(self):
+        pipeline = self.pipeline_loader.load_pipeline('sequence-1')
+        model = pmatic.DurationModel()
+        for step, seconds in zip(pipeline.steps, [1, 60, 2, 1, 1, 30]):
+            model.add(step.pipeline_name, step.duration_fields(), seconds)
+        self.assertEqual(model.default, 2)
+        pipeline.plan(model)
+        self.assertEqual([step.critical_path for step in pipeline.steps],
+                         [95, 94, 34, 32, 31, 30])
+        now = datetime.datetime.utcnow()
+        progress = {
+            'sequence-1/1-mkdir': pmatic.Event('sequence-1/1-mkdir',
+                                               'finished', None, id='1'),
+            'sequence-1/2-foo': pmatic.Event(
+                'sequence-1/2-foo', 'started', None, id='2',
+                when=now - datetime.timedelta(seconds=50)
+            ),
+        }
+        self.assertEqual(pipeline.estimate_remaining(model, progress, now),
+                         10 + 2 + 1 + 1 + 30)
+        parallel = self.pipeline_loader.load_pipeline('greet-parallel-1')
+        self.assertEqual(parallel.estimate_remaining(model), 2)
+        events = []
+        for name, seconds, extra in [('a', 10, {}), ('a', 20, {}),
+                                     ('a', 0, dict(up_to_date=True))]:
+            began = now - datetime.timedelta(seconds=100)
+            events[:0] = [
+                pmatic.Event(name, 'started', None, id=name, when=began,
+                             version='1'),
+                pmatic.Event(name, 'finished', None, id=name, when=began +
+                             datetime.timedelta(seconds=seconds), **extra),
+            ][::-1]
+        model = pmatic.DurationModel.from_events(events)
+        self.assertEqual(model.estimate('a', dict(version='1')), 15)
+
+    def test_parameter_generation(self):
+        write_file('foo-input', 'hello')
+        write_file('bar-input', 'world')
+        write_file('names.yaml', 'name: foo')
+        engine = pmatic.PipelineEngine(self.pmatic_base, self.test_dir)
+
+        def run(*args):
+            engine.run('greet-generated-1', *args)
+            with open('param-gen.calls') as fin:
+                return len(fin.readlines())
+        self.assertEqual(run(), 1)
+        self.assertEqual(pmatic.load_yaml_file('greeting.yaml'),
+                         dict(greeting='hello-foo'))
+        self.assertEqual(run(True), 1)  # inputs unchanged
+        write_file('names.yaml', 'name: bar')
+        self.assertEqual(run(), 2)
+        with open('bar.log') as fin:
+            self.assertEqual(fin.read(),
+                             'inside foo\nhello-bar $HOME\n     1\tworld\n')
+        self.assertEqual(run(True, True), 3)
+        os.remove(os.path.join('.pmatic', pmatic.PARAMETER_RECORDS_FILE_NAME))
+        self.assertEqual(run(), 4)  # not known to be up to date
+        self.assertEqual(run(), 4)
+
+
+class TestLocalScheduler(unittest.TestCase):
+    def wait_for_waiting(self, scheduler, count):
+        for attempt in xrange(100):
+            if len(scheduler.waiting) == count:
+                return
+            time.sleep(0.01)
+        self.fail('expected %d waiting requests' % count)
+
+    def test_backfill(self):
+        scheduler = pmatic.LocalScheduler(cpus=4, memory=100, max_skips=1)
+        granted = []
+
+        def request(cpus):
+            thread = threading.Thread(
+                target=lambda: granted.append(scheduler.acquire(cpus, 10))
+            )
+            thread.start()
+            return thread
+        big = scheduler.acquire(3, 10)
+        head = request(4)
+        self.wait_for_waiting(scheduler, 1)
+        small = scheduler.acquire(1, 10)  # backfills around the head
+        self.assertEqual(scheduler.waiting[0].skips, 1)
+        scheduler.release(small)
+        late = request(1)
+        self.wait_for_waiting(scheduler, 2)
+        time.sleep(0.05)
+        self.assertEqual(granted, [])  # The head may not be skipped again.
+        scheduler.release(big)
+        head.join()
+        self.assertEqual(granted[0].cpus, 4)
+        scheduler.release(granted[0])
+        late.join()
+        self.assertEqual(granted[1].cpus, 1)
+        self.assertRaises(EnvironmentError, scheduler.acquire, 5, 0)
+        self.assertRaises(EnvironmentError, scheduler.acquire, 1, 101)
+
+    def test_priority(self):
+        scheduler = pmatic.LocalScheduler(cpus=1, memory=100)
+        granted = []
+        busy = scheduler.acquire(1, 0)
+        for count, priority in enumerate([1, 5, 3]):
+            threading.Thread(
+                target=lambda priority=priority: granted.append(
+                    scheduler.acquire(1, 0, priority)
+                )
+            ).start()
+            self.wait_for_waiting(scheduler, count + 1)
+        self.assertEqual([request.priority for request in scheduler.waiting],
+                         [5, 3, 1])
+        scheduler.release(busy)
+        for count in xrange(3):
+            while len(granted) <= count:
+                time.sleep(0.01)
+            scheduler.release(granted[count])
+        self.assertEqual([request.priority for request in granted],
+                         [5, 3, 1])
+
 
 class TestEventLog(unittest.TestCase):
     def setUp(self):
@@ -198,13 +700,425 @@ class TestEventLog(unittest.TestCase):
         event_log.record_pipeline_finished(mock_pipeline)
         self.assertEqual(event_log.get_status(), 'finished')
 
+    def test_head_record(self):
+        mock_pipeline = pmatic.Namespace(pipeline_name='test-pipeline-1')
+        self.event_log.record_pipeline_started(mock_pipeline)
+        event_log = pmatic.EventLog(self.test_dir)
+        head = event_log.read_head()
+        self.assertEqual(head.id, '00000000-0000-0000-0000-000000000000')
+        self.assertEqual(head.what, 'started')
+        self.assertEqual(event_log.get_status(), 'started')
+        self.assertEqual(event_log.get_current_pipeline_name(),
+                         'test-pipeline-1')
+        self.assertEqual(event_log.event_data, None)  # never read the log
+
+    def test_legacy_head(self):
+        mock_pipeline = pmatic.Namespace(pipeline_name='test-pipeline-1')
+        self.event_log.record_pipeline_started(mock_pipeline)
+        self.event_log.record_pipeline_finished(mock_pipeline)
+        head_id = self.event_log.event_data[0].id
+        pmatic.save_yaml_file(self.event_log.head_path, head_id)
+        event_log = pmatic.EventLog(self.test_dir)
+        self.assertEqual(event_log.read_head().what, None)
+        self.assertEqual(event_log.get_status(), 'finished')
+        self.assertEqual(len(event_log.event_data), 2)
+
+    def test_durability(self):
+        mock_pipeline = pmatic.Namespace(pipeline_name='test-pipeline-1')
+        fsync = os.fsync
+        synced = []
+        os.fsync = lambda fd: synced.append(fd) or fsync(fd)
+        try:
+            counts = {}
+            for durability in pmatic.DURABILITY_MODES:
+                context_path = make_test_dir('EventLog', durability)
+                event_log = pmatic.EventLog(context_path,
+                                            durability=durability,
+                                            max_latency=60)
+                del synced[:]
+                for i in xrange(10):
+                    event_log.record_pipeline_started(mock_pipeline,
+                                                      take_snapshot=False)
+                    event_log.record_pipeline_finished(mock_pipeline)
+                if durability == 'batched':
+                    self.assertEqual(os.listdir(event_log.db_path), [])
+                    self.assertEqual(
+                        pmatic.EventLog(context_path).get_status(),
+                        'never_run'
+                    )
+                event_log.flush()
+                counts[durability] = len(synced)
+                self.assertEqual(len(os.listdir(event_log.db_path)), 20)
+                reader = pmatic.EventLog(context_path)
+                self.assertEqual(reader.get_status(), 'finished')
+                reader.read_log()
+                self.assertEqual(len(reader.event_data), 20)
+        finally:
+            os.fsync = fsync
+        self.assertEqual(counts, dict(none=0, batched=20 + 3,
+                                      strict=20 * 4))
+
+    def test_compact(self):
+        event_log = self.event_log
+        mock_pipeline = pmatic.Namespace(pipeline_name='test-pipeline-1')
+        scans = []
+        for i in xrange(4):
+            scans.append(pmatic.scan_directory(self.test_dir))
+            event_log.record_pipeline_started(mock_pipeline)
+            write_file(os.path.join(self.test_dir, 'out%d' % i), 'run %d' % i)
+            event_log.record_pipeline_finished(mock_pipeline)
+        self.assertEqual(event_log.compact(2), 3)
+        self.assertEqual(event_log.compact(2), 0)
+        self.assertEqual(
+            [event.what for event in event_log.event_data],
+            ['finished', 'started', 'finished', 'started', 'finished']
+        )
+        checkpoint = event_log.event_data[-1].checkpoint
+        self.assertEqual(checkpoint['events'], 4)
+        db_names = os.listdir(event_log.db_path)
+        self.assertEqual(len(db_names), 5)
+        inode_dir = os.path.join(self.test_dir, '.pmatic/inode_snapshots')
+        self.assertEqual(len(os.listdir(inode_dir)), 3)  # out0 .. out2
+        event_log.revert_one()
+        event_log.revert_one()
+        self.assertEqual(pmatic.scan_directory(self.test_dir), scans[2])
+        self.assertEqual(event_log.get_status(), 'finished')
+        self.assertRaises(AssertionError, event_log.revert_one)
+        # The events undone, and those recording the reverts, are gone.
+        self.assertEqual(event_log.compact(), 6)
+        self.assertEqual(os.listdir(event_log.db_path),
+                         [event_log.event_data[0].id + '.yaml'])
+        self.assertEqual(os.listdir(inode_dir), [])
+
+    def test_object_store(self):
+        store = pmatic.ObjectStore(make_test_dir('EventLog-store'))
+        contexts = [make_test_dir('EventLog-contexts', name)
+                    for name in ('a', 'b')]
+        mock_pipeline = pmatic.Namespace(pipeline_name='test-pipeline-1')
+        event_logs = []
+        for context_path in contexts:
+            write_file(os.path.join(context_path, 'in'), 'same contents')
+            event_log = pmatic.EventLog(context_path, object_store=store)
+            event_log.record_pipeline_started(mock_pipeline)
+            os.remove(os.path.join(context_path, 'in'))
+            event_log.record_pipeline_finished(mock_pipeline)
+            event_logs.append(event_log)
+        digest = hashlib.sha1('same contents\n').hexdigest()
+        self.assertEqual(event_logs[0].event_data[1].snapshot_objects,
+                         {'in': digest})
+        self.assertFalse(os.path.exists(os.path.join(
+            contexts[0], '.pmatic/inode_snapshots', 'in'
+        )))
+        original_hash_file = pmatic.hash_file
+        pmatic.hash_file = None  # the pre-key must avoid rehashing
+        try:
+            self.assertEqual(store.store(store.object_path(digest)), digest)
+        finally:
+            pmatic.hash_file = original_hash_file
+        event_logs[0].revert_one()
+        event_logs[1].revert_one()
+        paths = [os.path.join(context_path, 'in') for context_path in contexts]
+        self.assertFalse(os.path.samefile(*paths))
+        with open(paths[0], 'a') as fout:  # restored writable, and private
+            fout.write('more\n')
+        for path in [paths[1], store.object_path(digest)]:
+            with open(path) as fin:
+                self.assertEqual(fin.read(), 'same contents\n')
+        self.assertEqual(os.stat(store.object_path(digest)).st_mode & 0222, 0)
+        self.assertEqual(store.collect_garbage(grace=0), 0)
+        event_logs[1].compact(0)
+        shutil.rmtree(contexts[0])
+        self.assertEqual(store.collect_garbage(grace=0),
+                         len('same contents\n'))
+        self.assertFalse(os.path.exists(store.object_path(digest)))
+
+    def test_reflink(self):
+        event_log = self.event_log
+        mock_pipeline = pmatic.Namespace(pipeline_name='test-pipeline-1')
+        out_path = os.path.join(self.test_dir, 'out')
+        write_file(out_path, 'first')
+        original_clone_file = pmatic.clone_file
+        pmatic.clone_file = shutil.copyfile  # as if the filesystem could
+        try:
+            event_log.record_pipeline_started(mock_pipeline)
+            self.assertEqual(event_log.snapshot_strategy.name, 'reflink')
+            with open(out_path, 'a') as fout:  # still writable
+                fout.write('second\n')
+            event_log.record_pipeline_finished(mock_pipeline)
+            started = event_log.event_data[1]
+            self.assertEqual(started.snapshot_clones.keys(), ['out'])
+            self.assertEqual(os.stat(out_path).st_mode & 0777, 0644)
+            event_log.revert_one()
+            with open(out_path) as fin:
+                self.assertEqual(fin.read(), 'first\n')
+            event_log.record_pipeline_started(mock_pipeline)
+            event_log.record_pipeline_finished(mock_pipeline)
+        finally:
+            pmatic.clone_file = original_clone_file
+        self.assertEqual(event_log.compact(0), 1 + 3)  # and the reverted
+        self.assertEqual(os.listdir(os.path.join(
+            self.test_dir, '.pmatic/reflink_snapshots'
+        )), [])
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.uuid_mocker = GenUuidStrMocker()
+        self.test_dir = make_test_dir('Catalog')
+        self.catalog = pmatic.Catalog(os.path.join(self.test_dir, 'catalog'))
+        bar = pmatic.Namespace(pipeline_name='bar-1')
+        foo = pmatic.Namespace(pipeline_name='foo-1')
+        for name, pipeline, exit_code in [('a', bar, 0), ('b', bar, 2),
+                                          ('c/d', foo, 1)]:
+            context_path = os.path.join(self.test_dir, 'contexts', name)
+            os.makedirs(context_path)
+            event_log = pmatic.EventLog(context_path, self.catalog)
+            event_log.record_pipeline_started(pipeline)
+            if exit_code:
+                event_log.record_pipeline_failed(pipeline,
+                                                 exit_code=exit_code)
+            else:
+                event_log.record_pipeline_finished(pipeline)
+
+    def tearDown(self):
+        self.uuid_mocker.close()
+
+    def test_find(self):
+        catalog = self.catalog
+        self.assertEqual(len(catalog.find_events()), 6)
+        rows = catalog.find_events(pipeline_name='bar-1', what='failed')
+        self.assertEqual(len(rows), 1)
+        context_path, pipeline_name, what, time, exit_code = rows[0]
+        self.assertTrue(context_path.endswith('contexts/b'))
+        self.assertEqual(exit_code, 2)
+        rows = catalog.find_contexts(status='failed')
+        self.assertEqual(sorted(row[1] for row in rows), ['bar-1', 'foo-1'])
+        self.assertEqual(catalog.find_events(since='9999'), [])
+
+    def test_compact(self):
+        context_path = os.path.join(self.test_dir, 'contexts', 'a')
+        event_log = pmatic.EventLog(context_path, self.catalog)
+        event_log.revert_one()
+        self.assertEqual(len(self.catalog.find_events(context_path)), 3)
+        self.assertEqual(event_log.compact(), 3)
+        self.assertEqual(self.catalog.find_events(context_path), [])
+        self.assertEqual(len(self.catalog.find_events()), 4)
+
+    def test_reindex(self):
+        catalog = pmatic.Catalog(os.path.join(self.test_dir, 'rebuilt'))
+        root_path = os.path.join(self.test_dir, 'contexts')
+        self.assertEqual(catalog.reindex([root_path], processes=2), 3)
+        self.assertEqual(sorted(catalog.find_events()),
+                         sorted(self.catalog.find_events()))
+        self.assertEqual(sorted(catalog.find_contexts()),
+                         sorted(self.catalog.find_contexts()))
+
+
+class TestStepCache(unittest.TestCase):
+    def setUp(self):
+        self.uuid_mocker = GenUuidStrMocker()
+        self.test_dir = make_test_dir('StepCache')
+        self.cwd = os.getcwd()
+        self.pmatic_base = os.path.join(
+            os.environ['PROJECT_ROOT'], 'test/pmatic_base'
+        )
+        self.dependency_finder = pmatic.DependencyFinder(self.pmatic_base)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.uuid_mocker.close()
+
+    def run_foo(self, context_name, step_cache):
+        """Run foo-1 with caching in a new context. Return its event log."""
+        context_path = os.path.join(self.test_dir, context_name)
+        os.mkdir(context_path)
+        os.chdir(context_path)
+        write_file('foo-input', 'hello\nworld')
+        event_log = pmatic.EventLog(context_path)
+        pipeline_loader = pmatic.PipelineLoader(
+            self.pmatic_base, self.dependency_finder, event_log, step_cache
+        )
+        pipeline = pipeline_loader.load_pipeline('foo-1')
+        pipeline.cache = True
+        pipeline.run(pmatic.Namespace())
+        return event_log
+
+    def test_hit(self):
+        step_cache = pmatic.StepCache(os.path.join(self.test_dir, 'cache'))
+        first = self.run_foo('a', step_cache).event_data[0]
+        self.assertFalse(hasattr(first, 'cache_hit'))
+        second = self.run_foo('b', step_cache).event_data[0]
+        self.assertEqual(second.what, 'finished')
+        self.assertTrue(second.cache_hit)
+        first_path = os.path.join(self.test_dir, 'a', 'foo.log')
+        self.assertFalse(os.path.samefile(first_path, 'foo.log'))
+        self.assertTrue(os.stat(first_path).st_mode & stat.S_IWUSR)
+        self.assertEqual(os.stat('foo.log').st_nlink, 2)
+        with open('foo.log') as fin:
+            self.assertEqual(fin.read(), 'inside foo\n123 abc\n'
+                             '     1\thello\n     2\tworld\n')
+        entry_name, = os.listdir(step_cache.entries_path)
+        entry_path = os.path.join(step_cache.entries_path, entry_name)
+        write_file(entry_path, 'file_type: step-cache-entry-1\noutputs: {}')
+        third = self.run_foo('c', step_cache).event_data[0]
+        self.assertFalse(hasattr(third, 'cache_hit'))
+        self.assertEqual(pmatic.load_yaml_file(entry_path)['outputs'].keys(),
+                         ['foo.log'])
+
+    def test_missing_input(self):
+        step_cache = pmatic.StepCache(os.path.join(self.test_dir, 'cache'))
+        context_path = os.path.join(self.test_dir, 'missing')
+        os.mkdir(context_path)
+        os.chdir(context_path)
+        event_log = pmatic.EventLog(context_path)
+        pipeline_loader = pmatic.PipelineLoader(
+            self.pmatic_base, self.dependency_finder, event_log, step_cache
+        )
+        pipeline = pipeline_loader.load_pipeline('foo-1')
+        pipeline.cache = True
+        self.assertRaises(EnvironmentError, pipeline.run, pmatic.Namespace())
+        self.assertEqual(event_log.event_data[0].what, 'failed')
+        self.assertEqual(os.listdir(step_cache.entries_path), [])
+
+    def test_eviction(self):
+        step_cache = pmatic.StepCache(os.path.join(self.test_dir, 'cache'),
+                                      max_bytes=1)
+        self.run_foo('a', step_cache)
+        self.assertEqual(os.listdir(step_cache.entries_path), [])
+        for dir_path, dir_names, file_names in os.walk(
+            step_cache.objects_path
+        ):
+            self.assertEqual(file_names, [])
+        second = self.run_foo('b', step_cache).event_data[0]
+        self.assertFalse(hasattr(second, 'cache_hit'))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_textfile(self):
+        metrics_dir = make_test_dir('Metrics')
+        for i in xrange(2):  # as if from two processes
+            metrics = pmatic.Metrics(metrics_dir)
+            metrics.increment('pmatic_runs_total', result='finished')
+            metrics.increment('pmatic_step_failures_total', exit_code=2)
+            metrics.observe('pmatic_run_seconds', 0.5)
+            metrics.observe('pmatic_run_seconds', 100)
+            metrics.flush()
+        with open(os.path.join(metrics_dir, 'pmatic.prom')) as fin:
+            lines = fin.read().splitlines()
+        self.assertIn('pmatic_runs_total{result="finished"} 2', lines)
+        self.assertIn('pmatic_step_failures_total{exit_code="2"} 2', lines)
+        self.assertIn('# TYPE pmatic_run_seconds histogram', lines)
+        self.assertIn('pmatic_run_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('pmatic_run_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('pmatic_run_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('pmatic_run_seconds_sum 201.0', lines)
+        self.assertIn('pmatic_run_seconds_count 4', lines)
+
+
+class TestWatchStatus(unittest.TestCase):
+    def setUp(self):
+        self.uuid_mocker = GenUuidStrMocker()
+        self.test_dir = make_test_dir('WatchStatus')
+
+    def tearDown(self):
+        self.uuid_mocker.close()
+
+    def check_watch(self, use_inotify):
+        context_paths = [os.path.join(self.test_dir, name)
+                         for name in ('a', 'b')]
+        for context_path in context_paths:
+            os.mkdir(context_path)
+        watch = pmatic.watch_status(context_paths, poll_interval=0.01,
+                                    timeout=2, use_inotify=use_inotify)
+        self.assertEqual(sorted(status for path, status in
+                                itertools.islice(watch, 2)),
+                         ['never_run', 'never_run'])
+        event_log = pmatic.EventLog(context_paths[1])
+        mock_pipeline = pmatic.Namespace(pipeline_name='test-pipeline-1')
+        timer = threading.Timer(
+            0.1, event_log.record_pipeline_started, (mock_pipeline,)
+        )
+        timer.start()
+        self.assertEqual(next(watch), (context_paths[1], 'started'))
+        event_log.record_pipeline_finished(mock_pipeline)
+        self.assertEqual(next(watch), (context_paths[1], 'finished'))
+        watch.close()
+
+    def test_inotify(self):
+        self.check_watch(True)
+
+    def test_polling(self):
+        self.check_watch(False)
+
+    def test_bulk(self):
+        mock_pipeline = pmatic.Namespace(pipeline_name='test-pipeline-1')
+        expected = {}
+        for name, what in [('a', None), ('b/c', 'finished'),
+                           ('b/d', 'failed'), ('b/d/e', 'started')]:
+            context_path = os.path.join(self.test_dir, name)
+            os.makedirs(context_path)
+            event_log = pmatic.EventLog(context_path)
+            if what:
+                event_log.record_pipeline_started(mock_pipeline)
+                getattr(event_log, 'record_pipeline_' + what,
+                        lambda pipeline, **kwds: None)(mock_pipeline,
+                                                       exit_code=3)
+                expected[context_path] = what
+        found = pmatic.walk_context_paths([self.test_dir], threads=3)
+        summaries = list(pmatic.map_unordered(pmatic.summarize_context,
+                                              found, threads=2))
+        self.assertEqual(dict((summary['context'], summary['status'])
+                              for summary in summaries), expected)
+        for summary in summaries:
+            self.assertEqual(summary['pipeline'], 'test-pipeline-1')
+            self.assertTrue(summary['last_event'].endswith('Z'))
+            self.assertEqual(summary['failure'],
+                             'exit code 3' if summary['status'] == 'failed'
+                             else None)
+
+
+class TestFastStart(unittest.TestCase):
+    """Guards the start-up cost paid by every command-line invocation."""
+    IMPORT_TIME_BUDGET = 0.05  # seconds; typically well under 0.005
+    HEAVY_MODULES = ['yaml', 'subprocess', 'uuid', 'datetime']
+    PROBE = """if True:
+        import sys, time
+        start = time.time()
+        import pmatic
+        elapsed = time.time() - start
+        status = pmatic.EventLog(sys.argv[1]).get_status()
+        print elapsed
+        print status
+        print ' '.join(m for m in sys.argv[2:] if sys.modules.get(m))
+        """
+
+    def setUp(self):
+        self.uuid_mocker = GenUuidStrMocker()
+        self.test_dir = make_test_dir('FastStart')
+        event_log = pmatic.EventLog(self.test_dir)
+        mock_pipeline = pmatic.Namespace(pipeline_name='test-pipeline-1')
+        event_log.record_pipeline_started(mock_pipeline)
+        event_log.record_pipeline_finished(mock_pipeline)
+
+    def tearDown(self):
+        self.uuid_mocker.close()
+
+    def test_status_without_heavy_imports(self):
+        args = [sys.executable, '-c', self.PROBE, self.test_dir]
+        args.extend(self.HEAVY_MODULES)
+        output = subprocess.check_output(args)
+        elapsed, status, loaded = output.split('\n')[:3]
+        self.assertEqual(status, 'finished')
+        self.assertEqual(loaded, '')
+        self.assertLess(float(elapsed), self.IMPORT_TIME_BUDGET)
+
 
 class GenUuidStrMocker(object):
     """During construction, will replace pmatic.gen_uuid_str with a mock.
     Restores original function during close."""
     def __init__(self):
         self.original_gen = pmatic.gen_uuid_str
-        gen = ('00000000-0000-0000-0000-%012d' % i for i in xrange(20)).next
+        gen = ('00000000-0000-0000-0000-%012d' % i for i in xrange(100)).next
         pmatic.gen_uuid_str = gen
 
     def close(self):
@@ -324,6 +1238,26 @@ class TestNamespace(unittest.TestCase):
         )
 
 
+class TestTemplate(unittest.TestCase):
+    def test_substitute(self):
+        template = pmatic.Template('${name}-${x}.log costs $5, not $${x}')
+        self.assertEqual(template.names, frozenset(['name', 'x']))
+        self.assertEqual(template.substitute(dict(name='a', x=1)),
+                         'a-1.log costs $5, not ${x}')
+        self.assertEqual(
+            pmatic.compile_templates(['plain', {'k': '${v}'}])[1]['k'].names,
+            frozenset(['v'])
+        )
+
+    def test_literal_dollars(self):
+        for text in ['{print $1}', 'end$', '$HOME', '$', '$$', '${1}', '${']:
+            self.assertEqual(pmatic.compile_templates([text]), [text])
+        template = pmatic.compile_templates("awk '{print $1}' ${file}$")
+        self.assertEqual(template.names, frozenset(['file']))
+        self.assertEqual(template.substitute(dict(file='a')),
+                         "awk '{print $1}' a$")
+
+
 class TestChainMap(unittest.TestCase):
     def setUp(self):
         m1, m2 = make_maps()
@@ -385,6 +1319,16 @@ class TestChainMap(unittest.TestCase):
             sorted(c2.iteritems()), [('a', 3), ('b', 2), ('c', 4)]
         )
 
+    def test_push_pop(self):
+        c2 = self.c2
+        self.assertEqual(c2['a'], 3)
+        c2.push(dict(a=5, e=9))
+        self.assertEqual(c2['a'], 5)
+        c2['f'] = 10
+        self.assertEqual(len(c2), 6)
+        self.assertEqual(c2.pop(), dict(a=5, e=9, f=10))
+        self.assertEqual(c2, dict(a=3, b=2, c=4, d=7))
+
     def test_deep(self):
         c2 = self.c2
         c2['e'] = 8